@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the MJPEG frame splitter.
+Compares src/mjpeg.py against the old bytes-concatenating preview generator
+on a synthetic stream of JPEG-sized frames.
+
+Usage:
+    python scripts/debug/bench_mjpeg_splitter.py [frame_kb] [frames] [read_size]
+"""
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+from mjpeg import FrameSplitter  # noqa: E402
+
+
+def make_stream(frame_kb, frames):
+    """Build an MJPEG stream of frames with no markers inside the payload"""
+    payload = bytes(i % 255 for i in range(frame_kb * 1024))
+    frame = b'\xff\xd8' + payload + b'\xff\xd9'
+    return frame * frames
+
+
+def legacy_split(stream, read_size):
+    """The original web.api_preview generator loop"""
+    buffer = b''
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            break
+        buffer += chunk
+        start = buffer.find(b'\xff\xd8')
+        if start != -1:
+            end = buffer.find(b'\xff\xd9', start)
+            if end != -1:
+                yield buffer[start:end + 2]
+                buffer = buffer[end + 2:]
+
+
+def splitter_split(stream, read_size):
+    return FrameSplitter(read_size=read_size).read_frames(stream)
+
+
+def run(name, split, data, read_size, repeat=3):
+    best = None
+    for _ in range(repeat):
+        stream = io.BufferedReader(io.BytesIO(data))
+        start = time.perf_counter()
+        count = sum(1 for _ in split(stream, read_size))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    mb = len(data) / (1024 * 1024)
+    print(f"{name:>10}: {count} frames, {best * 1000:8.1f} ms, {mb / best:8.1f} MB/s")
+    return best
+
+
+def main():
+    frame_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    read_size = int(sys.argv[3]) if len(sys.argv) > 3 else 4096
+
+    data = make_stream(frame_kb, frames)
+    print(f"{frames} frames of {frame_kb} KB, read size {read_size}")
+    legacy = run('legacy', legacy_split, data, read_size)
+    current = run('splitter', splitter_split, data, read_size)
+    print(f"speedup: {legacy / current:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Load test the booth's web server and check the booth stays responsive.
+
+Runs the simulated booth in this process (see sim_booth.py), measures an
+idle baseline, then opens many preview streams, clip downloads and API
+pollers at once and measures again. Booth responsiveness is measured two
+ways: how late a 5 ms sleep wakes up on another thread (GIL contention)
+and the state machine's own handler latency histogram.
+
+Usage:
+    python scripts/debug/load_test_web.py [--previews 20] [--downloads 4]
+        [--pollers 4] [--seconds 30] [--server waitress]
+        [--preview-bandwidth 0]
+
+Needs ffmpeg for the preview streams; downloads and API polling work
+without it.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import urllib.request
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+PORT = 5099
+CLIP_SIZE = 20 * 1024 * 1024
+READ_SIZE = 64 * 1024
+BOUNDARY = b'--frame\r\n'
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Phase:
+    """Measurements taken while one load level runs"""
+
+    def __init__(self, name):
+        self.name = name
+        self.jitter = []
+        self.api_latency = []
+        self.download_bytes = 0
+        self.preview_bytes = 0
+        self.preview_frames = {}
+        self.tiers = {}
+        self.cpu = 0.0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, field, value):
+        with self.lock:
+            if isinstance(getattr(self, field), list):
+                getattr(self, field).append(value)
+            else:
+                setattr(self, field, getattr(self, field) + value)
+
+
+def jitter_probe(phase_ref, stop):
+    """Measure how late short sleeps wake up"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        time.sleep(0.005)
+        phase_ref[0].add('jitter', time.perf_counter() - start - 0.005)
+
+
+def preview_client(base, phase_ref, stop):
+    tail = b''
+    while not stop.is_set():
+        try:
+            with urllib.request.urlopen(f"{base}/api/preview", timeout=10) as response:
+                while not stop.is_set():
+                    data = response.read1(READ_SIZE)
+                    if not data:
+                        break
+                    phase = phase_ref[0]
+                    phase.add('preview_bytes', len(data))
+                    # Count frames by their boundaries, which may straddle reads
+                    frames = (tail + data).count(BOUNDARY)
+                    tail = data[-(len(BOUNDARY) - 1):]
+                    with phase.lock:
+                        client = threading.current_thread().name
+                        phase.preview_frames[client] = phase.preview_frames.get(client, 0) + frames
+        except Exception:
+            phase_ref[0].add('errors', 1)
+            time.sleep(1)
+
+
+def download_client(base, clip, phase_ref, stop):
+    while not stop.is_set():
+        try:
+            with urllib.request.urlopen(f"{base}/videos/{clip}/video.mp4", timeout=10) as response:
+                while not stop.is_set():
+                    data = response.read(READ_SIZE)
+                    if not data:
+                        break
+                    phase_ref[0].add('download_bytes', len(data))
+        except Exception:
+            phase_ref[0].add('errors', 1)
+            time.sleep(1)
+
+
+def api_poller(base, phase_ref, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"{base}/api/queue", timeout=10) as response:
+                response.read()
+            phase_ref[0].add('api_latency', time.perf_counter() - start)
+        except Exception:
+            phase_ref[0].add('errors', 1)
+        time.sleep(0.1)
+
+
+def handler_mean(metrics):
+    """Mean state machine handler time from the metrics registry"""
+    text = metrics.render()
+    total = count = 0.0
+    for line in text.splitlines():
+        if line.startswith('photobooth_state_handler_seconds_sum'):
+            total += float(line.rsplit(' ', 1)[1])
+        elif line.startswith('photobooth_state_handler_seconds_count'):
+            count += float(line.rsplit(' ', 1)[1])
+    return total, count
+
+
+def preview_tiers(metrics):
+    """Preview frames sent so far by tier"""
+    tiers = {}
+    for line in metrics.render().splitlines():
+        if line.startswith('photobooth_preview_frames_total{'):
+            labels, value = line.rsplit(' ', 1)
+            tiers[labels.split('tier="', 1)[1].split('"', 1)[0]] = float(value)
+    return tiers
+
+
+def cpu_time():
+    """CPU seconds used by this process and its ffmpeg children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def report(phase, seconds, handler):
+    print(f"\n== {phase.name} ==")
+    print(f"sleep overshoot   p50={percentile(phase.jitter, 50) * 1000:7.2f}ms "
+          f"p99={percentile(phase.jitter, 99) * 1000:7.2f}ms max={max(phase.jitter, default=0) * 1000:7.2f}ms")
+    if phase.api_latency:
+        print(f"/api/queue        p50={percentile(phase.api_latency, 50) * 1000:7.2f}ms "
+              f"p99={percentile(phase.api_latency, 99) * 1000:7.2f}ms n={len(phase.api_latency)}")
+    print(f"downloads         {phase.download_bytes / seconds / 1e6:7.1f} MB/s")
+    print(f"previews          {phase.preview_bytes / seconds / 1e6:7.1f} MB/s")
+    if phase.preview_frames:
+        fps = [frames / seconds for frames in phase.preview_frames.values()]
+        print(f"preview fps       min={min(fps):5.1f} p50={percentile(fps, 50):5.1f} "
+              f"max={max(fps):5.1f} clients={len(fps)}")
+    if phase.tiers:
+        total = sum(phase.tiers.values())
+        print("preview tiers     " + " ".join(f"{tier}={frames / total:.0%}"
+                                              for tier, frames in phase.tiers.items() if frames))
+    print(f"cpu               {phase.cpu / seconds:7.0%} of one core, {os.cpu_count()} available")
+    print(f"state handlers    mean={handler * 1000:7.3f}ms")
+    print(f"client errors     {phase.errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--previews', type=int, default=20)
+    parser.add_argument('--downloads', type=int, default=4)
+    parser.add_argument('--pollers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--server', default='auto', help="auto, waitress or werkzeug")
+    parser.add_argument('--preview-bandwidth', type=int,
+                        help="preview_max_bandwidth in bytes/s for all previews, 0 for no cap")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='photobooth-load-')
+    os.environ['PHOTOBOOTH_HARDWARE'] = 'sim'
+    os.environ['PHOTOBOOTH_DATA_DIR'] = data_dir
+    os.environ.setdefault('PHOTOBOOTH_SIM_INTERVAL', '8')
+    booth_settings = {
+        'webcam_resolution': '640x480',
+        'video_framerate': 30,
+        'video_duration': 3,
+        'web_port': PORT,
+        'web_server': args.server,
+        'web_threads': args.previews + args.downloads + args.pollers + 4,
+    }
+    if args.preview_bandwidth is not None:
+        booth_settings['preview_max_bandwidth'] = args.preview_bandwidth
+    with open(os.path.join(data_dir, 'settings.json'), 'w') as f:
+        json.dump(booth_settings, f, indent=4)
+
+    sys.path.insert(0, SRC_DIR)
+    import app
+    import metrics
+    from camera import VIDEO_DIR_OUT
+
+    # A clip to download
+    os.makedirs(VIDEO_DIR_OUT, exist_ok=True)
+    clip = 'loadtest-clip'
+    with open(os.path.join(VIDEO_DIR_OUT, f"{clip}.mp4"), 'wb') as f:
+        f.write(os.urandom(CLIP_SIZE))
+
+    thread = threading.Thread(target=app.state_machine, name="state-machine")
+    thread.daemon = True
+    thread.start()
+    time.sleep(6)  # init state sleeps while hardware settles
+
+    base = f"http://127.0.0.1:{PORT}"
+    stop_all = threading.Event()
+    phase_ref = [Phase('idle')]
+    threading.Thread(target=jitter_probe, args=(phase_ref, stop_all), daemon=True).start()
+
+    # Idle baseline, with a single poller to measure API latency
+    before = handler_mean(metrics)
+    cpu_before = cpu_time()
+    stop_idle = threading.Event()
+    threading.Thread(target=api_poller, args=(base, phase_ref, stop_idle), daemon=True).start()
+    time.sleep(args.seconds)
+    stop_idle.set()
+    after = handler_mean(metrics)
+    idle = phase_ref[0]
+    idle.cpu = cpu_time() - cpu_before
+    idle_handler = (after[0] - before[0]) / max(1, after[1] - before[1])
+
+    # Loaded
+    phase_ref[0] = Phase(f"loaded: {args.previews} previews, {args.downloads} downloads, "
+                         f"{args.pollers} pollers")
+    before = after
+    cpu_before = cpu_time()
+    tiers_before = preview_tiers(metrics)
+    clients = ([(preview_client, (base, phase_ref, stop_all))] * args.previews +
+               [(download_client, (base, clip, phase_ref, stop_all))] * args.downloads +
+               [(api_poller, (base, phase_ref, stop_all))] * args.pollers)
+    threads = []
+    for i, (target, client_args) in enumerate(clients):
+        threads.append(threading.Thread(target=target, args=client_args, name=f"client-{i}", daemon=True))
+        threads[-1].start()
+    time.sleep(args.seconds)
+    after = handler_mean(metrics)
+    loaded = phase_ref[0]
+    loaded.cpu = cpu_time() - cpu_before
+    loaded.tiers = {tier: frames - tiers_before.get(tier, 0) for tier, frames in preview_tiers(metrics).items()}
+    loaded_handler = (after[0] - before[0]) / max(1, after[1] - before[1])
+    stop_all.set()
+    # Hang up before the server goes away under the streams
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # waitress identifies itself as 'photobooth', werkzeug by name
+    with urllib.request.urlopen(f"{base}/api/queue", timeout=10) as response:
+        print(f"\nserver: {response.headers.get('Server')}")
+    report(idle, args.seconds, idle_handler)
+    report(loaded, args.seconds, loaded_handler)
+
+    app.stop_flask()
+
+
+if __name__ == '__main__':
+    main()
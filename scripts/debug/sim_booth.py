@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Run the full booth headless on simulated hardware and report throughput
+and per-stage latency.
+
+The state machine, capture, processing and uploads all run for real; only
+the GPIO, RFID reader, LCD and webcam are the simulated backends from
+src/sim.py, with ffmpeg's testsrc standing in for the camera.
+
+Usage:
+    python scripts/debug/sim_booth.py [seconds] [script]
+
+Needs ffmpeg and the Python requirements except the Pi-only packages.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import threading
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+
+
+def summarize(text):
+    """Print count and mean of every histogram in Prometheus text output"""
+    pattern = r'^(\w+)_(sum|count)(\{[^}]*\})? (\S+)$'
+    series = {}
+    for name, kind, labels, value in re.findall(pattern, text, re.M):
+        series.setdefault(name + labels, {})[kind] = float(value)
+    for key, values in sorted(series.items()):
+        count = values.get('count', 0)
+        if count:
+            print(f"{key:<70} n={count:<5.0f} mean={values.get('sum', 0) / count:8.3f}s")
+    for line in text.splitlines():
+        if line.startswith(('photobooth_recordings_total', 'photobooth_processing_jobs_total')):
+            print(line)
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 120
+    if len(sys.argv) > 2:
+        os.environ['PHOTOBOOTH_SIM_SCRIPT'] = os.path.abspath(sys.argv[2])
+
+    data_dir = tempfile.mkdtemp(prefix='photobooth-sim-')
+    os.environ['PHOTOBOOTH_HARDWARE'] = 'sim'
+    os.environ['PHOTOBOOTH_DATA_DIR'] = data_dir
+    with open(os.path.join(data_dir, 'settings.json'), 'w') as f:
+        json.dump({
+            'webcam_resolution': '640x480',
+            'video_framerate': 30,
+            'video_duration': 5,
+        }, f, indent=4)
+
+    sys.path.insert(0, SRC_DIR)
+    import app
+    import metrics
+
+    print(f"Running simulated booth for {duration:.0f}s in {data_dir}")
+    thread = threading.Thread(target=app.state_machine, name="state-machine")
+    thread.daemon = True
+    thread.start()
+    time.sleep(duration)
+
+    summarize(metrics.render())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Check the upload service against a local SMB server.
+
+Starts impacket's SMB server on a temporary folder as a stand-in for the
+booth's Samba share, unless --share points at a real one, and runs the
+upload service from src/samba.py through these cases:
+
+    upload      a queued clip arrives intact under its real name
+    resume      a partial upload left on the share is continued, not resent
+    no-share    with no share configured clips stay queued and untried,
+                and go up as soon as one is set
+    down        with the server unreachable a clip is retried with
+                backoff, and goes up once the share setting is fixed
+
+Usage:
+    python scripts/debug/smb_upload_test.py [--share smb://host:port/share
+        --username user --password pass]
+
+Needs impacket for the local server (pip install impacket).
+"""
+
+import io
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+PORT = 4445
+SHARE_NAME = 'BOOTH'
+CLIP_SIZE = 3 * 1024 * 1024 + 123   # a few chunks and a short last one
+TIMEOUT = 30
+
+
+def start_local_share(folder):
+    """Serve folder as an SMB share on localhost, returns its smb:// URL"""
+    from impacket import smbserver
+
+    server = smbserver.SimpleSMBServer(listenAddress='127.0.0.1', listenPort=PORT)
+    server.addShare(SHARE_NAME, folder, 'Photobooth uploads')
+    server.setSMB2Support(True)
+    thread = threading.Thread(target=server.start, name="smb-server")
+    thread.daemon = True
+    thread.start()
+    time.sleep(1)
+    return f"smb://127.0.0.1:{PORT}/{SHARE_NAME}"
+
+
+def wait_for(condition, timeout=TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def make_clip(folder, name):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(CLIP_SIZE))
+    return path
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class Remote:
+    """A separate connection for checking what landed on the share"""
+
+    def __init__(self, samba, share_url, username, password):
+        from smb.SMBConnection import SMBConnection
+
+        server, port, self.share = samba.parse_share(share_url)
+        self.conn = SMBConnection(username, password, 'photobooth-test', server, use_ntlm_v2=True)
+        if not self.conn.connect(server, port):
+            raise ConnectionError(f"Can't connect to {share_url}")
+
+    def read(self, name):
+        data = io.BytesIO()
+        try:
+            self.conn.retrieveFile(self.share, name, data)
+        except Exception:
+            return None
+        return data.getvalue()
+
+    def write(self, name, data):
+        self.conn.storeFile(self.share, name, io.BytesIO(data))
+
+    def remove(self, name):
+        try:
+            self.conn.deleteFiles(self.share, name)
+        except Exception:
+            pass
+
+
+def queued(samba, path):
+    return any(entry['path'] == path for entry in samba.get_upload_stats()['queue'])
+
+
+def arrived(remote, path):
+    with open(path, 'rb') as f:
+        expected = digest(f.read())
+    data = remote.read(os.path.basename(path))
+    return data is not None and digest(data) == expected
+
+
+def case_upload(samba, settings, remote, folder, share):
+    path = make_clip(folder, 'upload-test.mp4')
+    samba.queue_upload(path)
+    if not wait_for(lambda: not queued(samba, path)):
+        return "still queued"
+    if not arrived(remote, path):
+        return "missing or different on the share"
+    if remote.read('upload-test.mp4' + samba.PARTIAL_SUFFIX) is not None:
+        return "partial file left behind"
+
+
+def case_resume(samba, settings, remote, folder, share):
+    path = make_clip(folder, 'resume-test.mp4')
+    with open(path, 'rb') as f:
+        head = f.read(CLIP_SIZE // 2)
+    remote.write('resume-test.mp4' + samba.PARTIAL_SUFFIX, head)
+    sent_before = samba.get_upload_stats()['bytes']
+    samba.queue_upload(path)
+    if not wait_for(lambda: not queued(samba, path)):
+        return "still queued"
+    if not arrived(remote, path):
+        return "missing or different on the share"
+    sent = samba.get_upload_stats()['bytes'] - sent_before
+    if sent != CLIP_SIZE - len(head):
+        return f"sent {sent} bytes, expected {CLIP_SIZE - len(head)}"
+
+
+def case_no_share(samba, settings, remote, folder, share):
+    settings.save_settings({**settings.load_settings(), 'samba_share': ''})
+    failed_before = samba.get_upload_stats()['failed_attempts']
+    path = make_clip(folder, 'no-share-test.mp4')
+    samba.queue_upload(path)
+    time.sleep(3)
+    stats = samba.get_upload_stats()
+    if not queued(samba, path):
+        return "left the queue without a share"
+    if stats['failed_attempts'] != failed_before:
+        return f"tried {stats['failed_attempts'] - failed_before} uploads without a share"
+    if not stats['paused']:
+        return "not reported as paused"
+    settings.save_settings({**settings.load_settings(), 'samba_share': share})
+    if not wait_for(lambda: not queued(samba, path)):
+        return "not uploaded once the share was set"
+    if not arrived(remote, path):
+        return "missing or different on the share"
+
+
+def case_down(samba, settings, remote, folder, share):
+    # Nothing listens on the port after the local server's
+    settings.save_settings({**settings.load_settings(), 'samba_share': f"smb://127.0.0.1:{PORT + 1}/{SHARE_NAME}"})
+    path = make_clip(folder, 'down-test.mp4')
+    samba.queue_upload(path)
+
+    def attempts():
+        entries = [e for e in samba.get_upload_stats()['queue'] if e['path'] == path]
+        return entries[0]['attempts'] if entries else 0
+
+    if not wait_for(lambda: attempts() >= 2, timeout=samba.RETRY_BASE_DELAY * 3 + 5):
+        return "not retried"
+    entry = [e for e in samba.get_upload_stats()['queue'] if e['path'] == path][0]
+    if entry['next_attempt'] - time.time() <= samba.RETRY_BASE_DELAY:
+        return "no backoff between retries"
+    settings.save_settings({**settings.load_settings(), 'samba_share': share})
+    # The settings change retries at once rather than after the backoff
+    if not wait_for(lambda: not queued(samba, path), timeout=samba.RETRY_BASE_DELAY):
+        return "not uploaded once the share was fixed"
+    if not arrived(remote, path):
+        return "missing or different on the share"
+
+
+CASES = [
+    ('upload', case_upload),
+    ('resume', case_resume),
+    ('no-share', case_no_share),
+    ('down', case_down),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--share', help="smb:// URL of a real share instead of the local one")
+    parser.add_argument('--username', default='guest')
+    parser.add_argument('--password', default='')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='photobooth-smb-')
+    os.environ['PHOTOBOOTH_DATA_DIR'] = data_dir
+    sys.path.insert(0, SRC_DIR)
+    import settings
+    import samba
+
+    share = args.share
+    if not share:
+        folder = os.path.join(data_dir, 'share')
+        os.makedirs(folder)
+        share = start_local_share(folder)
+    settings.save_settings({'samba_share': share, 'samba_username': args.username,
+                            'samba_password': args.password})
+    remote = Remote(samba, share, args.username, args.password)
+    clips = os.path.join(data_dir, 'clips')
+    os.makedirs(clips)
+
+    failures = 0
+    for name, case in CASES:
+        start = time.time()
+        try:
+            error = case(samba, settings, remote, clips, share)
+        except Exception as e:
+            error = f"raised {e!r}"
+        print(f"{name:<10} {'FAIL: ' + error if error else 'ok'} ({time.time() - start:.1f}s)")
+        failures += bool(error)
+        remote.remove(f"{name}-test.mp4")
+
+    # The local server serves each connection on its own thread until it closes
+    remote.conn.close()
+    with samba._conn_lock:
+        samba._close_connection()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,65 +2,128 @@
 """
 Main application for the Alleycat Photobooth.
 Handles RFID reading, button control, video recording, and state management.
+
+The booth is driven by a blocking event queue. GPIO edges, RFID detections,
+state timeouts and background job results are posted as events, and the
+state machine thread sleeps on the queue in between.
 """
 
-import os
 import time
-import csv
-from datetime import datetime
-import RPi.GPIO as GPIO
-from mfrc522 import MFRC522
-import ffmpeg
-from logit import log, DEBUG
-from settings import load_settings, save_settings
+import queue
 import threading
-from gpio import init_gpio, cleanup, BUTTON_PIN, BUTTON_LED_PIN, STAGE_LEDS
-from led import turn_on_all_leds, turn_on_stage_led, turn_on_button_led, turn_off_button_led
-from rfid import scan_rfid
-from lcd import init_lcd, set_lcd_text
-from web import run_flask
+from hal import GPIO
+from logit import log, set_context
+from gpio import init_gpio, cleanup, BUTTON_PIN
+from led import turn_on_all_leds, turn_on_stage_led, turn_off_button_led, blink_led, countdown_led
+from rfid import start_scanner, set_scanning
+from lcd import init_lcd, set_lcd_text, start_countdown
+from web import run_flask, stop_flask
+from settings import load_settings
+from camera import record_video, arm_capture, disarm_capture
+from processing import start_workers, resume_jobs, enqueue_video, get_queue_stats
+from samba import start_uploader, get_upload_stats
+from fleet import start_agent
+from storage import start_governor, plan_recording, note_recording, lcd_status
+from encoders import start_probe
+from thumbnails import start_backfill
+from metrics import counter, histogram
 
 # Global state
 current_stage = 'init'
-last_state_change = time.time()
-last_button_state = GPIO.HIGH  # Initialize to HIGH (not pressed)
-button_press_time = 0
+state_deadline = None
+state_entered_at = time.monotonic()
+scanned_at = None
 player_data = None
-button_timeout = None
-recording = False
+recorded_file = None
+_events = queue.Queue()
 
 # Constants
-BUTTON_HOLD_TIME = 0.5  # seconds
 STARTUP_TIMEOUT = 30  # seconds
+BUTTON_WAIT_TIMEOUT = 30  # seconds
+INIT_RETRY_DELAY = 5  # seconds
+DISK_FULL_HOLD = 5  # seconds the LCD explains a refused scan
+RECORDING_SLACK = 30  # seconds past video_duration before a recording counts as hung
+
+# Events
+EVENT_BUTTON = 'button'
+EVENT_RFID = 'rfid'
+EVENT_TIMEOUT = 'timeout'
+EVENT_RECORDED = 'recorded'
+EVENT_JOB_DONE = 'job_done'
+
+# Metrics
+STATE_SECONDS = histogram('photobooth_state_seconds', 'Time spent in each booth state')
+HANDLER_SECONDS = histogram('photobooth_state_handler_seconds',
+                            'Time spent in state entry actions and event handlers',
+                            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+SCAN_TO_RECORD_SECONDS = histogram('photobooth_scan_to_record_seconds',
+                                   'Time from band scan to the start of recording')
+EVENTS_TOTAL = counter('photobooth_events_total', 'Events handled by the state machine')
+
+def post_event(event, data=None):
+    """Queue an event for the state machine. Safe to call from any thread."""
+    _events.put((event, data))
+
+def button_callback(channel):
+    """Handle button press (runs on the GPIO thread)"""
+    post_event(EVENT_BUTTON)
+
+def rfid_callback(data):
+    """Handle a scanned band (runs on the RFID scanner thread)"""
+    post_event(EVENT_RFID, data)
+
+def job_callback(job):
+    """Handle a finished processing job (runs on a worker thread)"""
+    post_event(EVENT_JOB_DONE, job)
 
-def check_button_press():
-    """Check for button press and return True if button is pressed"""
-    return GPIO.input(BUTTON_PIN) == GPIO.LOW
+def fleet_health():
+    """Booth state reported to the fleet coordinator with every push"""
+    processing = get_queue_stats()
+    uploads = get_upload_stats()
+    return {
+        'state': current_stage,
+        'processing_queue': processing['queue_depth'],
+        'processing_active': len(processing['active']),
+        'upload_queue': uploads['queue_depth'],
+    }
 
-def handle_init_state():
-    """Handle the initialization state - runs only once at application start"""
+
+def start_recording(player_data, duration):
+    """Record on a background thread and post the result as an event"""
+    def run():
+        post_event(EVENT_RECORDED, record_video(player_data, duration))
+    thread = threading.Thread(target=run, name="recording")
+    thread.daemon = True
+    thread.start()
+
+# State entry actions
+# Each runs once when its state is entered and may return a state to move
+# straight on to.
+
+def enter_init_state():
+    """Initialize the hardware and background services"""
     log("Entering init state")
-    
+
     # Initialize GPIO
     log("Initializing GPIO...")
     gpio_initialized = init_gpio()
-    
+
     if not gpio_initialized:
         log("Failed to initialize GPIO, staying in init state")
         set_lcd_text("GPIO Init Failed", "Check Connections")
-        return 'init'
-    
+        return None
+
     log("GPIO initialized successfully")
-    
+
     # Initialize LCD
     log("Initializing LCD...")
     if not init_lcd():
         log("Failed to initialize LCD, staying in init state")
-        return 'init'
-    
+        return None
+
     log("LCD initialized successfully")
     set_lcd_text("Initializing...", "Please Wait")
-    
+
     # Set up button interrupt
     try:
         GPIO.add_event_detect(BUTTON_PIN, GPIO.FALLING, callback=button_callback, bouncetime=300)
@@ -68,175 +131,245 @@ def handle_init_state():
     except Exception as e:
         log(f"Warning: Failed to set up button detection: {e}")
         log("Continuing without button detection")
-    
+
     # Start Flask web server in a separate thread
-    flask_thread = threading.Thread(target=run_flask)
+    flask_thread = threading.Thread(target=run_flask, name="web")
     flask_thread.daemon = True
     flask_thread.start()
     log("Flask thread started")
-    
+
+    # Start background encoder probing, video processing, uploads and RFID scanning
+    start_probe()
+    start_workers(on_done=job_callback)
+    resume_jobs()
+    start_backfill()
+    start_uploader()
+    start_scanner(rfid_callback)
+    start_agent(health_fn=fleet_health)
+    start_governor()
+
     # Wait a few seconds to ensure everything is stable
     log("Waiting for hardware to stabilize...")
     time.sleep(3)
-    
+
     # Initialization complete, move to startup state
     log("Init complete, moving to startup state")
     set_lcd_text("Init Complete", "Starting Up")
     return 'startup'
 
-def handle_startup_state():
-    """Handle startup state"""
-    global current_stage, last_state_change
-
+def enter_startup_state():
+    """Show the startup screen until the button is pressed or it times out"""
     turn_on_all_leds()
-    
-    # Check for button press
-    if check_button_press():
-        log("Button pressed, moving to ready state")
-        current_stage = 'ready'
-        last_state_change = time.time()
-        return 'ready'
-    
-    # Update LCD with startup message
     set_lcd_text("Alleycat", "Photobooth")
-    
-    # If we've been in startup state for too long, move to ready anyway
-    if time.time() - last_state_change > STARTUP_TIMEOUT:
-        log("Startup timeout reached, moving to ready state")
-        current_stage = 'ready'
-        last_state_change = time.time()
-        return 'ready'
-    
-    return 'startup'
 
-def handle_rfid_wait_state():
-    """Handle the RFID wait state"""
-    log("Entering rfid_wait state")
-    set_lcd_text("Scan RFID Band", "")
+def enter_rfid_wait_state():
+    """Wait for a band to be scanned"""
+    global player_data, recorded_file
+    player_data = None
+    recorded_file = None
+    set_context(player=None)
+    # The second line warns when the disk is filling up
+    set_lcd_text("Scan RFID Band", lcd_status())
     turn_on_stage_led('green')
-    
-    data = scan_rfid()
-    if data:
+
+def enter_button_wait_state():
+    """Wait for the scanned player to press the button"""
+    # Long names scroll on the LCD
+    set_lcd_text("Press Button", player_data.get('name', 'Unknown'))
+    turn_on_stage_led('yellow')
+    blink_led('button')
+
+    # Open the camera now so the press only has to commit frames
+    arm_capture()
+
+def enter_recording_state():
+    """Start recording in the background"""
+    if scanned_at is not None:
+        SCAN_TO_RECORD_SECONDS.observe(time.monotonic() - scanned_at)
+    requested = int(load_settings().get('video_duration', 5))
+    duration = plan_recording(requested)
+    if not duration:
+        log("No disk space left for a recording, transitioning to rfid_wait")
+        disarm_capture()
+        return 'rfid_wait'
+    if duration < requested:
+        log(f"Disk space is short, recording {duration}s instead of {requested}s")
+    start_countdown("Recording...", duration)
+    turn_on_stage_led('red')
+    countdown_led('red', duration)
+    turn_off_button_led()
+    start_recording(player_data, duration)
+
+def enter_processing_state():
+    """Hand the recorded clip to the background workers"""
+    set_lcd_text("Processing...", "")
+    turn_on_stage_led('blue')
+
+    # Encoding and upload happen off the state machine thread
+    enqueue_video(recorded_file, player_data)
+
+    log("Clip queued, transitioning to rfid_wait")
+    return 'rfid_wait'
+
+# Event handlers
+# Each gets an event for the current state and returns the next state, or
+# None to stay put.
+
+def handle_init_state(event, data):
+    """Retry initialization after a failure"""
+    if event == EVENT_TIMEOUT:
+        return 'init'
+    return None
+
+def handle_startup_state(event, data):
+    """Leave startup on a button press or after STARTUP_TIMEOUT"""
+    if event == EVENT_BUTTON:
+        log("Button pressed, moving to rfid_wait state")
+        return 'rfid_wait'
+    if event == EVENT_TIMEOUT:
+        log("Startup timeout reached, moving to rfid_wait state")
+        return 'rfid_wait'
+    return None
+
+def handle_rfid_wait_state(event, data):
+    """Handle the RFID wait state"""
+    global player_data, scanned_at, state_deadline
+    if event == EVENT_TIMEOUT:
+        # Back to the scan prompt after a refused scan
+        return 'rfid_wait'
+    if event == EVENT_RFID:
+        player_data = data
+        scanned_at = time.monotonic()
+        set_context(player=data.get('neoId'))
         log(f"RFID band scanned: {data}")
-        return 'button_wait', data, time.time() + 30
-    
-    log("No RFID band detected, staying in rfid_wait")
-    return 'rfid_wait', None, None
+        if not plan_recording(int(load_settings().get('video_duration', 5))):
+            log("No disk space left for a recording, ignoring scan")
+            set_lcd_text("Disk Full", "Cannot Record")
+            # The scanner pauses itself on every read, keep reading bands
+            # in case eviction frees space, and restore the prompt shortly
+            set_scanning(True)
+            state_deadline = time.monotonic() + DISK_FULL_HOLD
+            return None
+        return 'button_wait'
+    return None
 
-def handle_button_wait_state(player_data, button_timeout):
+def handle_button_wait_state(event, data):
     """Handle the button wait state"""
-    log("Entering button_wait state")
-    name = player_data.get('name', 'Unknown')
-    if len(name) > 16:  # Truncate long names
-        name = name[:13] + "..."
-    set_lcd_text("Press Button", name)
-    turn_on_stage_led('yellow')
-    turn_on_button_led()
-    
-    if time.time() >= button_timeout:
-        log("Button wait timeout, transitioning to rfid_wait")
-        return 'rfid_wait', None, None
-    
-    if check_button_press():
+    if event == EVENT_BUTTON:
         log("Button pressed, starting recording")
-        return 'recording', player_data, None
-    
-    return 'button_wait', player_data, button_timeout
+        return 'recording'
+    if event == EVENT_TIMEOUT:
+        log("Button wait timeout, transitioning to rfid_wait")
+        disarm_capture()
+        return 'rfid_wait'
+    return None
 
-def handle_recording_state(player_data):
+def handle_recording_state(event, data):
     """Handle the recording state"""
-    log("Entering recording state")
-    set_lcd_text("Recording...", "")
-    turn_on_stage_led('red')
-    turn_off_button_led()
-    
-    if record_video():
+    global recorded_file
+    if event == EVENT_TIMEOUT:
+        log("Recording didn't finish in time, transitioning to rfid_wait")
+        return 'rfid_wait'
+    if event != EVENT_RECORDED:
+        return None
+
+    if data:
         log("Video recorded successfully, transitioning to processing")
-        return 'processing', player_data
-    
+        recorded_file = data
+        note_recording(data)
+        return 'processing'
+
     log("Video recording failed, transitioning to rfid_wait")
-    return 'rfid_wait', None
+    return 'rfid_wait'
 
-def handle_processing_state(player_data):
-    """Handle the processing state"""
-    log("Entering processing state")
-    set_lcd_text("Processing...", "")
-    turn_on_stage_led('blue')
-    
-    # TODO: Process and upload video
-    
-    log("Processing complete, transitioning to rfid_wait")
-    return 'rfid_wait', None
+def handle_processing_state(event, data):
+    """Processing is left immediately on entry"""
+    return None
+
+STATE_ENTRY = {
+    'init': enter_init_state,
+    'startup': enter_startup_state,
+    'rfid_wait': enter_rfid_wait_state,
+    'button_wait': enter_button_wait_state,
+    'recording': enter_recording_state,
+    'processing': enter_processing_state,
+}
+
+STATE_HANDLERS = {
+    'init': handle_init_state,
+    'startup': handle_startup_state,
+    'rfid_wait': handle_rfid_wait_state,
+    'button_wait': handle_button_wait_state,
+    'recording': handle_recording_state,
+    'processing': handle_processing_state,
+}
+
+STATE_TIMEOUTS = {
+    'init': INIT_RETRY_DELAY,
+    'startup': STARTUP_TIMEOUT,
+    'button_wait': BUTTON_WAIT_TIMEOUT,
+    'recording': lambda: int(load_settings().get('video_duration', 5)) + RECORDING_SLACK,
+}
+
+def transition(state):
+    """Enter state, following any immediate transitions from entry actions"""
+    global current_stage, state_deadline, state_entered_at
+    while state:
+        log(f"State {current_stage} -> {state}")
+        now = time.monotonic()
+        STATE_SECONDS.observe(now - state_entered_at, state=current_stage)
+        state_entered_at = now
+        current_stage = state
+        set_context(state=state)
+        timeout = STATE_TIMEOUTS.get(state)
+        if callable(timeout):
+            timeout = timeout()
+        state_deadline = time.monotonic() + timeout if timeout else None
+
+        # Only poll the reader while waiting for a band
+        set_scanning(state == 'rfid_wait')
+        with HANDLER_SECONDS.time(state=state, phase='entry'):
+            state = STATE_ENTRY[state]()
 
 def state_machine():
     """Main state machine loop"""
-    global current_stage, player_data, button_timeout
-    
-    # Track if initialization has been handled
-    init_handled = False
-    
     log("Starting state machine")
-    
+    transition('init')
+
     while True:
-        # Handle each state
-        if current_stage == 'init':
-            if not init_handled:
-                current_stage = handle_init_state()
-                init_handled = True
-            else:
-                # Stay in init state for testing
-                log("Staying in init state")
-                time.sleep(1)
-            
-        elif current_stage == 'startup':
-            current_stage = handle_startup_state()
-            
-        elif current_stage == 'rfid_wait':
-            current_stage, player_data, button_timeout = handle_rfid_wait_state()
-            
-        elif current_stage == 'button_wait':
-            current_stage, player_data, button_timeout = handle_button_wait_state(player_data, button_timeout)
-            
-        elif current_stage == 'recording':
-            current_stage, player_data = handle_recording_state(player_data)
-            
-        elif current_stage == 'processing':
-            current_stage, player_data = handle_processing_state(player_data)
-        
-        time.sleep(0.1)
+        # Sleep until the next event or the current state's deadline
+        timeout = None
+        if state_deadline is not None:
+            timeout = max(0, state_deadline - time.monotonic())
+        try:
+            event, data = _events.get(timeout=timeout)
+        except queue.Empty:
+            event, data = EVENT_TIMEOUT, None
 
-def button_callback(channel):
-    """Handle button press"""
-    global current_stage, button_timeout
-    
-    # Ignore button presses during startup
-    if current_stage == 'startup':
-        return
-        
-    if current_stage == 'button_wait' and button_timeout and time.time() < button_timeout:
-        current_stage = 'recording'
-        turn_off_button_led()  # Only turn off button LED when moving to recording state
-        turn_on_stage_led("red")
-        
-        # Record video
-        if record_video():
-            current_stage = 'processing'
-            
-            # TODO: Process and upload video
-            
-            # Reset to initial state
-            current_stage = 'rfid_wait'
-            player_data = None
-            button_timeout = None
+        if event == EVENT_JOB_DONE:
+            log(f"Processing job {data['filename']} finished: {data['status']}")
+            continue
+        if event == EVENT_RECORDED and current_stage != 'recording':
+            # A recording that finished after its state timed out
+            if data:
+                log(f"Late recording {data} finished, queuing it")
+                enqueue_video(data)
+            continue
+
+        EVENTS_TOTAL.inc(event=event)
+        with HANDLER_SECONDS.time(state=current_stage, phase='event'):
+            next_state = STATE_HANDLERS[current_stage](event, data)
+        if next_state:
+            transition(next_state)
 
 if __name__ == '__main__':
     try:
         # Start in initialization state
-        current_stage = 'init'
         state_machine()
-        
+
     except KeyboardInterrupt:
         print("\nExiting...")
     finally:
-        # Clean up GPIO if it was initialized
-        cleanup() 
\ No newline at end of file
+        # Close client connections, then clean up GPIO if it was initialized
+        stop_flask()
+        cleanup()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Frame broadcaster for the Alleycat Photobooth.
+Runs one ffmpeg capture per camera and fans the JPEG frames out to every
+preview client and to the recorder, so the device is only opened once.
+"""
+
+import time
+import threading
+from collections import deque
+from logit import log
+from settings import load_settings, subscribe
+from mjpeg import FrameSplitter, DEFAULT_READ_SIZE
+from metrics import gauge
+from hal import find_camera, camera_input
+
+# Constants
+RESTART_DELAY = 2  # seconds before reopening a camera that went away
+RAW_QUALITY = 2    # JPEG q for cameras whose raw frames are encoded here, 2 (best) to 31
+CAPTURE_SETTINGS = {'webcam_device', 'webcam_resolution', 'video_framerate', 'capture_read_size'}
+
+# Global state
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+class FrameQueue:
+    """
+    A small per-client frame queue.
+
+    Old frames are dropped when the client falls behind, so a slow reader
+    never holds up the capture or the other clients.
+    """
+
+    def __init__(self, maxsize=2):
+        self._frames = deque(maxlen=maxsize)
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __call__(self, frame):
+        with self._cond:
+            if frame is None:
+                self._closed = True
+            else:
+                self._frames.append(frame)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next frame, or None if the stream ended or timed out"""
+        with self._cond:
+            if not self._frames and not self._closed:
+                self._cond.wait(timeout)
+            if self._frames:
+                return self._frames.popleft()
+            return None
+
+
+class FrameBroadcaster:
+    """One capture process for a camera, shared by all subscribers"""
+
+    def __init__(self, device, resolution, framerate, read_size=DEFAULT_READ_SIZE):
+        self.device = device
+        self.resolution = resolution
+        self.framerate = framerate
+        self.read_size = read_size
+        self.frame_count = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._process = None
+        self._thread = None
+        self._running = False
+        self._reconfigured = False
+
+    def subscribe(self, callback):
+        """
+        Register a callable that receives every frame.
+        The callable gets None once if the camera drops out.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+            if self._running:
+                return callback
+            self._running = True
+            previous = self._thread
+            self._thread = threading.Thread(target=self._run, args=(previous,),
+                                            name=f"broadcast-{self.device}")
+            self._thread.daemon = True
+            thread = self._thread
+        thread.start()
+        return callback
+
+    def unsubscribe(self, callback):
+        """Remove a subscriber, stopping the capture when it was the last one"""
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+            if self._subscribers or not self._running:
+                return
+            self._running = False
+            process = self._process
+        self._stop_process(process)
+
+    def reconfigure(self, device, resolution, framerate, read_size):
+        """Switch to new capture settings, restarting the capture if it is running"""
+        with self._lock:
+            self.device = device
+            self.resolution = resolution
+            self.framerate = framerate
+            self.read_size = read_size
+            self._reconfigured = True
+            process = self._process
+        self._stop_process(process)
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _stop_process(self, process):
+        if not process:
+            return
+        try:
+            process.terminate()
+            process.wait(timeout=1)
+        except Exception:
+            process.kill()
+
+    def _start_process(self):
+        # A real webcam's own MJPEG is passed through untouched, raw frames
+        # are encoded near losslessly since 'copy' capture records them as is
+        stream, vcodec = camera_input(self.device, self.resolution, self.framerate)
+        quality = {'q:v': RAW_QUALITY} if vcodec != 'copy' else {}
+        return (
+            stream
+            .output('pipe:', format='mjpeg', vcodec=vcodec, **quality)
+            .run_async(pipe_stdout=True, quiet=True)
+        )
+
+    def _publish(self, frame):
+        self.frame_count += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(frame)
+            except Exception as e:
+                log(f"Error delivering frame to subscriber: {e}")
+
+    def _read_frames(self, process):
+        splitter = FrameSplitter(read_size=self.read_size)
+        for frame in splitter.read_frames(process.stdout):
+            # One copy per frame, shared by every subscriber
+            self._publish(bytes(frame))
+
+    def _is_current(self):
+        """True while this thread is the one that should be capturing"""
+        return self._running and self._thread is threading.current_thread()
+
+    def _run(self, previous):
+        # Make sure a capture that is still shutting down has released the device
+        if previous:
+            previous.join()
+
+        log(f"Starting capture on {self.device} ({self.resolution}@{self.framerate})")
+        while True:
+            process = None
+            try:
+                process = self._start_process()
+                with self._lock:
+                    if not self._is_current():
+                        break
+                    self._process = process
+                self._read_frames(process)
+            except Exception as e:
+                log(f"Error in capture on {self.device}: {e}")
+            finally:
+                with self._lock:
+                    self._process = None
+                self._stop_process(process)
+
+            with self._lock:
+                if not self._is_current():
+                    break
+                reconfigured, self._reconfigured = self._reconfigured, False
+            if reconfigured:
+                log(f"Restarting capture with {self.device} ({self.resolution}@{self.framerate})")
+                continue
+
+            # The camera dropped out while clients were still watching
+            self._publish(None)
+            log(f"Capture on {self.device} ended, restarting in {RESTART_DELAY}s")
+            time.sleep(RESTART_DELAY)
+        log(f"Capture on {self.device} stopped")
+
+
+def _capture_config(settings):
+    """Return (device, resolution, framerate, read_size) from settings"""
+    return (
+        settings.get('webcam_device') or find_camera(),
+        settings.get('webcam_resolution', '1280x720'),
+        int(settings.get('video_framerate', 30)),
+        int(settings.get('capture_read_size', DEFAULT_READ_SIZE)),
+    )
+
+
+def get_broadcaster(settings=None):
+    """Return the shared broadcaster for the booth's camera"""
+    global _broadcaster
+
+    if settings is None:
+        settings = load_settings()
+    config = _capture_config(settings)
+    if not config[0]:
+        return None
+
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            _broadcaster = FrameBroadcaster(*config)
+        return _broadcaster
+
+
+def _on_settings_changed(changed, settings):
+    """Restart the capture in place when the camera settings change"""
+    if not set(changed) & CAPTURE_SETTINGS:
+        return
+    config = _capture_config(settings)
+    with _broadcaster_lock:
+        broadcaster = _broadcaster
+    # Current subscribers stay attached across the restart
+    if broadcaster and config[0]:
+        broadcaster.reconfigure(*config)
+
+
+subscribe(_on_settings_changed)
+
+gauge('photobooth_camera_subscribers', 'Preview clients and recorders attached to the camera',
+      fn=lambda: _broadcaster.subscriber_count if _broadcaster else 0)
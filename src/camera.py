@@ -6,23 +6,343 @@ Handles video recording and processing.
 
 import os
 import time
+import queue
+import subprocess
+import threading
+from collections import deque
 from datetime import datetime
 import ffmpeg
 from logit import log
-from settings import load_settings
+from settings import load_settings, subscribe, DATA_DIR
+from broadcast import get_broadcaster
+from hal import find_camera, native_mjpeg
+from metrics import counter, histogram, timed
+from encoders import get_encoder, encoder_args
+from catalog import add_video
+from journal import record_stage, durable_rename, fsync_file, STAGE_RECORDED
 
 # Global state
 recording = False
-stream_process = None
+_session = None
+_session_lock = threading.Lock()
 
 # Constants
-VIDEO_DIR_IN = '/data/videos/in'
-VIDEO_DIR_PROC = '/data/videos/processing'
-VIDEO_DIR_OUT = '/data/videos/out'
+VIDEO_DIR_IN = os.path.join(DATA_DIR, 'videos', 'in')
+VIDEO_DIR_PROC = os.path.join(DATA_DIR, 'videos', 'processing')
+VIDEO_DIR_OUT = os.path.join(DATA_DIR, 'videos', 'out')
+ARMED_DIR = os.path.join(VIDEO_DIR_IN, '.armed')  # captures in progress, cleared on startup
+DEFAULT_PREROLL = 1.0  # seconds of video kept from before the button press
+DEFAULT_CAPTURE_MODE = 'copy'  # 'copy' records the camera's MJPEG as is, 'encode' encodes live
+RAW_EXTENSION = '.mkv'  # stream-copied clips, transcoded by processing
+WRITE_BACKLOG = 2.0  # seconds of frames queued for a writer that falls behind
+FINISH_TIMEOUT = 10  # seconds for the writer and ffmpeg to finish a clip
+# Metrics
+RECORD_SECONDS = histogram('photobooth_record_seconds', 'Time to record a clip, from press to file')
+ENCODE_SECONDS = histogram('photobooth_encode_seconds', 'Time to process a recorded clip')
+RECORDINGS_TOTAL = counter('photobooth_recordings_total', 'Recordings by result')
+FRAMES_DROPPED_TOTAL = counter('photobooth_capture_dropped_frames_total',
+                               'Camera frames left out of clips because the writer fell behind')
 
-def record_video(player_data=None):
-    """Record a video with the webcam"""
-    global recording, stream_process
+CAMERA_SETTINGS = {'webcam_device', 'webcam_resolution', 'webcam_rotation',
+                   'video_framerate', 'video_preroll', 'video_encoder', 'capture_mode'}
+
+
+def _stop_process(process):
+    """Terminate an ffmpeg process, killing it if it doesn't exit"""
+    if not process:
+        return
+    try:
+        process.terminate()
+        process.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    except Exception as e:
+        log(f"Error stopping ffmpeg process: {e}")
+
+
+def _capture_mode(settings):
+    """
+    The capture_mode setting, or the default for the camera: 'copy' when it
+    delivers MJPEG itself, 'encode' when its frames are encoded to MJPEG
+    first, as copying those would encode every clip twice
+    """
+    mode = settings.get('capture_mode')
+    if mode:
+        return mode
+    device = settings.get('webcam_device') or find_camera()
+    if device and not native_mjpeg(device, settings.get('webcam_resolution', '1280x720')):
+        return 'encode'
+    return DEFAULT_CAPTURE_MODE
+
+
+class CaptureSession:
+    """
+    A capture pipeline opened ahead of the button press.
+
+    Frames from the shared camera broadcaster are kept in a pre-roll ring
+    buffer and an ffmpeg writer is started waiting on stdin, so committing a
+    recording only has to start feeding frames to an already running process.
+
+    In 'copy' mode the camera's MJPEG frames are muxed into a Matroska file
+    without decoding them, and rotation and the H.264 encode are left to
+    processing. In 'encode' mode the clip is rotated and encoded live.
+
+    Frames are written to ffmpeg from the session's own thread, through a
+    bounded queue, so an encoder that falls behind drops frames from the
+    clip rather than stalling the camera and every preview client.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.copy = _capture_mode(settings) == 'copy'
+        self.rotation = settings.get('webcam_rotation', 0)
+        self.framerate = int(settings.get('video_framerate', 30))
+        preroll = float(settings.get('video_preroll', DEFAULT_PREROLL))
+        self.preroll = deque(maxlen=max(1, int(preroll * self.framerate)))
+        # Room for the whole pre-roll plus a backlog of live frames
+        self.frames = queue.Queue(maxsize=self.preroll.maxlen + int(WRITE_BACKLOG * self.framerate))
+        self.extension = RAW_EXTENSION if self.copy else '.mp4'
+        self.temp_path = os.path.join(ARMED_DIR, f"{os.getpid()}-{int(time.time())}{self.extension}")
+        self.broadcaster = None
+        self.encoder_process = None
+        self.writer = None
+        self.lost = False
+        self.frames_needed = 0
+        self.frames_taken = 0      # frames that belong in the clip, queued or dropped
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Tap the camera broadcaster and start the writer"""
+        os.makedirs(ARMED_DIR, exist_ok=True)
+
+        self.broadcaster = get_broadcaster(self.settings)
+        if self.broadcaster is None:
+            raise RuntimeError("no camera device found")
+
+        stream = ffmpeg.input('pipe:', f='mjpeg', framerate=self.framerate)
+        if self.copy:
+            output = stream.output(self.temp_path, vcodec='copy', f='matroska')
+        else:
+            if self.rotation:
+                stream = stream.filter('transpose', self.rotation)
+            output = stream.output(self.temp_path,
+                                   movflags='+faststart',
+                                   **encoder_args(get_encoder(self.settings)))
+        self.encoder_process = output.overwrite_output().run_async(pipe_stdin=True, quiet=True)
+        self.writer = threading.Thread(target=self._write, name="capture-writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+        self.broadcaster.subscribe(self._on_frame)
+
+    def _write(self):
+        """Feed queued frames to ffmpeg until the end of the clip"""
+        failed = False
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if failed:
+                # Keep draining so commit can always hand over the end marker
+                continue
+            try:
+                self.encoder_process.stdin.write(frame)
+                self.frames_written += 1
+            except (BrokenPipeError, ValueError, OSError) as e:
+                log(f"Error writing capture frame: {e}")
+                failed = True
+        try:
+            self.encoder_process.stdin.close()
+        except Exception:
+            pass
+
+    def _on_frame(self, frame):
+        if frame is None:
+            # Unblock a waiting commit if the camera went away
+            self.lost = True
+            self.done.set()
+            with self.lock:
+                idle = not self.frames_needed
+            if idle:
+                # Frames after the camera restarts would follow a gap in the
+                # file, so an armed session is retired rather than kept
+                thread = threading.Thread(target=_retire_session, args=(self,),
+                                          name="capture-retire")
+                thread.daemon = True
+                thread.start()
+            return
+        with self.lock:
+            if self.lost:
+                return
+            if not self.frames_needed:
+                self.preroll.append(frame)
+                return
+            if self.frames_taken >= self.frames_needed:
+                return
+            self.frames_taken += 1
+            try:
+                self.frames.put_nowait(frame)
+            except queue.Full:
+                self.frames_dropped += 1
+            if self.frames_taken >= self.frames_needed:
+                self.done.set()
+
+    def commit(self, duration):
+        """Record duration seconds (after the pre-roll) and return the temp file"""
+        with self.lock:
+            self.frames_needed = len(self.preroll) + int(duration * self.framerate)
+            for frame in self.preroll:
+                self.frames.put_nowait(frame)
+            self.frames_taken = len(self.preroll)
+            self.preroll.clear()
+
+        # Allow a few seconds of slack for dropped camera frames
+        self.done.wait(timeout=duration + 3)
+        with self.lock:
+            if self.frames_taken < self.frames_needed:
+                log(f"Capture ended early: {self.frames_taken}/{self.frames_needed} frames")
+            self.frames_needed = self.frames_taken
+        self.broadcaster.unsubscribe(self._on_frame)
+
+        # Let the writer finish the queue, it closes ffmpeg's stdin
+        deadline = time.monotonic() + FINISH_TIMEOUT
+        try:
+            self.frames.put(None, timeout=FINISH_TIMEOUT)
+        except queue.Full:
+            pass
+        self.writer.join(max(0, deadline - time.monotonic()))
+        if self.frames_dropped:
+            log(f"Capture writer fell behind, dropped {self.frames_dropped}/{self.frames_taken} frames")
+            FRAMES_DROPPED_TOTAL.inc(self.frames_dropped)
+
+        try:
+            self.encoder_process.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            # Killing ffmpeg also unblocks a writer stuck on its stdin
+            _stop_process(self.encoder_process)
+            raise RuntimeError(f"encoder didn't finish within {FINISH_TIMEOUT}s")
+        if self.encoder_process.returncode != 0 or not self.frames_written:
+            raise RuntimeError(f"encoder exited with {self.encoder_process.returncode}")
+        return self.temp_path
+
+    def close(self):
+        """Tear the pipeline down without recording"""
+        if self.broadcaster:
+            self.broadcaster.unsubscribe(self._on_frame)
+        if self.writer and self.writer.is_alive():
+            try:
+                self.frames.put_nowait(None)
+            except queue.Full:
+                pass
+        if self.encoder_process:
+            try:
+                self.encoder_process.stdin.close()
+            except Exception:
+                pass
+            _stop_process(self.encoder_process)
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def arm_capture():
+    """Open the camera ahead of a recording so the button press starts instantly"""
+    global _session
+
+    # Settings first: loading them may notify _on_settings_changed, which
+    # takes the session lock itself
+    settings = load_settings()
+    with _session_lock:
+        if _session is not None and not _session.lost:
+            return True
+        # A session the camera dropped out of can't record any more
+        stale, _session = _session, None
+    if stale:
+        stale.close()
+
+    with _session_lock:
+        if _session is not None:
+            return True
+        try:
+            session = CaptureSession(settings)
+            session.start()
+            _session = session
+            log("Capture session armed")
+            return True
+        except Exception as e:
+            log(f"Error arming capture session: {e}")
+            return False
+
+
+def _retire_session(session):
+    """Disarm a session the camera dropped out of, unless it was replaced already"""
+    global _session
+
+    with _session_lock:
+        if _session is not session:
+            return
+        _session = None
+    session.close()
+    log("Capture session disarmed, the camera dropped out")
+
+
+def disarm_capture():
+    """Release the camera if a capture session is armed"""
+    global _session
+
+    with _session_lock:
+        session, _session = _session, None
+    if session:
+        session.close()
+        log("Capture session disarmed")
+
+
+def is_capturing():
+    """True while a capture session is armed or recording"""
+    with _session_lock:
+        return recording or _session is not None
+
+
+def _on_settings_changed(changed, settings):
+    """Re-arm an idle session so it picks up new camera settings"""
+    if recording or not set(changed) & CAMERA_SETTINGS:
+        return
+    with _session_lock:
+        armed = _session is not None
+    if armed:
+        disarm_capture()
+        arm_capture()
+
+
+subscribe(_on_settings_changed)
+
+
+def clear_abandoned_captures(keep=()):
+    """
+    Delete captures a previous run left unfinished, except the paths in
+    keep. Call before arming.
+    """
+    try:
+        entries = list(os.scandir(ARMED_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.path in keep:
+            continue
+        try:
+            os.remove(entry.path)
+            log(f"Removed abandoned capture {entry.name}")
+        except OSError as e:
+            log(f"Error removing abandoned capture {entry.name}: {e}")
+
+
+@timed(RECORD_SECONDS)
+def record_video(player_data=None, duration=None):
+    """Record a video with the webcam, for duration seconds or the video_duration setting"""
+    global recording, _session
     
     if recording:
         log("Already recording")
@@ -32,87 +352,88 @@ def record_video(player_data=None):
         recording = True
         log("Starting video recording")
         
-        # Load settings
-        settings = load_settings(force_reload=True)
-        device = settings.get('webcam_device', '/dev/video0')
-        resolution = settings.get('webcam_resolution', '1280x720')
-        rotation = settings.get('webcam_rotation', 0)
-        duration = settings.get('video_duration', 5)  # Default 5 seconds
+        if duration is None:
+            duration = load_settings().get('video_duration', 5)  # Default 5 seconds
+        
+        # Arm on demand if the booth didn't do it ahead of time
+        if not arm_capture():
+            return False
+        with _session_lock:
+            session, _session = _session, None
+        if session.lost:
+            # The camera dropped out between arming and the press
+            session.close()
+            raise RuntimeError("camera dropped out before the recording started")
         
-        # Generate filename
+        # Generate filename, stream-copied clips keep their raw extension
+        # until processing transcodes them. The time keeps a player's repeat
+        # recordings apart.
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
         if player_data:
-            filename = f"{player_data['role']}-{player_data['name']}-{player_data['neoId']}.mp4"
+            filename = f"{player_data['role']}-{player_data['name']}-{player_data['neoId']}-{stamp}{session.extension}"
         else:
-            filename = f"video-{datetime.now().strftime('%Y%m%d-%H%M%S')}.mp4"
+            filename = f"video-{stamp}{session.extension}"
         
         output_path = os.path.join(VIDEO_DIR_IN, filename)
         
-        # Create output directory if it doesn't exist
-        os.makedirs(VIDEO_DIR_IN, exist_ok=True)
+        try:
+            temp_path = session.commit(duration)
+            # Journal the clip before moving it, so a restart can finish the move
+            record_stage(filename, STAGE_RECORDED, temp_path=temp_path, player_data=player_data)
+            durable_rename(temp_path, output_path)
+        finally:
+            session.close()
         
-        # Build FFmpeg command
-        stream = ffmpeg.input(device, s=resolution, framerate=30)
-        if rotation:
-            stream = stream.filter('transpose', rotation)
+        add_video(filename, output_path, player_data,
+                  codec='mjpeg' if session.copy else 'h264',
+                  duration=round(session.frames_written / session.framerate, 2))
         
-        stream = stream.output(
-            output_path,
-            vcodec='h264_v4l2m2m',
-            pix_fmt='yuv420p',
-            t=duration + 3,  # Add 3 second buffer
-            movflags='+faststart'
-        )
-        
-        # Run the command
-        stream.run(capture_stdout=True, capture_stderr=True)
         log(f"Video recorded successfully: {filename}")
+        RECORDINGS_TOTAL.inc(result='ok')
         return filename
         
-    except ffmpeg.Error as e:
-        log(f"Error recording video: {e.stderr.decode()}")
-        return False
     except Exception as e:
         log(f"Error recording video: {e}")
+        RECORDINGS_TOTAL.inc(result='failed')
         return False
     finally:
         recording = False
-        if stream_process:
-            try:
-                stream_process.terminate()
-                stream_process.wait(timeout=1)
-            except:
-                pass
-            stream_process = None
 
 
-def process_video(input_file: str, output_file: str, rotation: int = 0) -> bool:
+@timed(ENCODE_SECONDS)
+def process_video(input_file: str, output_file: str, rotation: int = 0, bitrate: int = None) -> bool:
     """
     Process a video file with optional rotation and other effects.
+    Stream-copied clips are rotated and encoded to H.264 here; clips that
+    were encoded during capture are already rotated and are only moved.
+    A bitrate (bits/s) caps the encode, e.g. while disk space is short.
+    The output is on disk before the input is removed, so while the input
+    exists the output may be incomplete, and once it is gone it is not.
     Returns True if processing was successful, False otherwise.
     """
     try:
-        if rotation == 0:
+        if not input_file.endswith(RAW_EXTENSION):
             # No processing needed, just move the file
-            os.rename(input_file, output_file)
+            durable_rename(input_file, output_file)
             return True
             
-        log(f"Processing video: rotation={rotation}")
+        log(f"Processing video: rotation={rotation}" + (f", bitrate={bitrate}" if bitrate else ""))
         
         # Read the input file
         stream = ffmpeg.input(input_file)
         
         # Apply rotation
-        stream = stream.filter('transpose', rotation)
+        if rotation:
+            stream = stream.filter('transpose', rotation)
         
-        # Encode with hardware acceleration
+        # Encode with the fastest encoder the probe found
         process = (
             stream
             .output(output_file,
-                   vcodec='h264_v4l2m2m',
-                   b='2M',
                    g=30,
-                   pix_fmt='yuv420p',
-                   f='mp4')
+                   f='mp4',
+                   movflags='+faststart',
+                   **encoder_args(get_encoder(), bitrate))
             .overwrite_output()
         )
         
@@ -122,9 +443,12 @@ def process_video(input_file: str, output_file: str, rotation: int = 0) -> bool:
             log(f"FFmpeg processing stderr output: {err.decode()}")
         
         # Remove the input file after successful processing
+        fsync_file(output_file)
         os.remove(input_file)
         return True
         
     except Exception as e:
         log(f"Error processing video: {str(e)}")
-        return False
\ No newline at end of file
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return False
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Video catalog for the Alleycat Photobooth.
+
+Every clip gets a row in an indexed SQLite table when it is recorded, and the
+row is updated as the clip moves through processing and upload, so finding a
+player's clips never means listing the video folders on the USB drive.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from logit import log
+from settings import DATA_DIR
+from fleet import record_event
+
+# Constants
+CATALOG_DB_FILE = os.path.join(DATA_DIR, 'videos.db')
+MAX_PAGE_SIZE = 200
+
+# Clip states, in pipeline order
+STATE_RECORDED = 'recorded'
+STATE_PROCESSING = 'processing'
+STATE_PROCESSED = 'processed'
+STATE_FAILED = 'failed'
+STATE_EVICTED = 'evicted'      # uploaded, then deleted locally to free space
+
+# Upload statuses
+UPLOAD_PENDING = 'pending'
+UPLOAD_QUEUED = 'queued'
+UPLOAD_RETRYING = 'retrying'
+UPLOAD_DONE = 'uploaded'
+
+COLUMNS = ('clip', 'filename', 'path', 'neo_id', 'name', 'role', 'faction', 'allegiance',
+           'state', 'upload_status', 'upload_attempts', 'codec', 'duration', 'size',
+           'recorded_at', 'updated_at', 'accessed_at')
+
+# Query parameter -> column for list_videos filters
+FILTERS = {
+    'neoId': 'neo_id',
+    'name': 'name',
+    'role': 'role',
+    'faction': 'faction',
+    'state': 'state',
+    'upload': 'upload_status',
+}
+
+# Global state
+_db_lock = threading.Lock()
+_db = None
+
+
+def _connect():
+    """Open the catalog database, creating the table and indexes if needed"""
+    os.makedirs(os.path.dirname(CATALOG_DB_FILE), exist_ok=True)
+    conn = sqlite3.connect(CATALOG_DB_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS videos (
+            id INTEGER PRIMARY KEY,
+            clip TEXT NOT NULL UNIQUE,
+            filename TEXT NOT NULL,
+            path TEXT,
+            neo_id TEXT,
+            name TEXT,
+            role TEXT,
+            faction TEXT,
+            allegiance TEXT,
+            state TEXT NOT NULL,
+            upload_status TEXT NOT NULL,
+            upload_attempts INTEGER NOT NULL DEFAULT 0,
+            codec TEXT,
+            duration REAL,
+            size INTEGER,
+            recorded_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            accessed_at REAL
+        )
+    """)
+    # Catalogs created before clips were evicted lack the access time
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(videos)")}
+    if 'accessed_at' not in columns:
+        conn.execute("ALTER TABLE videos ADD COLUMN accessed_at REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS videos_neo_id ON videos (neo_id, recorded_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS videos_state ON videos (state, recorded_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS videos_faction ON videos (faction, recorded_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS videos_recorded_at ON videos (recorded_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS videos_upload ON videos (upload_status, state)")
+    conn.commit()
+    return conn
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        _db = _connect()
+    return _db
+
+
+def clip_id(filename):
+    """Return the catalog key of a clip: its file name without extension"""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _publish(clip_file):
+    """Pass a clip's current catalog entry on to the fleet coordinator"""
+    video = get_video(clip_id(clip_file))
+    if video:
+        record_event('clip', video)
+
+
+def add_video(filename, path, player_data=None, codec=None, duration=None):
+    """Record a newly captured clip. Returns True on success."""
+    player = player_data or {}
+    now = time.time()
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO videos (clip, filename, path, neo_id, name, role, "
+                    "faction, allegiance, state, upload_status, codec, duration, size, "
+                    "recorded_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (clip_id(filename), filename, path, player.get('neoId'), player.get('name'),
+                     player.get('role'), player.get('faction'), player.get('allegiance'),
+                     STATE_RECORDED, UPLOAD_PENDING, codec, duration, _size(path), now, now))
+        _publish(filename)
+        return True
+    except Exception as e:
+        log(f"Error adding {filename} to the video catalog: {e}")
+        return False
+
+
+def update_video(clip_file, **fields):
+    """
+    Update catalog fields of a clip.
+
+    Args:
+        clip_file: Any file name or path of the clip
+        fields: Columns to set; a 'path' also refreshes the size
+    """
+    fields = {k: v for k, v in fields.items() if k in COLUMNS and k != 'clip'}
+    if 'path' in fields:
+        fields.setdefault('size', _size(fields['path']))
+    fields['updated_at'] = time.time()
+    assignments = ', '.join(f"{column} = ?" for column in fields)
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.execute(f"UPDATE videos SET {assignments} WHERE clip = ?",
+                           (*fields.values(), clip_id(clip_file)))
+        _publish(clip_file)
+        return True
+    except Exception as e:
+        log(f"Error updating {clip_file} in the video catalog: {e}")
+        return False
+
+
+def record_upload(path, ok):
+    """Record the result of an upload attempt"""
+    status = UPLOAD_DONE if ok else UPLOAD_RETRYING
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.execute(
+                    "UPDATE videos SET upload_status = ?, upload_attempts = upload_attempts + 1, "
+                    "updated_at = ? WHERE clip = ?", (status, time.time(), clip_id(path)))
+        _publish(path)
+    except Exception as e:
+        log(f"Error recording upload of {path} in the video catalog: {e}")
+
+
+def get_video(clip):
+    """Return a clip's catalog entry, or None"""
+    with _db_lock:
+        row = _get_db().execute("SELECT * FROM videos WHERE clip = ?", (clip,)).fetchone()
+    return dict(row) if row else None
+
+
+def list_videos(filters=None, limit=50, offset=0):
+    """
+    Return one page of clips, newest first.
+
+    Args:
+        filters: Dict of FILTERS keys to exact values
+        limit: Page size, capped at MAX_PAGE_SIZE
+        offset: Number of clips to skip
+
+    Returns:
+        (videos, total) where total counts every matching clip
+    """
+    where, params = [], []
+    for key, value in (filters or {}).items():
+        if key in FILTERS and value is not None:
+            where.append(f"{FILTERS[key]} = ?")
+            params.append(value)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    offset = max(0, int(offset))
+
+    with _db_lock:
+        db = _get_db()
+        total = db.execute(f"SELECT COUNT(*) FROM videos {clause}", params).fetchone()[0]
+        rows = db.execute(
+            f"SELECT * FROM videos {clause} ORDER BY recorded_at DESC LIMIT ? OFFSET ?",
+            (*params, limit, offset)).fetchall()
+    return [dict(row) for row in rows], total
+
+
+def touch_video(clip):
+    """Note that a clip was just served, for least-recently-used eviction"""
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.execute("UPDATE videos SET accessed_at = ? WHERE clip = ?", (time.time(), clip))
+    except Exception as e:
+        log(f"Error recording access to {clip} in the video catalog: {e}")
+
+
+def storage_usage():
+    """
+    Return the bytes held by catalogued clips, per state, and the bytes
+    that could be evicted, from the sizes recorded as clips move through
+    the pipeline.
+    """
+    with _db_lock:
+        db = _get_db()
+        rows = db.execute("SELECT state, COUNT(*), COALESCE(SUM(size), 0) FROM videos "
+                          "GROUP BY state").fetchall()
+        evictable = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM videos "
+                               "WHERE state = ? AND upload_status = ?",
+                               (STATE_PROCESSED, UPLOAD_DONE)).fetchone()
+    return {
+        'states': {state: {'clips': count, 'bytes': size} for state, count, size in rows},
+        'evictable': {'clips': evictable[0], 'bytes': evictable[1]},
+    }
+
+
+def eviction_candidates(min_age, limit=50):
+    """
+    Return uploaded clips that may be deleted locally, least recently
+    used first. A clip that was never served counts from its last update.
+
+    Args:
+        min_age: Seconds a clip must have been left alone
+        limit: Number of clips to return at most
+    """
+    cutoff = time.time() - min_age
+    with _db_lock:
+        rows = _get_db().execute(
+            "SELECT * FROM videos WHERE state = ? AND upload_status = ? "
+            "AND COALESCE(accessed_at, updated_at) < ? "
+            "ORDER BY COALESCE(accessed_at, updated_at) LIMIT ?",
+            (STATE_PROCESSED, UPLOAD_DONE, cutoff, limit)).fetchall()
+    return [dict(row) for row in rows]
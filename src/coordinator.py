@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Fleet coordinator for the Alleycat Photobooth.
+
+Collects the batches booth agents push (see fleet.py) into one SQLite
+database and serves a combined, searchable view of every booth's scans
+and clips, cross-booth throughput, and the fleet-wide settings the
+agents pick up. It is mounted at /fleet on every booth's web server, so
+any booth can act as coordinator, or it can run on its own:
+
+    python src/coordinator.py [port]
+
+Fleet settings are only handed out and changed with the coordinator's
+fleet_token in the X-Fleet-Token header, and samba credentials among them
+only go to booths if fleet_share_credentials is set.
+"""
+
+import os
+import sys
+import json
+import hmac
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from flask import Blueprint, Flask, render_template, request, jsonify
+from logit import log
+from settings import load_settings, DATA_DIR
+from fleet import TOKEN_HEADER, CREDENTIAL_SETTINGS
+
+# Constants
+FLEET_DB_FILE = os.path.join(DATA_DIR, 'fleet.db')
+OFFLINE_AFTER = 30        # seconds without a push before a booth counts as offline
+MAX_PAGE_SIZE = 200
+DEFAULT_PORT = 5100
+
+CLIP_FIELDS = ('clip', 'neo_id', 'name', 'role', 'faction', 'allegiance', 'state',
+               'upload_status', 'codec', 'duration', 'size', 'recorded_at', 'updated_at')
+
+# Query parameter -> column, for both scans and clips
+FILTERS = {
+    'booth': 'booth',
+    'neoId': 'neo_id',
+    'name': 'name',
+    'role': 'role',
+    'faction': 'faction',
+}
+
+fleet = Blueprint('fleet', __name__, url_prefix='/fleet', template_folder='templates')
+
+# Global state
+_db_lock = threading.Lock()
+_db = None
+
+
+def _connect():
+    """Open the fleet database, creating the tables and indexes if needed"""
+    os.makedirs(os.path.dirname(FLEET_DB_FILE), exist_ok=True)
+    conn = sqlite3.connect(FLEET_DB_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS booths (
+            booth TEXT PRIMARY KEY,
+            address TEXT,
+            epoch TEXT,
+            last_event_id INTEGER NOT NULL DEFAULT 0,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            health TEXT,
+            settings_version INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS scans (
+            id INTEGER PRIMARY KEY,
+            booth TEXT NOT NULL,
+            ts REAL NOT NULL,
+            neo_id TEXT,
+            name TEXT,
+            role TEXT,
+            faction TEXT,
+            allegiance TEXT
+        );
+        CREATE INDEX IF NOT EXISTS scans_neo_id ON scans (neo_id, ts);
+        CREATE INDEX IF NOT EXISTS scans_booth ON scans (booth, ts);
+        CREATE INDEX IF NOT EXISTS scans_ts ON scans (ts);
+        CREATE TABLE IF NOT EXISTS clips (
+            booth TEXT NOT NULL,
+            clip TEXT NOT NULL,
+            neo_id TEXT,
+            name TEXT,
+            role TEXT,
+            faction TEXT,
+            allegiance TEXT,
+            state TEXT,
+            upload_status TEXT,
+            codec TEXT,
+            duration REAL,
+            size INTEGER,
+            recorded_at REAL,
+            updated_at REAL,
+            PRIMARY KEY (booth, clip)
+        );
+        CREATE INDEX IF NOT EXISTS clips_neo_id ON clips (neo_id, recorded_at);
+        CREATE INDEX IF NOT EXISTS clips_recorded_at ON clips (recorded_at);
+        CREATE TABLE IF NOT EXISTS fleet_settings (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            settings TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+    """)
+    conn.commit()
+    return conn
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        _db = _connect()
+    return _db
+
+
+def _current_settings(db):
+    row = db.execute("SELECT version, settings FROM fleet_settings "
+                     "ORDER BY version DESC LIMIT 1").fetchone()
+    return (row['version'], json.loads(row['settings'])) if row else (None, None)
+
+
+def _authorized():
+    """True if the request carries the coordinator's fleet_token"""
+    token = load_settings().get('fleet_token')
+    return bool(token) and hmac.compare_digest(request.headers.get(TOKEN_HEADER, ''), token)
+
+
+def _distributed(settings):
+    """The fleet settings as booths get them"""
+    if load_settings().get('fleet_share_credentials'):
+        return settings
+    return {k: v for k, v in settings.items() if k not in CREDENTIAL_SETTINGS}
+
+
+def _store_events(db, booth, events):
+    """Store a batch of events, skipping ones already received"""
+    scans = []
+    for event in events:
+        data = event['data']
+        if event['kind'] == 'scan':
+            scans.append((booth, data.get('ts', event['ts']), data.get('neoId'), data.get('name'),
+                          data.get('role'), data.get('faction'), data.get('allegiance')))
+        elif event['kind'] == 'clip':
+            values = [booth] + [data.get(field) for field in CLIP_FIELDS]
+            # Keep the newest state of a clip, batches can arrive late
+            db.execute(
+                f"INSERT INTO clips (booth, {', '.join(CLIP_FIELDS)}) "
+                f"VALUES ({', '.join('?' * (len(CLIP_FIELDS) + 1))}) "
+                f"ON CONFLICT (booth, clip) DO UPDATE SET "
+                f"{', '.join(f'{f} = excluded.{f}' for f in CLIP_FIELDS[1:])} "
+                f"WHERE excluded.updated_at >= clips.updated_at", values)
+    if scans:
+        db.executemany("INSERT INTO scans (booth, ts, neo_id, name, role, faction, allegiance) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)", scans)
+
+
+@fleet.route('/api/push', methods=['POST'])
+def push():
+    """Receive a batch of events and health from a booth agent"""
+    # Without a token set the coordinator only collects, it hands out no settings
+    authorized = _authorized()
+    if load_settings().get('fleet_token') and not authorized:
+        return jsonify({'error': 'Missing or wrong fleet token'}), 403
+    data = request.get_json(force=True)
+    booth = data['booth']
+    epoch = data.get('epoch')
+    events = data.get('events', [])
+    now = time.time()
+
+    with _db_lock:
+        db = _get_db()
+        with db:
+            row = db.execute("SELECT epoch, last_event_id FROM booths WHERE booth = ?",
+                             (booth,)).fetchone()
+            # A retried batch repeats ids that were already stored
+            last_id = row['last_event_id'] if row and row['epoch'] == epoch else 0
+            new = [event for event in events if event['id'] > last_id]
+            _store_events(db, booth, new)
+            if events:
+                last_id = max(last_id, max(event['id'] for event in events))
+
+            db.execute(
+                "INSERT INTO booths (booth, address, epoch, last_event_id, first_seen, last_seen, "
+                "health, settings_version) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (booth) DO UPDATE SET address = excluded.address, "
+                "epoch = excluded.epoch, last_event_id = excluded.last_event_id, "
+                "last_seen = excluded.last_seen, health = excluded.health, "
+                "settings_version = excluded.settings_version",
+                (booth, request.remote_addr, epoch, last_id, now, now,
+                 json.dumps(data.get('health')), data.get('settings_version')))
+            version, settings = _current_settings(db)
+
+    reply = {'ack': last_id}
+    if authorized and version is not None and data.get('settings_version') != version:
+        reply['settings'] = _distributed(settings)
+        reply['settings_version'] = version
+    return jsonify(reply)
+
+
+def _page(table, order, extra_filters=()):
+    """Filtered, paginated rows of a table from the request's query string"""
+    where, params = [], []
+    for key, column in list(FILTERS.items()) + list(extra_filters):
+        value = request.args.get(key)
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(value)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    limit = max(1, min(request.args.get('limit', 50, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    with _db_lock:
+        db = _get_db()
+        total = db.execute(f"SELECT COUNT(*) FROM {table} {clause}", params).fetchone()[0]
+        rows = db.execute(f"SELECT * FROM {table} {clause} ORDER BY {order} DESC LIMIT ? OFFSET ?",
+                          (*params, limit, offset)).fetchall()
+    return {'total': total, 'limit': limit, 'offset': offset, 'items': [dict(r) for r in rows]}
+
+
+@fleet.route('/api/scans')
+def api_scans():
+    """Scans from every booth, newest first"""
+    return jsonify(_page('scans', 'ts'))
+
+
+@fleet.route('/api/clips')
+def api_clips():
+    """Clips from every booth, newest first"""
+    return jsonify(_page('clips', 'recorded_at',
+                         [('state', 'state'), ('upload', 'upload_status')]))
+
+
+def get_booths():
+    """Every booth that ever pushed, with its latest health"""
+    now = time.time()
+    with _db_lock:
+        rows = _get_db().execute("SELECT * FROM booths ORDER BY booth").fetchall()
+    booths = []
+    for row in rows:
+        booth = dict(row)
+        booth['health'] = json.loads(booth['health'] or 'null')
+        booth['online'] = now - booth['last_seen'] < OFFLINE_AFTER
+        booths.append(booth)
+    return booths
+
+
+def get_stats(window=3600):
+    """Scans and clips per booth in the last window seconds, and in total"""
+    since = time.time() - window
+    with _db_lock:
+        db = _get_db()
+        scans = db.execute("SELECT booth, COUNT(*), SUM(ts >= ?) FROM scans GROUP BY booth",
+                           (since,)).fetchall()
+        clips = db.execute("SELECT booth, COUNT(*), SUM(recorded_at >= ?), "
+                           "SUM(upload_status = 'uploaded'), SUM(state = 'failed') "
+                           "FROM clips GROUP BY booth", (since,)).fetchall()
+    stats = {}
+    for booth, total, recent in scans:
+        stats.setdefault(booth, {})['scans'] = {'total': total, 'recent': recent or 0}
+    for booth, total, recent, uploaded, failed in clips:
+        stats.setdefault(booth, {})['clips'] = {'total': total, 'recent': recent or 0,
+                                                'uploaded': uploaded or 0, 'failed': failed or 0}
+    return {
+        'window': window,
+        'booths': stats,
+        'scans_per_hour': sum(b.get('scans', {}).get('recent', 0) for b in stats.values()) * 3600 / window,
+        'clips_per_hour': sum(b.get('clips', {}).get('recent', 0) for b in stats.values()) * 3600 / window,
+    }
+
+
+@fleet.route('/api/booths')
+def api_booths():
+    return jsonify(get_booths())
+
+
+@fleet.route('/api/stats')
+def api_stats():
+    """Cross-booth throughput"""
+    return jsonify(get_stats(request.args.get('window', 3600, type=int)))
+
+
+@fleet.route('/api/settings', methods=['GET', 'POST'])
+def api_settings():
+    """Read or replace the settings every booth takes from the fleet"""
+    if not _authorized():
+        return jsonify({'error': 'Missing or wrong fleet token'}), 403
+    with _db_lock:
+        db = _get_db()
+        if request.method == 'POST':
+            settings = request.get_json(force=True)
+            if not isinstance(settings, dict):
+                return jsonify({'error': 'Settings must be a JSON object'}), 400
+            with db:
+                db.execute("INSERT INTO fleet_settings (settings, created) VALUES (?, ?)",
+                           (json.dumps(settings), time.time()))
+            log(f"Fleet settings updated: {sorted(settings)}")
+        version, settings = _current_settings(db)
+    return jsonify({'version': version, 'settings': settings or {}})
+
+
+@fleet.app_template_filter('timestamp')
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts else ''
+
+
+@fleet.route('/')
+def view():
+    """Combined view of every booth, searchable by band"""
+    neo_id = request.args.get('neoId')
+    scans = clips = None
+    if neo_id:
+        scans = _page('scans', 'ts')['items']
+        clips = _page('clips', 'recorded_at')['items']
+    return render_template('fleet.html', booths=get_booths(), stats=get_stats(),
+                           neo_id=neo_id, scans=scans, clips=clips, now=time.time())
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    app = Flask(__name__)
+    app.register_blueprint(fleet)
+    log(f"Fleet coordinator listening on port {port}")
+    app.run(host='0.0.0.0', port=port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Video encoder probing for the Alleycat Photobooth.
+
+At startup the H.264 encoders ffmpeg offers on this machine are benchmarked
+on a short synthetic MJPEG clip, the same kind of input capture feeds them.
+The results are cached in DATA_DIR and the fastest working encoder becomes
+the default for capture and processing, so a box without the Pi's hardware
+encoder still records.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import ffmpeg
+from logit import log
+from settings import load_settings, DATA_DIR
+from hal import DEFAULT_ENCODER, HARDWARE
+
+# Constants
+PROBE_FILE = os.path.join(DATA_DIR, 'encoder_probe.json')
+PROBE_SECONDS = 3         # length of the synthetic clip
+PROBE_TIMEOUT = 60        # seconds an encoder may take before it is given up on
+
+# Encoder name -> ffmpeg output arguments
+ENCODERS = {
+    'h264_v4l2m2m': {'vcodec': 'h264_v4l2m2m', 'b': '4M'},
+    'libx264-ultrafast': {'vcodec': 'libx264', 'preset': 'ultrafast', 'crf': 23},
+    'libx264-veryfast': {'vcodec': 'libx264', 'preset': 'veryfast', 'crf': 23},
+    'mjpeg-copy': {'vcodec': 'copy'},
+}
+
+# Encoders that produce H.264; the others are benchmarked for reference only
+H264_ENCODERS = ('h264_v4l2m2m', 'libx264-ultrafast', 'libx264-veryfast')
+
+# Global state
+_results = None
+_lock = threading.Lock()
+_probe_thread = None
+
+
+def encoder_args(name, bitrate=None):
+    """
+    Return the ffmpeg output arguments for an encoder name, optionally
+    capped at a bitrate in bits/s instead of the encoder's own quality.
+    """
+    args = dict(ENCODERS.get(name, {'vcodec': name}))
+    if args['vcodec'] == 'copy':
+        return args
+    args['pix_fmt'] = 'yuv420p'
+    if bitrate:
+        args.pop('crf', None)
+        args.update(b=int(bitrate), maxrate=int(bitrate), bufsize=2 * int(bitrate))
+    return args
+
+
+def _probe_key(resolution, framerate):
+    """Identify the conditions a cached probe is valid for"""
+    try:
+        version = subprocess.run(['ffmpeg', '-version'], capture_output=True,
+                                 text=True, timeout=10).stdout.split('\n', 1)[0]
+    except Exception:
+        version = None
+    devices = sorted(d for d in os.listdir('/dev') if d.startswith('video')) if os.path.isdir('/dev') else []
+    return {
+        'ffmpeg': version,
+        'hardware': HARDWARE,
+        'devices': devices,
+        'resolution': resolution,
+        'framerate': framerate,
+    }
+
+
+def _make_clip(path, resolution, framerate):
+    """Render the synthetic MJPEG clip the encoders are timed on"""
+    (
+        ffmpeg
+        .input(f"testsrc=size={resolution}:rate={framerate}", f='lavfi', t=PROBE_SECONDS)
+        .output(path, vcodec='mjpeg', f='mjpeg', **{'q:v': 5})
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+
+def _time_encoder(name, clip, out_path, framerate):
+    """Encode the clip and return the result for one encoder"""
+    frames = PROBE_SECONDS * framerate
+    process = (
+        ffmpeg
+        .input(clip, f='mjpeg', framerate=framerate)
+        .output(out_path, f='mp4', **encoder_args(name))
+        .overwrite_output()
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+    start = time.monotonic()
+    try:
+        _, err = process.communicate(timeout=PROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        return {'ok': False, 'error': 'timed out'}
+    elapsed = time.monotonic() - start
+
+    if process.returncode != 0 or not os.path.exists(out_path) or not os.path.getsize(out_path):
+        lines = err.decode(errors='replace').strip().splitlines()
+        return {'ok': False, 'error': lines[-1] if lines else f"exit {process.returncode}"}
+    return {'ok': True, 'fps': round(frames / elapsed, 1), 'seconds': round(elapsed, 3)}
+
+
+def _best(encoders):
+    """Name of the fastest working H.264 encoder, or None"""
+    working = [(result['fps'], name) for name, result in encoders.items()
+               if result.get('ok') and name in H264_ENCODERS]
+    return max(working)[1] if working else None
+
+
+def probe_encoders(force=False):
+    """
+    Benchmark the encoders, reusing the cached results if nothing changed.
+
+    Returns:
+        Dict with 'best' (encoder name or None), 'encoders' (name -> result)
+        and 'key' (the conditions the probe ran under)
+    """
+    global _results
+
+    settings = load_settings()
+    resolution = settings.get('webcam_resolution', '1280x720')
+    framerate = int(settings.get('video_framerate', 30))
+    key = _probe_key(resolution, framerate)
+
+    if not force:
+        try:
+            with open(PROBE_FILE, 'r') as f:
+                cached = json.load(f)
+            if cached.get('key') == key:
+                with _lock:
+                    _results = cached
+                log(f"Using cached encoder probe, best encoder {cached.get('best')}")
+                return cached
+        except (OSError, ValueError):
+            pass
+
+    log(f"Probing video encoders at {resolution}@{framerate}")
+    work_dir = tempfile.mkdtemp(prefix='encoder-probe-')
+    try:
+        clip = os.path.join(work_dir, 'clip.mjpeg')
+        _make_clip(clip, resolution, framerate)
+        encoders = {}
+        for name in ENCODERS:
+            encoders[name] = _time_encoder(name, clip, os.path.join(work_dir, f"{name}.mp4"), framerate)
+            log(f"Encoder {name}: {encoders[name]}")
+    except Exception as e:
+        log(f"Error probing encoders: {e}")
+        return None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {'best': _best(encoders), 'encoders': encoders, 'key': key, 'probed_at': time.time()}
+    with _lock:
+        _results = results
+
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        tmp_path = PROBE_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(results, f, indent=4)
+        os.replace(tmp_path, PROBE_FILE)
+    except Exception as e:
+        log(f"Error saving encoder probe: {e}")
+
+    log(f"Encoder probe finished, best encoder {results['best']}")
+    return results
+
+
+def start_probe():
+    """Probe the encoders in the background"""
+    global _probe_thread
+    with _lock:
+        if _probe_thread is not None:
+            return
+        _probe_thread = threading.Thread(target=probe_encoders, name="encoder-probe")
+        _probe_thread.daemon = True
+        _probe_thread.start()
+
+
+def get_probe_results():
+    """Return the latest probe results, or None before the first probe"""
+    with _lock:
+        return _results
+
+
+def get_encoder(settings=None):
+    """
+    Return the encoder name to use for H.264 output.
+
+    An explicit video_encoder setting wins, then the probed best encoder,
+    then the backend's default.
+    """
+    if settings is None:
+        settings = load_settings()
+    if settings.get('video_encoder'):
+        return settings['video_encoder']
+    results = get_probe_results()
+    if results and results.get('best'):
+        return results['best']
+    return DEFAULT_ENCODER
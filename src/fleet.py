@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Fleet agent for the Alleycat Photobooth.
+
+When several booths run at one event, each booth pushes its scans, clip
+catalog changes and health to a coordinator (see coordinator.py) in
+batches over HTTP. Events wait in a SQLite outbox until the coordinator
+acknowledges them, so a booth that drops off the network catches up once
+it is back. The coordinator's reply carries the fleet-wide settings.
+Pushes carry the fleet_token setting, which the coordinator checks.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+import urllib.request
+from logit import log
+from settings import load_settings, save_settings, DATA_DIR
+
+# Constants
+OUTBOX_DB_FILE = os.path.join(DATA_DIR, 'fleet_outbox.db')
+PUSH_PATH = '/fleet/api/push'
+TOKEN_HEADER = 'X-Fleet-Token'
+DEFAULT_PUSH_INTERVAL = 5.0    # seconds between pushes
+BATCH_SIZE = 200               # events per push at most
+MAX_OUTBOX = 100000            # events kept while offline, oldest dropped first
+PUSH_TIMEOUT = 10              # seconds
+RETRY_MAX_DELAY = 300          # seconds between pushes while the coordinator is down
+
+# Settings that describe this booth and are never taken from the fleet
+LOCAL_SETTINGS = {'booth_id', 'hostname', 'fleet_coordinator', 'fleet_token', 'webcam_device'}
+# Only sent to booths when the coordinator sets fleet_share_credentials
+CREDENTIAL_SETTINGS = {'samba_username', 'samba_password'}
+
+# Global state
+_db_lock = threading.Lock()
+_db = None
+_agent_thread = None
+_health_fn = None
+_wake = threading.Event()
+_stats = {
+    'pushed': 0,
+    'failed_pushes': 0,
+    'last_push': None,
+    'last_error': None,
+    'settings_version': None,
+}
+
+
+def booth_id(settings=None):
+    """Name this booth reports to the coordinator"""
+    if settings is None:
+        settings = load_settings()
+    return settings.get('booth_id') or settings.get('hostname') or socket.gethostname()
+
+
+def _connect():
+    """Open the outbox database, creating the table if needed"""
+    os.makedirs(os.path.dirname(OUTBOX_DB_FILE), exist_ok=True)
+    conn = sqlite3.connect(OUTBOX_DB_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            ts REAL NOT NULL,
+            payload TEXT NOT NULL
+        )
+    """)
+    # A new outbox restarts its ids, the epoch tells the coordinator so
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex,))
+    conn.commit()
+    return conn
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        _db = _connect()
+    return _db
+
+
+def _epoch():
+    with _db_lock:
+        return _get_db().execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+
+
+def record_events(kind, payloads):
+    """
+    Queue events for the coordinator. Does nothing unless a coordinator
+    is configured with the fleet_coordinator setting.
+
+    Args:
+        kind: 'scan' or 'clip'
+        payloads: List of JSON-serializable dicts
+    """
+    if not payloads or not load_settings().get('fleet_coordinator'):
+        return
+    now = time.time()
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.executemany("INSERT INTO outbox (kind, ts, payload) VALUES (?, ?, ?)",
+                               [(kind, now, json.dumps(p)) for p in payloads])
+                # Bound the backlog of a booth that has been offline for a long time
+                db.execute("DELETE FROM outbox WHERE id <= "
+                           "(SELECT MAX(id) FROM outbox) - ?", (MAX_OUTBOX,))
+    except Exception as e:
+        log(f"Error queuing fleet events: {e}")
+
+
+def record_event(kind, payload):
+    record_events(kind, [payload])
+
+
+def outbox_depth():
+    try:
+        with _db_lock:
+            return _get_db().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    except Exception:
+        return 0
+
+
+def _read_batch():
+    with _db_lock:
+        rows = _get_db().execute(
+            "SELECT id, kind, ts, payload FROM outbox ORDER BY id LIMIT ?", (BATCH_SIZE,)).fetchall()
+    return [{'id': r[0], 'kind': r[1], 'ts': r[2], 'data': json.loads(r[3])} for r in rows]
+
+
+def _ack(last_id):
+    with _db_lock:
+        db = _get_db()
+        with db:
+            db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,))
+
+
+def _health():
+    health = {'time': time.time(), 'outbox': outbox_depth()}
+    if _health_fn:
+        try:
+            health.update(_health_fn())
+        except Exception as e:
+            log(f"Error collecting health for the fleet: {e}")
+    return health
+
+
+def _apply_settings(fleet_settings, version):
+    """Merge the fleet-wide settings into the local ones"""
+    settings = load_settings()
+    changes = {k: v for k, v in fleet_settings.items()
+               if k not in LOCAL_SETTINGS and settings.get(k) != v}
+    if changes and not save_settings({**settings, **changes}):
+        return
+    _stats['settings_version'] = version
+    if changes:
+        log(f"Applied fleet settings version {version}: {sorted(changes)}")
+
+
+def push_once(settings=None):
+    """
+    Send one batch of events and the booth's health to the coordinator.
+
+    Returns:
+        Number of events acknowledged
+    """
+    if settings is None:
+        settings = load_settings()
+    url = settings['fleet_coordinator'].rstrip('/') + PUSH_PATH
+    events = _read_batch()
+    body = json.dumps({
+        'booth': booth_id(settings),
+        'epoch': _epoch(),
+        'events': events,
+        'health': _health(),
+        'settings_version': _stats['settings_version'],
+    }).encode()
+    headers = {'Content-Type': 'application/json'}
+    if settings.get('fleet_token'):
+        headers[TOKEN_HEADER] = settings['fleet_token']
+    request = urllib.request.Request(url, data=body, headers=headers)
+    with urllib.request.urlopen(request, timeout=PUSH_TIMEOUT) as response:
+        reply = json.load(response)
+
+    if events and reply.get('ack') is not None:
+        _ack(reply['ack'])
+    if 'settings' in reply:
+        _apply_settings(reply['settings'], reply.get('settings_version'))
+    return len(events)
+
+
+def _agent_loop():
+    delay = 0
+    while True:
+        settings = load_settings()
+        interval = float(settings.get('fleet_push_interval', DEFAULT_PUSH_INTERVAL))
+        _wake.wait(max(interval, delay))
+        _wake.clear()
+        if not settings.get('fleet_coordinator'):
+            continue
+
+        try:
+            sent = push_once(settings)
+            _stats['pushed'] += sent
+            _stats['last_push'] = time.time()
+            delay = 0
+            # Keep going straight away while catching up on a backlog
+            if sent == BATCH_SIZE:
+                _wake.set()
+        except Exception as e:
+            _stats['failed_pushes'] += 1
+            if _stats['last_error'] != str(e):
+                log(f"Error pushing to the fleet coordinator: {e}")
+            _stats['last_error'] = str(e)
+            delay = min(RETRY_MAX_DELAY, max(interval, delay * 2))
+
+
+def start_agent(health_fn=None):
+    """
+    Start pushing to the coordinator in the background.
+
+    Args:
+        health_fn: Optional callable returning a dict of booth health
+    """
+    global _agent_thread, _health_fn
+    _health_fn = health_fn
+    if _agent_thread is not None:
+        return
+    _agent_thread = threading.Thread(target=_agent_loop, name="fleet-agent")
+    _agent_thread.daemon = True
+    _agent_thread.start()
+
+
+def get_agent_stats():
+    return {**_stats, 'booth': booth_id(), 'outbox': outbox_depth(),
+            'coordinator': load_settings().get('fleet_coordinator')}
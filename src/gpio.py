@@ -3,7 +3,7 @@
 GPIO control for the photobooth.
 """
 
-import RPi.GPIO as GPIO
+from hal import GPIO
 from logit import get_logger, log
 
 # Get logger
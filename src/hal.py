@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Hardware abstraction for the Alleycat Photobooth.
+
+Every hardware dependency is imported from here, so the booth can run on a
+Pi or headless with the simulated backends in sim.py. The backend is picked
+with the PHOTOBOOTH_HARDWARE environment variable: 'pi' (default) or 'sim'.
+"""
+
+import os
+import re
+import functools
+import subprocess
+import ffmpeg
+
+HARDWARE = os.environ.get('PHOTOBOOTH_HARDWARE', 'pi').lower()
+SIMULATED = HARDWARE == 'sim'
+
+if SIMULATED:
+    from sim import GPIO, MFRC522, CharLCD
+else:
+    import RPi.GPIO as GPIO
+    from mfrc522 import MFRC522
+    from RPLCD.i2c import CharLCD
+
+# Video encoder that works on this backend without probing
+DEFAULT_ENCODER = 'libx264' if SIMULATED else 'h264_v4l2m2m'
+
+SIM_CAMERA = 'sim://testsrc'
+
+
+def find_camera():
+    """Find the first available camera device"""
+    if SIMULATED:
+        return SIM_CAMERA
+    for i in range(10):  # Check up to /dev/video9
+        device = f"/dev/video{i}"
+        if os.path.exists(device):
+            return device
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def camera_formats(device):
+    """
+    List the pixel formats a V4L2 camera offers, the same way
+    scripts/debug/get_webcam_info.sh does with ffmpeg -list_formats.
+
+    Returns:
+        Dict mapping format name (e.g. 'mjpeg', 'yuyv422', 'h264') to
+        {'compressed': bool, 'sizes': [resolution, ...]}, empty if the
+        camera could not be queried
+    """
+    if device == SIM_CAMERA:
+        return {}
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-f', 'v4l2', '-list_formats', 'all', '-i', device],
+            capture_output=True, text=True, timeout=10)
+    except Exception:
+        return {}
+
+    formats = {}
+    pattern = r'\]\s*(Compressed|Raw)\s*:\s*(\S+)\s+:\s+.*?\s+:\s+(.*)$'
+    for kind, name, sizes in re.findall(pattern, result.stderr, re.M):
+        formats[name] = {'compressed': kind == 'Compressed', 'sizes': sizes.split()}
+    return formats
+
+
+def _offers(formats, name, resolution):
+    """True if the camera offers a format at a resolution"""
+    fmt = formats.get(name)
+    return bool(fmt) and (resolution in fmt['sizes'] or not fmt['sizes'])
+
+
+def _raw_format(device, resolution):
+    """The raw format to capture when a camera has no MJPEG at a resolution, or None"""
+    formats = camera_formats(device)
+    if not formats or _offers(formats, 'mjpeg', resolution):
+        return None
+    raw = [name for name, fmt in formats.items()
+           if not fmt['compressed'] and _offers(formats, name, resolution)]
+    return raw[0] if raw else None
+
+
+def native_mjpeg(device, resolution):
+    """True if the camera's own MJPEG is what the capture passes through"""
+    return device != SIM_CAMERA and _raw_format(device, resolution) is None
+
+
+def camera_input(device, resolution, framerate):
+    """
+    Build the ffmpeg input for a camera.
+
+    Returns:
+        (stream, vcodec) where vcodec is the codec that turns the input into
+        an MJPEG stream: 'copy' when the camera delivers MJPEG itself,
+        'mjpeg' for raw frames from the simulated camera or from a webcam
+        without MJPEG at this resolution
+    """
+    if device == SIM_CAMERA:
+        # Real-time test pattern standing in for the webcam
+        stream = ffmpeg.input(f"testsrc=size={resolution}:rate={framerate}", f='lavfi', re=None)
+        return stream, 'mjpeg'
+
+    # Prefer the camera's own MJPEG, it can be passed through untouched
+    input_format, vcodec = 'mjpeg', 'copy'
+    raw = _raw_format(device, resolution)
+    if raw:
+        input_format, vcodec = raw, 'mjpeg'
+
+    stream = ffmpeg.input(device,
+                          f='v4l2',
+                          input_format=input_format,
+                          s=resolution,
+                          framerate=framerate)
+    return stream, vcodec
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Processing journal for the Alleycat Photobooth.
+
+Each clip's pipeline stage is written to a SQLite journal on /data before
+the step that moves it on, and every file move is made durable, so after
+a restart or power cut the booth knows exactly which clips are unfinished
+and which step each one needs, without rescanning the video folders.
+Finished clips are removed from the journal.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from logit import log
+from settings import DATA_DIR
+
+# Constants
+JOURNAL_DB_FILE = os.path.join(DATA_DIR, 'journal.db')
+
+# Stages, in pipeline order. Each is written before its step starts.
+STAGE_RECORDED = 'recorded'      # capture finished, moving into videos/in
+STAGE_CLAIMED = 'claimed'        # moving into videos/processing and encoding
+STAGE_ENCODED = 'encoded'        # encode complete, moving it to its output path,
+                                 # then thumbnails and upload
+STAGE_FAILED = 'failed'          # left alone until someone looks at it
+
+# Global state
+_db_lock = threading.Lock()
+_db = None
+
+
+def _connect():
+    """Open the journal database, creating the table if needed"""
+    os.makedirs(os.path.dirname(JOURNAL_DB_FILE), exist_ok=True)
+    conn = sqlite3.connect(JOURNAL_DB_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Every stage must be on disk before the step it announces
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            filename TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            temp_path TEXT,
+            output TEXT,
+            player TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    # Journals from before encodes were tracked lack the output
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+    if 'output' not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN output TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage, created_at)")
+    conn.commit()
+    return conn
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        _db = _connect()
+    return _db
+
+
+def record_stage(filename, stage, temp_path=None, player_data=None, output=None):
+    """
+    Record that a clip is entering a stage. Returns True on success.
+
+    Args:
+        filename: Name of the clip as recorded, inside videos/in
+        stage: One of the STAGE_* constants
+        temp_path: Where capture wrote the clip, for STAGE_RECORDED
+        player_data: RFID data of the player, for STAGE_RECORDED
+        output: Where the finished encode goes, for STAGE_ENCODED
+    """
+    now = time.time()
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                if stage == STAGE_RECORDED:
+                    # A new clip starts a new job, whatever used the name before
+                    db.execute(
+                        "INSERT OR REPLACE INTO jobs (filename, stage, temp_path, player, "
+                        "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (filename, stage, temp_path,
+                         json.dumps(player_data) if player_data else None, now, now))
+                else:
+                    db.execute(
+                        "UPDATE jobs SET stage = ?, output = COALESCE(?, output), updated_at = ? "
+                        "WHERE filename = ?", (stage, output, now, filename))
+        return True
+    except Exception as e:
+        log(f"Error journaling {filename} as {stage}: {e}")
+        return False
+
+
+def add_attempt(filename):
+    """Count a run of the pipeline on a clip"""
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.execute("UPDATE jobs SET attempts = attempts + 1 WHERE filename = ?", (filename,))
+    except Exception as e:
+        log(f"Error journaling an attempt at {filename}: {e}")
+
+
+def finish(filename):
+    """Drop a clip that made it all the way through the pipeline"""
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.execute("DELETE FROM jobs WHERE filename = ?", (filename,))
+    except Exception as e:
+        log(f"Error removing {filename} from the journal: {e}")
+
+
+def unfinished():
+    """Return the clips still in the pipeline, oldest first"""
+    with _db_lock:
+        rows = _get_db().execute(
+            "SELECT * FROM jobs WHERE stage != ? ORDER BY created_at", (STAGE_FAILED,)).fetchall()
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job['player'] = json.loads(job['player']) if job['player'] else None
+        jobs.append(job)
+    return jobs
+
+
+def capture_paths():
+    """Capture files the journal still refers to, failed clips included"""
+    with _db_lock:
+        rows = _get_db().execute("SELECT temp_path FROM jobs WHERE temp_path IS NOT NULL").fetchall()
+    return {row['temp_path'] for row in rows}
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_file(path):
+    """Flush a file's data to disk"""
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def durable_rename(src, dst):
+    """
+    Move a file so that after a power cut it is either still at src or
+    complete at dst: its data is flushed first and both directories after.
+    """
+    fsync_file(src)
+    os.replace(src, dst)
+    _fsync_dir(os.path.dirname(dst) or '.')
+    if os.path.dirname(src) != os.path.dirname(dst):
+        _fsync_dir(os.path.dirname(src) or '.')
@@ -1,58 +1,177 @@
 #!/usr/bin/env python3
 """
 LCD display control for the photobooth.
+
+Callers only describe what the display should show. A render thread draws
+the latest frame, coalescing rapid updates, and only rewrites the character
+cells that changed, so slow I2C writes never block the booth.
 """
 
-from RPLCD.i2c import CharLCD
+import math
+import time
+import threading
+from hal import CharLCD
 from logit import get_logger, log
+from metrics import counter
 
 # Get logger
 logger = get_logger(__name__)
 
+# Constants
+LCD_COLS = 16
+LCD_ROWS = 2
+COALESCE_DELAY = 0.02   # seconds to wait for more updates before drawing
+SCROLL_INTERVAL = 0.4   # seconds per character when scrolling long lines
+SCROLL_PAUSE = 1.0      # seconds a long line rests at its start
+SCROLL_GAP = '    '     # spacing between the end and the start of a scrolled line
+
+# Metrics
+LCD_WRITES = counter('photobooth_lcd_cell_writes_total', 'Character cells written to the LCD')
+
 # Global LCD instance
 _lcd = None
 
-# Track last displayed text
-_last_line1 = None
-_last_line2 = None
+# What the display currently shows, None when unknown
+_shown = None
+
+# The frame the display should show
+_frame = {'lines': ('', ''), 'countdown_end': None, 'countdown_format': None, 'since': 0.0}
+_frame_version = 0
+_cond = threading.Condition()
+_render_thread = None
 
 def init_lcd():
     """Initialize the LCD display"""
     global _lcd
     if _lcd is not None:
         return _lcd
-        
+
     try:
         # Initialize LCD with PCF8574 I2C backpack
         _lcd = CharLCD('PCF8574', 0x27)
         log("LCD initialized successfully")
+        _start_renderer()
         return _lcd
     except Exception as e:
         log(f"Error initializing LCD: {e}")
         return None
 
+def _set_frame(lines, countdown_end=None, countdown_format=None):
+    global _frame, _frame_version
+    with _cond:
+        _frame = {
+            'lines': lines,
+            'countdown_end': countdown_end,
+            'countdown_format': countdown_format,
+            'since': time.time(),
+        }
+        _frame_version += 1
+        _cond.notify()
+
 def set_lcd_text(line1, line2):
-    """Set text on the LCD display. Assumes LCD is already initialized."""
-    global _lcd, _last_line1, _last_line2
-    
-    # Early exit if no text has changed
-    if line1 == _last_line1 and line2 == _last_line2:
-        return True
-        
+    """
+    Set text on the LCD display. Returns immediately.
+    Lines longer than the display scroll.
+    """
+    with _cond:
+        if _frame['lines'] == (line1, line2) and _frame['countdown_end'] is None:
+            return True
+    _set_frame((line1, line2))
+    return True
+
+def start_countdown(line1, seconds, template="{}s"):
+    """Show line1 with a countdown from seconds on the second line"""
+    _set_frame((line1, ''), time.time() + seconds, template)
+    return True
+
+def _scroll(text, elapsed):
+    """Return the window of a long line shown after elapsed seconds"""
+    if len(text) <= LCD_COLS:
+        return text.ljust(LCD_COLS)
+    loop = text + SCROLL_GAP
+    steps = int(max(0.0, elapsed - SCROLL_PAUSE) / SCROLL_INTERVAL) % len(loop)
+    return (loop + loop)[steps:steps + LCD_COLS]
+
+def _render(frame, now):
+    """
+    Work out the text for each row at time now.
+
+    Returns:
+        (rows, next_change) where next_change is when the text changes next
+        by itself, or None if it is static
+    """
+    elapsed = now - frame['since']
+    line1, line2 = frame['lines']
+    next_change = None
+
+    if frame['countdown_end'] is not None:
+        remaining = max(0.0, frame['countdown_end'] - now)
+        line2 = frame['countdown_format'].format(math.ceil(remaining))
+        if remaining > 0:
+            # Redraw just after the next whole second is crossed
+            next_change = now + (remaining - math.floor(remaining) or 1.0) + 0.01
+
+    rows = [_scroll(line1, elapsed), _scroll(line2, elapsed)]
+    if len(line1) > LCD_COLS or len(line2) > LCD_COLS:
+        tick = now + SCROLL_INTERVAL
+        next_change = tick if next_change is None else min(next_change, tick)
+    return rows, next_change
+
+def _draw(rows):
+    """Write only the cells that differ from what the display shows"""
+    global _shown
+    if _lcd is None:
+        return
+    shown = _shown or [None] * LCD_ROWS
     try:
-        # Update line1 if it changed
-        if line1 != _last_line1:
-            _lcd.cursor_pos = (0, 0)  # Move to first line
-            _lcd.write_string(line1[:16].ljust(16))  # First line, padded to 16 chars
-            _last_line1 = line1
-            
-        # Update line2 if it changed
-        if line2 != _last_line2:
-            _lcd.cursor_pos = (1, 0)  # Move to second line
-            _lcd.write_string(line2[:16].ljust(16))  # Second line, padded to 16 chars
-            _last_line2 = line2
-            
-        return True
+        for row, text in enumerate(rows):
+            old = shown[row] or '\0' * LCD_COLS
+            col = 0
+            while col < LCD_COLS:
+                if text[col] == old[col]:
+                    col += 1
+                    continue
+                # Write each run of changed cells with a single cursor move
+                end = col
+                while end < LCD_COLS and text[end] != old[end]:
+                    end += 1
+                _lcd.cursor_pos = (row, col)
+                _lcd.write_string(text[col:end])
+                LCD_WRITES.inc(end - col)
+                col = end
+        _shown = list(rows)
     except Exception as e:
         log(f"Error setting LCD text: {e}")
-        return False
\ No newline at end of file
+        # The display is in an unknown state, redraw everything next time
+        _shown = None
+
+def _render_loop():
+    """Draw the latest frame whenever it or its animation changes"""
+    drawn_version = -1
+    next_change = None
+    while True:
+        with _cond:
+            while _frame_version == drawn_version:
+                timeout = None if next_change is None else max(0.0, next_change - time.time())
+                if timeout == 0.0:
+                    break
+                if not _cond.wait(timeout) and next_change is not None:
+                    break
+
+        # Let a burst of updates settle so only the last one is drawn
+        if _frame_version != drawn_version:
+            time.sleep(COALESCE_DELAY)
+
+        with _cond:
+            frame = _frame
+            drawn_version = _frame_version
+        rows, next_change = _render(frame, time.time())
+        _draw(rows)
+
+def _start_renderer():
+    global _render_thread
+    if _render_thread is not None:
+        return
+    _render_thread = threading.Thread(target=_render_loop, name="lcd-render")
+    _render_thread.daemon = True
+    _render_thread.start()
@@ -1,61 +1,173 @@
-import RPi.GPIO as GPIO
+#!/usr/bin/env python3
+"""
+LED control for the photobooth.
+
+The last level written to each pin is tracked so only changes reach the
+GPIO. Blinking, pulsing and countdown patterns run on a background timer
+thread, so the state machine only has to say which pattern it wants.
+"""
+
+import time
+import threading
+from hal import GPIO
 from logit import log
 from gpio import BUTTON_LED_PIN, STAGE_LEDS
+from metrics import counter
+
+# Constants
+BLINK_PERIOD = 0.8        # seconds per on/off cycle
+PULSE_PERIOD = 1.5        # seconds between pulses
+PULSE_WIDTH = 0.15        # seconds a pulse stays on
+COUNTDOWN_SLOW = 1.0      # blink period at the start of a countdown
+COUNTDOWN_FAST = 0.15     # blink period at the end of a countdown
+
+# Metrics
+LED_WRITES = counter('photobooth_led_writes_total', 'GPIO writes made for the LEDs')
+
+# Global state
+_levels = {}      # pin -> last level written
+_patterns = {}    # pin -> (pattern, started)
+_cond = threading.Condition()
+_pattern_thread = None
+
+def _pin(led):
+    """Map 'button' or a stage colour to its pin"""
+    if led == 'button':
+        return BUTTON_LED_PIN
+    return STAGE_LEDS[led]
+
+def _write(pin, level):
+    """Write a pin unless it already has that level. Call with _cond held."""
+    if _levels.get(pin) == level:
+        return
+    GPIO.output(pin, level)
+    _levels[pin] = level
+    LED_WRITES.inc()
+
+def _set(levels):
+    """Set pins to fixed levels, stopping any pattern running on them"""
+    try:
+        with _cond:
+            for pin, level in levels.items():
+                _patterns.pop(pin, None)
+                _write(pin, level)
+        return True
+    except Exception as e:
+        log(f"Error setting LEDs: {e}")
+        return False
+
+# Patterns
+# Each maps the seconds since it started to (level, seconds until the level
+# next changes), with None meaning it never changes again.
+
+def _blink(period, on_time):
+    def pattern(elapsed):
+        phase = elapsed % period
+        if phase < on_time:
+            return GPIO.HIGH, on_time - phase
+        return GPIO.LOW, period - phase
+    return pattern
+
+def _countdown(duration):
+    def pattern(elapsed):
+        remaining = duration - elapsed
+        if remaining <= 0:
+            return GPIO.HIGH, None
+        # Blink faster as the end approaches
+        period = COUNTDOWN_FAST + (COUNTDOWN_SLOW - COUNTDOWN_FAST) * remaining / duration
+        phase = elapsed % period
+        if phase < period / 2:
+            return GPIO.HIGH, min(period / 2 - phase, remaining)
+        return GPIO.LOW, min(period - phase, remaining)
+    return pattern
+
+def _start_pattern(led, pattern):
+    try:
+        pin = _pin(led)
+        with _cond:
+            _patterns[pin] = (pattern, time.monotonic())
+            _cond.notify()
+        _start_engine()
+        return True
+    except Exception as e:
+        log(f"Error starting LED pattern: {e}")
+        return False
+
+def _pattern_loop():
+    """Apply every running pattern and sleep until the next level change"""
+    while True:
+        with _cond:
+            now = time.monotonic()
+            wake = None
+            for pin, (pattern, started) in list(_patterns.items()):
+                level, until = pattern(now - started)
+                try:
+                    _write(pin, level)
+                except Exception as e:
+                    log(f"Error driving LED pattern on pin {pin}: {e}")
+                if until is None:
+                    # Finished patterns leave the pin at their final level
+                    del _patterns[pin]
+                elif wake is None or until < wake:
+                    wake = until
+            _cond.wait(wake)
+
+def _start_engine():
+    global _pattern_thread
+    with _cond:
+        if _pattern_thread is not None:
+            return
+        _pattern_thread = threading.Thread(target=_pattern_loop, name="led-patterns")
+        _pattern_thread.daemon = True
+        _pattern_thread.start()
+
+def blink_led(led, period=BLINK_PERIOD):
+    """Blink an LED ('button' or a stage colour) until it is set again"""
+    return _start_pattern(led, _blink(period, period / 2))
+
+def pulse_led(led, period=PULSE_PERIOD, width=PULSE_WIDTH):
+    """Flash an LED briefly once per period until it is set again"""
+    return _start_pattern(led, _blink(period, width))
+
+def countdown_led(led, seconds):
+    """Blink an LED faster and faster for seconds, then leave it on"""
+    return _start_pattern(led, _countdown(seconds))
 
 def turn_on_all_leds():
     """Turn on all LEDs (button and stage LEDs)"""
-    try:
-        # Turn on all stage LEDs
-        for color, pin in STAGE_LEDS.items():
-            GPIO.output(pin, GPIO.HIGH)
-            log(f"Turned on {color} LED at pin {pin}")
-        # Turn on button LED
-        GPIO.output(BUTTON_LED_PIN, GPIO.HIGH)
+    levels = {pin: GPIO.HIGH for pin in STAGE_LEDS.values()}
+    levels[BUTTON_LED_PIN] = GPIO.HIGH
+    if _set(levels):
         log("All LEDs turned on")
-    except Exception as e:
-        log(f"Error turning on all LEDs: {e}")
 
 def turn_off_all_leds():
     """Turn off all LEDs (button and stage LEDs)"""
-    try:
-        # Turn off all stage LEDs
-        for color, pin in STAGE_LEDS.items():
-            GPIO.output(pin, GPIO.LOW)
-            log(f"Turned off {color} LED at pin {pin}")
-        # Turn off button LED
-        GPIO.output(BUTTON_LED_PIN, GPIO.LOW)
+    levels = {pin: GPIO.LOW for pin in STAGE_LEDS.values()}
+    levels[BUTTON_LED_PIN] = GPIO.LOW
+    if _set(levels):
         log("All LEDs turned off")
-    except Exception as e:
-        log(f"Error turning off all LEDs: {e}")
 
 def turn_on_stage_led(stage):
-    """Turn on only the LED for a specific stage"""
-    try:
-        # Turn off all LEDs first
-        turn_off_all_leds()
-        # Turn on the specific stage LED
-        if stage in STAGE_LEDS:
-            GPIO.output(STAGE_LEDS[stage], GPIO.HIGH)
-            log(f"Stage LED turned on for {stage}")
-    except Exception as e:
-        log(f"Error turning on stage LED: {e}")
+    """Turn on only the LED for a specific stage, all others off"""
+    levels = {pin: GPIO.HIGH if color == stage else GPIO.LOW
+              for color, pin in STAGE_LEDS.items()}
+    levels[BUTTON_LED_PIN] = GPIO.LOW
+    if _set(levels):
+        log(f"Stage LED turned on for {stage}", 'DEBUG')
 
 def turn_on_button_led():
     """Turn on the button LED"""
-    try:
-        GPIO.output(BUTTON_LED_PIN, GPIO.HIGH)
-        log("Button LED turned on")
-    except Exception as e:
-        log(f"Error turning on button LED: {e}")
+    if _set({BUTTON_LED_PIN: GPIO.HIGH}):
+        log("Button LED turned on", 'DEBUG')
 
 def turn_off_button_led():
     """Turn off the button LED"""
-    try:
-        GPIO.output(BUTTON_LED_PIN, GPIO.LOW)
-        log("Button LED turned off")
-    except Exception as e:
-        log(f"Error turning off button LED: {e}")
+    if _set({BUTTON_LED_PIN: GPIO.LOW}):
+        log("Button LED turned off", 'DEBUG')
 
 def cleanup():
     """Clean up GPIO resources"""
-    GPIO.cleanup() 
\ No newline at end of file
+    with _cond:
+        _patterns.clear()
+        _levels.clear()
+    GPIO.cleanup()
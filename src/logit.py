@@ -1,29 +1,159 @@
 import os
+import sys
+import time
+import queue
+import atexit
 import logging
+import threading
+from collections import deque
+from datetime import datetime
 
 # Get DEBUG flag from environment variable
 DEBUG = os.environ.get('DEBUG', 'false').lower() == 'true'
 
-def log(message):
+# Constants
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+RECENT_SIZE = 1000          # records kept in memory for the web UI
+RATE_LIMIT_WINDOW = 10.0    # seconds
+RATE_LIMIT_BURST = 5        # identical messages allowed per window
+
+# Global state
+_queue = queue.SimpleQueue()
+_recent = deque(maxlen=RECENT_SIZE)
+_recent_lock = threading.Lock()
+_context = {'state': None, 'player': None}
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+def set_context(**context):
+    """
+    Set fields attached to every following record, e.g. state and player.
+    Pass None to clear a field.
     """
-    Log a message if DEBUG is enabled.
+    _context.update(context)
+
+def log(message, level='INFO'):
+    """
+    Log a message.
     The ONLY print function that should be used in any container.
+
+    Only queues the record; formatting, rate limiting and printing (when
+    DEBUG is enabled) happen on a background thread.
     """
-    if DEBUG:
-        print(message, flush=True)
+    if _writer_thread is None:
+        _start_writer()
+    module = sys._getframe(1).f_globals.get('__name__', '?')
+    _queue.put((time.time(), level, module, message, _context['state'], _context['player']))
+
+def _format(record):
+    context = ''
+    if record['state'] or record['player']:
+        context = f" [state={record['state']} player={record['player']}]"
+    timestamp = datetime.fromtimestamp(record['time']).strftime('%H:%M:%S.%f')[:-3]
+    return f"{timestamp} {record['level']:<7} {record['module']}{context} {record['message']}\n"
+
+def _writer_loop():
+    """Drain the queue, rate limit repeats, keep recent records and print"""
+    # (module, message) -> [window start, count]
+    seen = {}
+    while True:
+        item = _queue.get()
+        lines = []
+        while True:
+            if item is not None:
+                when, level, module, message, state, player = item
+                key = (module, message)
+                window = seen.get(key)
+                if window is None or when - window[0] > RATE_LIMIT_WINDOW:
+                    if window and window[1] > RATE_LIMIT_BURST:
+                        message = f"{message} (repeated {window[1] - RATE_LIMIT_BURST} more times)"
+                    window = seen[key] = [when, 0]
+                    # Forget old keys so the table doesn't grow without bound
+                    if len(seen) > RECENT_SIZE:
+                        seen = {k: v for k, v in seen.items() if when - v[0] <= RATE_LIMIT_WINDOW}
+                        seen[key] = window
+                window[1] += 1
+
+                if window[1] <= RATE_LIMIT_BURST:
+                    record = {
+                        'time': when,
+                        'level': level,
+                        'module': module,
+                        'state': state,
+                        'player': player,
+                        'message': str(message),
+                    }
+                    with _recent_lock:
+                        _recent.append(record)
+                    if DEBUG:
+                        lines.append(_format(record))
+            try:
+                item = _queue.get_nowait()
+            except queue.Empty:
+                break
+
+        # One write and flush per burst of records
+        if lines:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+
+def _start_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is not None:
+            return
+        _writer_thread = threading.Thread(target=_writer_loop, name="logit-writer")
+        _writer_thread.daemon = True
+        _writer_thread.start()
+        atexit.register(_drain)
+
+def _drain(timeout=1.0):
+    """Give the writer a moment to print queued records at exit"""
+    deadline = time.time() + timeout
+    while not _queue.empty() and time.time() < deadline:
+        time.sleep(0.01)
+
+def get_recent_logs(limit=100, level=None, module=None):
+    """
+    Return the most recent log records, newest last.
+
+    Args:
+        limit: Maximum number of records
+        level: Minimum level name, e.g. 'WARNING'
+        module: Only records from this module
+    """
+    min_level = LEVELS.get(level, 0) if level else 0
+    with _recent_lock:
+        records = list(_recent)
+    records = [r for r in records
+               if LEVELS.get(r['level'], 0) >= min_level
+               and (module is None or r['module'] == module)]
+    return records[-limit:]
+
+class _PipelineHandler(logging.Handler):
+    """Send standard logging records through the log() pipeline"""
+
+    def emit(self, record):
+        _queue.put((record.created, record.levelname, record.name, record.getMessage(),
+                    _context['state'], _context['player']))
 
 def get_logger(name):
     """
     Get a properly configured logger instance for a module.
     This is the preferred way for modules to get their own logger.
-    
+
     Args:
         name: Usually __name__ of the calling module
-        
+
     Returns:
         A configured logger instance
     """
     logger = logging.getLogger(name)
     # Set level based on DEBUG flag
     logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
-    return logger 
\ No newline at end of file
+    if not any(isinstance(h, _PipelineHandler) for h in logger.handlers):
+        if _writer_thread is None:
+            _start_writer()
+        logger.addHandler(_PipelineHandler())
+        logger.propagate = False
+    return logger
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+MJPEG stream splitting for the Alleycat Photobooth.
+Cuts a raw MJPEG byte stream into individual JPEG frames in linear time.
+"""
+
+# Constants
+JPEG_START = b'\xff\xd8'
+JPEG_END = b'\xff\xd9'
+DEFAULT_READ_SIZE = 64 * 1024      # bytes per read from the capture pipe
+DEFAULT_BUFFER_SIZE = 512 * 1024   # initial buffer, grows for larger frames
+
+
+class FrameSplitter:
+    """
+    Incremental JPEG frame splitter.
+
+    Data is read straight into a reusable bytearray and only the bytes that
+    arrived since the last read are scanned for markers. Frames come out as
+    memoryview slices of that buffer, so no copy is made until a consumer
+    needs to keep one. A frame view is only valid until the next read;
+    call bytes() on it to hold on to it.
+    """
+
+    def __init__(self, read_size=DEFAULT_READ_SIZE, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.read_size = read_size
+        self._buf = bytearray(max(buffer_size, read_size))
+        self._start = 0         # first byte still needed
+        self._end = 0           # end of valid data
+        self._scan = 0          # where the next marker search resumes
+        self._frame_start = -1  # start of the frame being assembled
+
+    def _reserve(self, size):
+        """Make room for size more bytes after the valid data"""
+        if len(self._buf) - self._end >= size:
+            return
+
+        live = self._end - self._start
+        offset = self._start
+        if live + size <= len(self._buf):
+            # Slide the partial frame to the front; same-length slice
+            # assignment is allowed while frame views are still exported
+            self._buf[0:live] = self._buf[offset:self._end]
+        else:
+            # Existing views keep the old buffer alive, so grow into a new one
+            buf = bytearray(max(len(self._buf) * 2, live + size))
+            buf[0:live] = self._buf[offset:self._end]
+            self._buf = buf
+
+        self._start = 0
+        self._end = live
+        self._scan -= offset
+        if self._frame_start >= 0:
+            self._frame_start -= offset
+
+    def _split(self):
+        """Yield every complete frame in the buffer"""
+        buf = self._buf
+        while True:
+            if self._frame_start < 0:
+                start = buf.find(JPEG_START, self._scan, self._end)
+                if start == -1:
+                    # Drop the junk but keep a trailing 0xff that may start a marker
+                    self._start = self._scan = max(self._scan, self._end - 1)
+                    return
+                self._frame_start = self._start = start
+                self._scan = start + 2
+
+            end = buf.find(JPEG_END, self._scan, self._end)
+            if end == -1:
+                self._scan = max(self._scan, self._end - 1)
+                return
+
+            end += 2
+            yield memoryview(buf)[self._frame_start:end]
+            self._frame_start = -1
+            self._start = self._scan = end
+
+    def feed(self, data):
+        """Append data and yield the frames it completes"""
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        yield from self._split()
+
+    def read_frames(self, stream):
+        """Read stream until EOF, yielding frames as they complete"""
+        # readinto1 returns as soon as the pipe has data instead of waiting
+        # for a full read_size block
+        readinto = getattr(stream, 'readinto1', stream.readinto)
+        while True:
+            self._reserve(self.read_size)
+            count = readinto(memoryview(self._buf)[self._end:self._end + self.read_size])
+            if not count:
+                return
+            self._end += count
+            yield from self._split()
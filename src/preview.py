@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Adaptive camera preview for the Alleycat Photobooth.
+
+Every preview client only ever gets the newest frame, at a frame rate
+matched to how fast its connection drains. Clients too slow for the
+camera's full-size frames step down a ladder of smaller, more compressed
+tiers, each re-encoded by one ffmpeg shared by every client on it, and a
+global bandwidth cap is split between the connected clients. The camera's
+frames are passed through as they are unless webcam_rotation is set, in
+which case full-size frames are re-encoded too, and every tier applies the
+same transpose as the recordings.
+"""
+
+import time
+import threading
+import ffmpeg
+from logit import log
+from settings import load_settings, subscribe
+from broadcast import FrameQueue
+from mjpeg import FrameSplitter
+from metrics import counter, gauge
+
+# Constants
+DEFAULT_MAX_FPS = 10
+DEFAULT_MIN_FPS = 1
+DEFAULT_MAX_BANDWIDTH = 4000000   # bytes/s for all preview clients together
+DEFAULT_LOW_QUALITY = 10          # JPEG q of the low tier, 2 (best) to 31
+DEFAULT_LOW_SCALE = 0.5           # low tier size relative to the camera
+DEFAULT_FULL_QUALITY = 2          # JPEG q of full-size frames re-encoded for rotation
+DOWNGRADE_FPS = 3                 # frames fitting less often than this -> a smaller tier
+UPGRADE_FPS = 6                   # a better tier's frames fitting this often -> move up
+TIER_HOLD = 5.0                   # seconds a client stays on a tier at least
+MIN_SEND_TIME = 0.005             # sends faster than this count as unthrottled
+MEASURE_INTERVAL = 1.0            # seconds of sends pooled into one drain rate sample
+EWMA_ALPHA = 0.3
+FRAME_TIMEOUT = 5                 # seconds without frames before a stream ends
+TIER_FULL = 'full'
+TIER_LOW = 'low'
+
+# Re-encoded tiers, best first: (name, scale, JPEG q, frame size relative
+# to full frames, assumed until the tier has encoded some). The full tier
+# is only re-encoded while the camera's frames need rotating.
+ENCODED_TIERS = (
+    (TIER_FULL, 1.0, DEFAULT_FULL_QUALITY, 1.0),
+    ('medium', 0.75, 6, 0.45),
+    (TIER_LOW, DEFAULT_LOW_SCALE, DEFAULT_LOW_QUALITY, 0.2),
+    ('lowest', 0.33, 18, 0.08),
+)
+TIER_ORDER = tuple(tier[0] for tier in ENCODED_TIERS)
+
+# Metrics
+PREVIEW_BYTES_TOTAL = counter('photobooth_preview_bytes_total', 'Bytes sent to preview clients by tier')
+PREVIEW_FRAMES_TOTAL = counter('photobooth_preview_frames_total', 'Frames sent to preview clients by tier')
+
+# Global state
+_clients = set()
+_clients_lock = threading.Lock()
+
+
+def _ewma(old, sample):
+    return sample if old is None else old + EWMA_ALPHA * (sample - old)
+
+
+class EncodedTier:
+    """
+    One re-encode of the camera frames, rotated and scaled for a step of
+    the ladder and shared by every client on it. It runs only while it has
+    subscribers and encodes at most preview_max_fps, so its CPU cost
+    doesn't grow with the client count.
+    """
+
+    def __init__(self, name, scale, quality, size_ratio):
+        self.name = name
+        self.scale = scale
+        self.quality = quality
+        self.size_ratio = size_ratio
+        self.frame_size = None          # bytes, EWMA of what it encodes
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._broadcaster = None
+        self._run_id = 0
+        self._stop = None
+
+    def subscribe(self, broadcaster, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+            if self._stop is not None:
+                return callback
+            self._broadcaster = broadcaster
+            run_id, stop = self._new_run()
+        self._start(run_id, stop)
+        return callback
+
+    def restart(self):
+        """Start encoding again with the current settings, keeping the subscribers"""
+        with self._lock:
+            if self._stop is None:
+                return
+            self._stop.set()
+            run_id, stop = self._new_run()
+        self._start(run_id, stop)
+
+    def _new_run(self):
+        self._run_id += 1
+        self._stop = threading.Event()
+        return self._run_id, self._stop
+
+    def _start(self, run_id, stop):
+        thread = threading.Thread(target=self._run, args=(self._broadcaster, run_id, stop),
+                                  name=f"preview-{self.name}-tier")
+        thread.daemon = True
+        thread.start()
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+            if self._subscribers or self._stop is None:
+                return
+            stop, self._stop = self._stop, None
+        stop.set()
+
+    def _publish(self, frame, run_id):
+        with self._lock:
+            if run_id != self._run_id:
+                return
+            subscribers = list(self._subscribers)
+        if frame is not None:
+            self.frame_size = _ewma(self.frame_size, len(frame))
+        for callback in subscribers:
+            callback(frame)
+
+    def _feed(self, frames, process, stop, fps):
+        """Pass camera frames to the encoder at no more than fps"""
+        interval = 1.0 / fps
+        last = 0
+        try:
+            while not stop.is_set():
+                frame = frames.get(timeout=FRAME_TIMEOUT)
+                if frame is None:
+                    break
+                now = time.monotonic()
+                if now - last < interval:
+                    continue
+                last = now
+                process.stdin.write(frame)
+                process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except Exception:
+                pass
+
+    def _run(self, broadcaster, run_id, stop):
+        settings = load_settings()
+        scale = float(settings.get(f'preview_{self.name}_scale', self.scale))
+        quality = int(settings.get(f'preview_{self.name}_quality', self.quality))
+        rotation = settings.get('webcam_rotation', 0)
+        fps = float(settings.get('preview_max_fps', DEFAULT_MAX_FPS))
+        frames = broadcaster.subscribe(FrameQueue(maxsize=1))
+        process = None
+        try:
+            # image2pipe stamps each frame in turn, the raw mjpeg demuxer
+            # gives them all one timestamp and they get dropped
+            stream = ffmpeg.input('pipe:', f='image2pipe', vcodec='mjpeg', framerate=fps,
+                                  probesize=32, fflags='nobuffer')
+            # The same transpose as the recordings, so the preview matches them
+            if rotation:
+                stream = stream.filter('transpose', rotation)
+            if scale != 1:
+                stream = stream.filter('scale', f"trunc(iw*{scale}/2)*2", -2)
+            process = (
+                stream
+                .output('pipe:', f='mjpeg', flush_packets=1, **{'q:v': quality})
+                .run_async(pipe_stdin=True, pipe_stdout=True, quiet=True)
+            )
+            feeder = threading.Thread(target=self._feed, args=(frames, process, stop, fps),
+                                      name=f"preview-{self.name}-feed")
+            feeder.daemon = True
+            feeder.start()
+            log(f"Preview tier {self.name} started")
+            for frame in FrameSplitter().read_frames(process.stdout):
+                if stop.is_set():
+                    break
+                self._publish(bytes(frame), run_id)
+        except Exception as e:
+            log(f"Error in preview tier {self.name}: {e}")
+        finally:
+            broadcaster.unsubscribe(frames)
+            frames(None)
+            if process:
+                try:
+                    process.terminate()
+                    process.wait(timeout=1)
+                except Exception:
+                    process.kill()
+            # Clients still attached fall back to full frames on their own
+            if not stop.is_set():
+                self._publish(None, run_id)
+                with self._lock:
+                    if self._run_id == run_id:
+                        self._stop = None
+            log(f"Preview tier {self.name} stopped")
+
+
+_tiers = {name: EncodedTier(name, scale, quality, ratio)
+          for name, scale, quality, ratio in ENCODED_TIERS}
+
+
+class PreviewClient:
+    """One viewer's preview stream, adapted to its connection"""
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.tier = TIER_FULL
+        self.tier_since = time.monotonic()
+        self.bandwidth = None                      # bytes/s the client drains
+        self._send_cost = None                     # EWMA of seconds per byte sent
+        self.frame_size = {tier: None for tier in TIER_ORDER}
+        self.closed = False
+        self._queue = None
+        self._source = None                        # the tier it is on, None for the camera
+        self._attach(TIER_FULL)
+
+    def _attach(self, tier):
+        # A fresh queue per source, so a source ending only ends that queue
+        self._queue = FrameQueue(maxsize=1)
+        # Full frames come straight from the camera unless they need rotating
+        if tier == TIER_FULL and not load_settings().get('webcam_rotation', 0):
+            self._source = None
+            self.broadcaster.subscribe(self._queue)
+        else:
+            self._source = _tiers[tier]
+            self._source.subscribe(self.broadcaster, self._queue)
+        self.tier = tier
+        self.tier_since = time.monotonic()
+
+    def _detach(self):
+        if self._source:
+            self._source.unsubscribe(self._queue)
+        else:
+            self.broadcaster.unsubscribe(self._queue)
+
+    def _switch(self, tier):
+        self._detach()
+        self._attach(tier)
+        log(f"Preview client moved to {tier} tier "
+            f"({(self.bandwidth or 0) / 1000:.0f} kB/s)", 'DEBUG')
+
+    def close(self):
+        """End the stream, e.g. on shutdown"""
+        self.closed = True
+        self._queue(None)
+
+    def _limits(self, settings):
+        """Return (min_fps, max_fps, bytes/s available to this client)"""
+        with _clients_lock:
+            count = max(1, len(_clients))
+        cap = float(settings.get('preview_max_bandwidth', DEFAULT_MAX_BANDWIDTH))
+        available = cap / count if cap > 0 else float('inf')
+        if self.bandwidth is not None:
+            available = min(available, self.bandwidth)
+        return (float(settings.get('preview_min_fps', DEFAULT_MIN_FPS)),
+                float(settings.get('preview_max_fps', DEFAULT_MAX_FPS)),
+                available)
+
+    def _estimate(self, tier):
+        """Expected frame size on a tier, in bytes, or None if unknown"""
+        if self.frame_size[tier]:
+            return self.frame_size[tier]
+        if tier != TIER_FULL and _tiers[tier].frame_size:
+            return _tiers[tier].frame_size
+        full_size = self.frame_size[TIER_FULL]
+        return full_size * _tiers[tier].size_ratio if full_size and tier != TIER_FULL else None
+
+    def _adapt(self, available):
+        """
+        Pick the best tier whose frames fit UPGRADE_FPS times a second in
+        the available bandwidth. Moving down only happens once the current
+        tier fits less than DOWNGRADE_FPS, so clients don't flap between two.
+        """
+        current = self._estimate(self.tier)
+        if not current or time.monotonic() - self.tier_since < TIER_HOLD:
+            return
+        target = TIER_ORDER[-1]
+        for tier in TIER_ORDER:
+            size = self._estimate(tier)
+            if size and available / size >= UPGRADE_FPS:
+                target = tier
+                break
+        if target == self.tier:
+            return
+        if TIER_ORDER.index(target) < TIER_ORDER.index(self.tier) or available / current < DOWNGRADE_FPS:
+            self._switch(target)
+
+    def frames(self):
+        """Yield multipart MJPEG chunks until the camera or the client goes away"""
+        last_sent = 0
+        window_start, window_bytes, window_time = time.monotonic(), 0, 0.0
+        while not self.closed:
+            frame = self._queue.get(timeout=FRAME_TIMEOUT)
+            if self.closed:
+                break
+            if frame is None:
+                if self.tier != TIER_FULL:
+                    # The shared tier stopped, carry on with full frames
+                    self._switch(TIER_FULL)
+                    continue
+                break
+
+            tier = self.tier
+            self.frame_size[tier] = _ewma(self.frame_size[tier], len(frame))
+
+            settings = load_settings()
+            rotated = bool(settings.get('webcam_rotation', 0))
+            if self.tier == TIER_FULL and rotated != (self._source is not None):
+                # Full frames only go through a tier while they need rotating
+                self._switch(TIER_FULL)
+                continue
+
+            # Only send as often as this client's share of bandwidth allows
+            min_fps, max_fps, available = self._limits(settings)
+            fps = max(min_fps, min(max_fps, available / self.frame_size[tier]))
+            now = time.monotonic()
+            if now - last_sent < 1.0 / fps:
+                continue
+            last_sent = now
+
+            chunk = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n'
+            # The server only returns from the yield once the chunk fits in
+            # its buffers, which web.py keeps small, so a slow client makes
+            # the yields wait. A buffer takes a frame or two without waiting
+            # and then holds up the next one for both, so the rate comes from
+            # the bytes and waits of a whole interval, not from single sends.
+            # Averaging time per byte keeps the intervals where nothing had
+            # to wait from swamping the ones that show the real rate.
+            start = time.monotonic()
+            yield chunk
+            window_bytes += len(chunk)
+            window_time += max(time.monotonic() - start, MIN_SEND_TIME)
+            if time.monotonic() - window_start >= MEASURE_INTERVAL:
+                self._send_cost = _ewma(self._send_cost, window_time / window_bytes)
+                self.bandwidth = 1 / self._send_cost
+                window_start, window_bytes, window_time = time.monotonic(), 0, 0.0
+            PREVIEW_BYTES_TOTAL.inc(len(chunk), tier=tier)
+            PREVIEW_FRAMES_TOTAL.inc(tier=tier)
+
+            self._adapt(available)
+
+
+def _on_settings_changed(changed, settings):
+    """Restart running tiers whose rotation, frame rate, scale or quality changed"""
+    for name, tier in _tiers.items():
+        keys = {'webcam_rotation', 'preview_max_fps', f'preview_{name}_scale', f'preview_{name}_quality'}
+        if keys & set(changed):
+            tier.restart()
+
+
+subscribe(_on_settings_changed)
+
+
+def stream_preview(broadcaster):
+    """Generator of multipart MJPEG chunks for one preview client"""
+    client = PreviewClient(broadcaster)
+    with _clients_lock:
+        _clients.add(client)
+    log(f"Preview client connected ({len(_clients)} clients)")
+    try:
+        yield from client.frames()
+    finally:
+        client._detach()
+        with _clients_lock:
+            _clients.discard(client)
+        log("Preview client disconnected")
+
+
+def close_all():
+    """End every open preview stream"""
+    with _clients_lock:
+        clients = list(_clients)
+    for client in clients:
+        client.close()
+
+
+def client_count(tier=None):
+    with _clients_lock:
+        return sum(1 for client in _clients if tier is None or client.tier == tier)
+
+
+gauge('photobooth_preview_clients', 'Connected preview clients', fn=client_count)
+gauge('photobooth_preview_low_tier_clients', 'Preview clients on a reduced quality tier',
+      fn=lambda: client_count() - client_count(TIER_FULL))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Background video processing for the Alleycat Photobooth.
+Runs a bounded pool of workers that move recorded clips from
+in -> processing -> out and queue them for upload, so the booth never
+waits on ffmpeg. Every step is journaled first (see journal.py), and clips
+a restart interrupted are resumed at the step they were on.
+"""
+
+import os
+import time
+import queue
+import threading
+from collections import deque
+from logit import log
+from settings import load_settings
+from camera import (process_video, clear_abandoned_captures, VIDEO_DIR_IN, VIDEO_DIR_PROC,
+                    VIDEO_DIR_OUT)
+from samba import queue_upload
+from thumbnails import generate_thumbnails
+from storage import encode_bitrate
+from catalog import (add_video, get_video, clip_id, update_video, STATE_PROCESSING,
+                     STATE_PROCESSED, STATE_FAILED, UPLOAD_QUEUED)
+from journal import (record_stage, add_attempt, finish, unfinished, durable_rename,
+                     capture_paths, STAGE_RECORDED, STAGE_CLAIMED, STAGE_ENCODED, STAGE_FAILED)
+from metrics import counter, gauge
+
+# Constants
+DEFAULT_WORKERS = 1       # The Pi only has one hardware encoder
+MAX_QUEUE_SIZE = 50       # Clips waiting to be processed
+JOB_HISTORY_SIZE = 20     # Finished jobs kept for the stats endpoint
+MAX_ATTEMPTS = 3          # Interrupted runs of a clip before it counts as failed
+
+# Global state
+_job_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+_workers = []
+_active_jobs = {}
+_finished_jobs = deque(maxlen=JOB_HISTORY_SIZE)
+_stats_lock = threading.Lock()
+_on_done = None
+
+# Metrics
+JOBS_TOTAL = counter('photobooth_processing_jobs_total', 'Processing jobs by result')
+gauge('photobooth_processing_queue_depth', 'Clips waiting to be processed', fn=_job_queue.qsize)
+gauge('photobooth_processing_active_jobs', 'Clips being processed', fn=lambda: len(_active_jobs))
+
+_stats = {
+    'enqueued': 0,
+    'completed': 0,
+    'failed': 0,
+}
+
+
+def _make_job(filename, player_data, stage, output=None):
+    return {
+        'filename': filename,
+        'player': player_data.get('neoId') if player_data else None,
+        'stage': stage,
+        'output': output,
+        'queued_at': time.time(),
+    }
+
+
+def enqueue_video(filename, player_data=None):
+    """
+    Queue a recorded clip for processing.
+
+    Args:
+        filename: Name of the clip inside VIDEO_DIR_IN
+        player_data: Optional RFID data of the player who recorded it
+
+    Returns:
+        True if the clip was queued, False if the queue is full
+    """
+    job = _make_job(filename, player_data, STAGE_RECORDED)
+    try:
+        _job_queue.put_nowait(job)
+    except queue.Full:
+        # Still journaled, the next start picks it up
+        log(f"Processing queue full, leaving {filename} in {VIDEO_DIR_IN}")
+        return False
+
+    with _stats_lock:
+        _stats['enqueued'] += 1
+    log(f"Queued {filename} for processing (depth={_job_queue.qsize()})")
+    return True
+
+
+def _run_job(job):
+    """
+    Take a clip through the rest of the pipeline from its journaled stage
+    and queue its upload. Returns True on success.
+    """
+    filename = job['filename']
+    in_path = os.path.join(VIDEO_DIR_IN, filename)
+    proc_path = os.path.join(VIDEO_DIR_PROC, filename)
+    # Processed clips are always H.264 MP4, whatever capture wrote
+    out_path = job.get('output') or os.path.join(VIDEO_DIR_OUT, os.path.splitext(filename)[0] + '.mp4')
+    part_path = os.path.join(VIDEO_DIR_OUT, f".{os.path.basename(out_path)}.part")
+    stage = job.get('stage', STAGE_RECORDED)
+
+    os.makedirs(VIDEO_DIR_PROC, exist_ok=True)
+    os.makedirs(VIDEO_DIR_OUT, exist_ok=True)
+    add_attempt(filename)
+
+    if stage == STAGE_RECORDED:
+        record_stage(filename, STAGE_CLAIMED)
+        stage = STAGE_CLAIMED
+
+    if stage == STAGE_CLAIMED:
+        # Claim the clip so nothing else picks it up from the in folder
+        if os.path.exists(in_path):
+            durable_rename(in_path, proc_path)
+        update_video(filename, state=STATE_PROCESSING, path=proc_path)
+
+        # Encode under a name tied to this clip, anything already there is
+        # what an interrupted run left behind. process_video only removes
+        # the input once the encode is on disk, so without an input the
+        # encode finished before the stage below could be journaled.
+        if os.path.exists(proc_path):
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            rotation = load_settings().get('webcam_rotation', 0)
+            start = time.time()
+            # Encodes shrink while the disk is nearly full
+            if not process_video(proc_path, part_path, rotation, encode_bitrate()):
+                record_stage(filename, STAGE_FAILED)
+                update_video(filename, state=STATE_FAILED)
+                return False
+            job['encode_time'] = time.time() - start
+        record_stage(filename, STAGE_ENCODED, output=out_path)
+        stage = STAGE_ENCODED
+
+    if stage == STAGE_ENCODED:
+        if os.path.exists(part_path):
+            durable_rename(part_path, out_path)
+        elif not os.path.exists(out_path):
+            log(f"Encode of {filename} is missing")
+            record_stage(filename, STAGE_FAILED)
+            update_video(filename, state=STATE_FAILED)
+            return False
+        update_video(filename, state=STATE_PROCESSED, path=out_path,
+                     filename=os.path.basename(out_path), codec='h264')
+
+    # Render the web UI's poster and preview once, while the clip is fresh
+    job['thumbnails'] = generate_thumbnails(out_path)
+
+    # The upload service retries on its own, the worker can move on. The
+    # status goes first, a fast upload would otherwise be marked queued again
+    update_video(filename, upload_status=UPLOAD_QUEUED)
+    job['upload_queued'] = queue_upload(out_path)
+    if job['upload_queued']:
+        finish(filename)
+    return True
+
+
+def _recover(entry):
+    """
+    Bring a journaled clip back to a state its stage can continue from.
+    Returns False if there is nothing left to continue.
+    """
+    filename = entry['filename']
+    in_path = os.path.join(VIDEO_DIR_IN, filename)
+    if entry['stage'] == STAGE_RECORDED and not os.path.exists(in_path):
+        # Capture finished but the move into the in folder didn't
+        if not (entry['temp_path'] and os.path.exists(entry['temp_path'])):
+            log(f"Recorded clip {filename} is gone, dropping it")
+            finish(filename)
+            return False
+        durable_rename(entry['temp_path'], in_path)
+    if entry['stage'] == STAGE_RECORDED and get_video(clip_id(filename)) is None:
+        add_video(filename, in_path, entry['player'])
+    return True
+
+
+def _resume_loop(jobs):
+    for job in jobs:
+        # Blocks while the queue is full, new clips still queue behind
+        _job_queue.put(job)
+        with _stats_lock:
+            _stats['enqueued'] += 1
+
+
+def resume_jobs():
+    """
+    Requeue the clips a previous run left unfinished, at the step each was
+    on, and clear out captures that never finished. Call after start_workers.
+
+    Returns:
+        Number of clips resumed
+    """
+    jobs = []
+    for entry in unfinished():
+        filename = entry['filename']
+        if entry['attempts'] >= MAX_ATTEMPTS:
+            log(f"Giving up on {filename} after {MAX_ATTEMPTS} interrupted attempts")
+            record_stage(filename, STAGE_FAILED)
+            update_video(filename, state=STATE_FAILED)
+            continue
+        try:
+            if _recover(entry):
+                jobs.append(_make_job(filename, entry['player'], entry['stage'], entry['output']))
+        except Exception as e:
+            log(f"Error recovering {filename}: {e}")
+    # A journaled capture that couldn't be recovered is the clip's only copy
+    clear_abandoned_captures(keep=capture_paths())
+
+    if jobs:
+        log(f"Resuming {len(jobs)} unfinished clip(s)")
+        thread = threading.Thread(target=_resume_loop, args=(jobs,), name="processing-resume")
+        thread.daemon = True
+        thread.start()
+    return len(jobs)
+
+
+def _worker_loop(worker_id):
+    """Consume jobs from the queue forever"""
+    while True:
+        job = _job_queue.get()
+        job['started_at'] = time.time()
+        job['wait_time'] = job['started_at'] - job['queued_at']
+        with _stats_lock:
+            _active_jobs[worker_id] = job
+
+        try:
+            ok = _run_job(job)
+        except Exception as e:
+            log(f"Error processing {job['filename']}: {e}")
+            ok = False
+
+        job['total_time'] = time.time() - job['started_at']
+        job['status'] = 'done' if ok else 'failed'
+        with _stats_lock:
+            _active_jobs.pop(worker_id, None)
+            _finished_jobs.append(job)
+            _stats['completed' if ok else 'failed'] += 1
+        JOBS_TOTAL.inc(result=job['status'])
+
+        log(f"Job {job['filename']} {job['status']} in {job['total_time']:.1f}s "
+            f"(waited {job['wait_time']:.1f}s)")
+        if _on_done:
+            _on_done(dict(job))
+        _job_queue.task_done()
+
+
+def start_workers(num_workers=None, on_done=None):
+    """
+    Start the processing worker pool if it isn't running yet.
+
+    Args:
+        num_workers: Pool size, defaults to the processing_workers setting
+        on_done: Optional callback called with each finished job
+    """
+    global _on_done
+    _on_done = on_done
+    if _workers:
+        return len(_workers)
+
+    if num_workers is None:
+        num_workers = load_settings().get('processing_workers', DEFAULT_WORKERS)
+    num_workers = max(1, int(num_workers))
+
+    for i in range(num_workers):
+        worker = threading.Thread(target=_worker_loop, args=(i,), name=f"processing-{i}")
+        worker.daemon = True
+        worker.start()
+        _workers.append(worker)
+
+    log(f"Started {num_workers} processing worker(s)")
+    return num_workers
+
+
+def get_queue_stats():
+    """Return queue depth, active jobs and timings of recently finished jobs"""
+    with _stats_lock:
+        return {
+            'workers': len(_workers),
+            'queue_depth': _job_queue.qsize(),
+            'active': list(_active_jobs.values()),
+            'recent': list(_finished_jobs),
+            **_stats,
+        }
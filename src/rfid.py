@@ -9,22 +9,91 @@ Usage:
 
 import sys
 import time
-import RPi.GPIO as GPIO
-from mfrc522 import MFRC522
+import threading
+from hal import GPIO, MFRC522, SIMULATED
 from logit import log, DEBUG
-import csv
-from datetime import datetime
+from settings import load_settings
+from scanlog import log_scan
+from metrics import counter, histogram
 
 # Define GPIO pins for MFRC522 connection
 RST_PIN = 22    # GPIO 22 (Pin 15)
+IRQ_PIN = 18    # GPIO 18 (Pin 12)
+
+# MFRC522 registers and commands used for card-detect interrupts
+COM_IEN_REG = 0x02
+COM_IRQ_REG = 0x04
+FIFO_DATA_REG = 0x09
+FIFO_LEVEL_REG = 0x0A
+BIT_FRAMING_REG = 0x0D
+COMMAND_REG = 0x01
+CMD_IDLE = 0x00
+CMD_TRANSCEIVE = 0x0C
+PICC_REQA = 0x26
 
 # NeoBand configuration
 NEOBAND_KEY_A = [0xA0, 0xA1, 0xA2, 0xA3, 0xA4, 0xA5]  # Key A for reading
 AUTH_MODE = 0x60  # Authentication mode
 
+# Fields stored on the band, by sector and block within the sector
+TAG_FIELDS = {
+    1: {0: 'role', 1: 'wins', 2: 'bestDrawTime'},
+    39: {0: 'name', 1: 'allegiance'},
+}
+
+# Scan modes
+MODE_POLL = 'poll'  # Run a full MFRC522_Request every SCAN_INTERVAL
+MODE_IRQ = 'irq'    # Send REQA write-only and sleep until the IRQ line fires
+
+# How often the reader is polled while scanning is enabled
+SCAN_INTERVAL = 0.1  # seconds
+IRQ_KICK_INTERVAL = 0.1  # seconds between REQA transmissions in IRQ mode
+IRQ_SAFETY_POLL = 2.0  # seconds between full polls in IRQ mode, in case the IRQ is missed
+IRQ_MAX_MISSES = 3  # cards found by the safety poll before falling back to polling
+
+# Metrics
+RFID_READ_SECONDS = histogram('photobooth_rfid_read_seconds', 'Time to read a band once detected',
+                              buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+RFID_SCANS_TOTAL = counter('photobooth_rfid_scans_total', 'Bands read')
+
 # Global reader instance
 _reader = None
 
+# Background scanner state
+_scanning = threading.Event()
+_scanner_thread = None
+_scan_mode = MODE_POLL
+_irq_event = threading.Event()
+_irq_misses = 0
+
+# Scan measurements, see get_scan_stats()
+_stats_lock = threading.Lock()
+_stats = {
+    'spi_transactions': 0,
+    'detections': 0,
+    'latency_total': 0.0,
+    'latency_max': 0.0,
+    'since': time.time(),
+    'last_read': None,
+}
+
+def _count_spi(reader):
+    """Wrap the reader's register access so every SPI transaction is counted"""
+    read, write = reader.Read_MFRC522, reader.Write_MFRC522
+
+    def counted_read(addr):
+        with _stats_lock:
+            _stats['spi_transactions'] += 1
+        return read(addr)
+
+    def counted_write(addr, val):
+        with _stats_lock:
+            _stats['spi_transactions'] += 1
+        return write(addr, val)
+
+    reader.Read_MFRC522 = counted_read
+    reader.Write_MFRC522 = counted_write
+
 def init_rfid():
     """Initialize the RFID reader"""
     global _reader
@@ -52,6 +121,7 @@ def init_rfid():
         
         # Configure antenna gain for optimal reading
         _reader.AntennaOn()
+        _count_spi(_reader)
         
         return _reader
     
@@ -59,20 +129,64 @@ def init_rfid():
         log(f"Error initializing RFID reader: {e}")
         return None
 
+def block_address(sector, block):
+    """Convert sector/block to an absolute block number on a MIFARE Classic 4K tag"""
+    # Sectors 0-31 have 4 blocks each, sectors 32-39 have 16
+    if sector < 32:
+        return sector * 4 + block
+    return 128 + (sector - 32) * 16 + block
+
 def read_block(reader, sector, block):
-    """Read a block from the RFID tag"""
+    """Read a block from the RFID tag. The sector must already be authenticated."""
     try:
-        # Read the block - MFRC522_Read takes block number (0-63)
-        block_num = sector * 4 + block  # Convert sector/block to absolute block number
-        (status, data) = reader.MFRC522_Read(block_num)
-        if status == reader.MI_OK:
+        block_num = block_address(sector, block)
+        data = reader.MFRC522_Read(block_num)
+        if data is not None and len(data) == 16:
             return data
-        log(f"Error reading block {block_num}: status={status}")
+        log(f"Error reading block {block_num}")
         return None
     except Exception as e:
         log(f"Error reading block: {e}")
         return None
 
+def read_sector(reader, uid, sector, blocks):
+    """
+    Authenticate a sector once with Key A and read several of its blocks.
+
+    Args:
+        reader: MFRC522 instance with the tag selected
+        uid: Tag UID from anticollision
+        sector: Sector number (0-39)
+        blocks: Block numbers within the sector to read
+
+    Returns:
+        Dict of block number -> 16 byte list (None for failed reads), or
+        None if authentication failed
+    """
+    status = reader.MFRC522_Auth(AUTH_MODE, block_address(sector, 0), NEOBAND_KEY_A, uid)
+    if status != reader.MI_OK:
+        log(f"Authentication failed for sector {sector}")
+        return None
+    return {block: read_block(reader, sector, block) for block in blocks}
+
+def read_tag(reader, uid):
+    """
+    Read every TAG_FIELDS field, one authenticated session per sector.
+
+    Returns:
+        (fields, timings) where fields maps field name to text (None if
+        unreadable) and timings maps each sector to its read time in seconds
+    """
+    fields = {}
+    timings = {}
+    for sector, blocks in TAG_FIELDS.items():
+        start = time.time()
+        data = read_sector(reader, uid, sector, blocks) or {}
+        timings[sector] = time.time() - start
+        for block, name in blocks.items():
+            fields[name] = hex_to_text(data.get(block))
+    return fields, timings
+
 def hex_to_text(hex_data):
     """Convert hex data to text"""
     if not hex_data:
@@ -86,18 +200,9 @@ def hex_to_text(hex_data):
         return None
 
 def log_rfid_scan(data):
-    """Log RFID scan to CSV file"""
+    """Queue an RFID scan for the background scan log writer"""
     try:
-        with open('/data/rfid_log.csv', 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                datetime.now().isoformat(),
-                data.get('neoId', ''),
-                data.get('name', ''),
-                data.get('role', ''),
-                data.get('allegiance', ''),
-                data.get('faction', '')
-            ])
+        log_scan(data)
     except Exception as e:
         log(f"Error logging RFID scan: {e}")
 
@@ -112,6 +217,8 @@ def scan_rfid():
             return None
     
     try:
+        scan_start = time.time()
+        
         # Look for cards
         (status, TagType) = _reader.MFRC522_Request(_reader.PICC_REQIDL)
         
@@ -127,34 +234,34 @@ def scan_rfid():
         # Format the UID
         neo_id = '-'.join([f"{x:02x}" for x in uid])
         
-        # Select the card
-        if _reader.MFRC522_SelectTag(uid) != _reader.MI_OK:
+        # Select the card (returns the SAK, 0 on failure)
+        if not _reader.MFRC522_SelectTag(uid):
             return None
         
-        # Read role (Sector 1, Block 0)
-        role_data = read_block(_reader, 1, 0)
-        role = hex_to_text(role_data) if role_data else 'bounty'
-        
-        # Read name (Sector 39, Block 0)
-        name_data = read_block(_reader, 39, 0)
-        name = hex_to_text(name_data) if name_data else 'Unknown'
-        
-        # Read allegiance (Sector 39, Block 1)
-        allegiance_data = read_block(_reader, 39, 1)
-        allegiance = hex_to_text(allegiance_data) if allegiance_data else 'Unknown'
-        
-        # Determine faction
-        faction = f"faction{uid[0] % 31 + 1}"
+        # Read all fields, authenticating each sector once
+        spi_before = _stats['spi_transactions']
+        fields, timings = read_tag(_reader, uid)
         
         # Halt the card
         _reader.MFRC522_StopCrypto1()
         
+        RFID_READ_SECONDS.observe(time.time() - scan_start)
+        RFID_SCANS_TOTAL.inc()
+        with _stats_lock:
+            _stats['last_read'] = {
+                'sectors': timings,
+                'total': time.time() - scan_start,
+                'spi_transactions': _stats['spi_transactions'] - spi_before,
+            }
+        
         data = {
-            "role": role,
-            "name": name,
-            "allegiance": allegiance,
+            "role": fields['role'] or 'bounty',
+            "name": fields['name'] or 'Unknown',
+            "allegiance": fields['allegiance'] or 'Unknown',
             "neoId": neo_id,
-            "faction": faction
+            "faction": f"faction{uid[0] % 31 + 1}",
+            "wins": fields['wins'],
+            "bestDrawTime": fields['bestDrawTime'],
         }
         
         log_rfid_scan(data)
@@ -164,6 +271,151 @@ def scan_rfid():
         log(f"Error reading RFID: {e}")
     return None
 
+def set_scanning(enabled):
+    """Enable or pause the background scanner"""
+    if enabled:
+        _scanning.set()
+    else:
+        _scanning.clear()
+
+def _on_irq(channel):
+    """GPIO callback for the reader's IRQ line"""
+    _irq_event.set()
+
+def init_irq():
+    """Set up the card-detect interrupt. Returns True if IRQ mode can be used."""
+    try:
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(IRQ_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(IRQ_PIN, GPIO.FALLING, callback=_on_irq)
+        return True
+    except Exception as e:
+        log(f"Error setting up RFID IRQ on GPIO {IRQ_PIN}: {e}")
+        return False
+
+def wait_for_card(timeout):
+    """
+    Wait for a card using the reader's receive interrupt.
+
+    The MFRC522 cannot sense a card on its own, so REQA is still sent every
+    IRQ_KICK_INTERVAL, but only as a few register writes. Nothing is read
+    back over SPI until a card answers and the IRQ line goes low.
+
+    Returns:
+        The time the IRQ fired, or None on timeout
+    """
+    if _reader is None and init_rfid() is None:
+        time.sleep(timeout)
+        return None
+
+    # Route only RxIRq to the (active low) IRQ pin and clear stale requests
+    _reader.Write_MFRC522(COM_IEN_REG, 0xA0)
+    _reader.Write_MFRC522(COM_IRQ_REG, 0x7F)
+    _irq_event.clear()
+
+    deadline = time.time() + timeout
+    while time.time() < deadline and _scanning.is_set():
+        _reader.Write_MFRC522(FIFO_LEVEL_REG, 0x80)  # Flush the FIFO
+        _reader.Write_MFRC522(FIFO_DATA_REG, PICC_REQA)
+        _reader.Write_MFRC522(COMMAND_REG, CMD_TRANSCEIVE)
+        _reader.Write_MFRC522(BIT_FRAMING_REG, 0x87)  # StartSend, 7 bit frame
+        if _irq_event.wait(IRQ_KICK_INTERVAL):
+            fired_at = time.time()
+            _reader.Write_MFRC522(COMMAND_REG, CMD_IDLE)
+            return fired_at
+
+    _reader.Write_MFRC522(COMMAND_REG, CMD_IDLE)
+    return None
+
+def _record_detection(started):
+    """Record band-to-detection latency measured from started"""
+    latency = time.time() - started
+    with _stats_lock:
+        _stats['detections'] += 1
+        _stats['latency_total'] += latency
+        _stats['latency_max'] = max(_stats['latency_max'], latency)
+
+def _scan_once():
+    """Run one detection cycle in the current mode and return band data or None"""
+    global _scan_mode, _irq_misses
+
+    if _scan_mode == MODE_IRQ:
+        fired_at = wait_for_card(IRQ_SAFETY_POLL)
+        started = fired_at or time.time()
+        data = scan_rfid()
+        if data and fired_at is None:
+            # The safety poll found a card the interrupt never reported
+            _irq_misses += 1
+            if _irq_misses >= IRQ_MAX_MISSES:
+                log("RFID IRQ line not firing, falling back to polling")
+                _scan_mode = MODE_POLL
+        elif data:
+            _irq_misses = 0
+    else:
+        # A band arrives on average half an interval before the poll sees it
+        started = time.time() - SCAN_INTERVAL / 2
+        data = scan_rfid()
+
+    if data:
+        _record_detection(started)
+    return data
+
+def _scanner_loop(on_scan):
+    """Look for bands while scanning is enabled"""
+    while True:
+        # Block without touching the SPI bus while scanning is paused
+        _scanning.wait()
+        data = _scan_once()
+        if data and _scanning.is_set():
+            # One detection per enable, the booth re-enables when it is ready
+            _scanning.clear()
+            on_scan(data)
+        elif _scan_mode == MODE_POLL:
+            time.sleep(SCAN_INTERVAL)
+
+def get_scan_stats():
+    """Return the scan mode, SPI transactions per hour and detection latency"""
+    with _stats_lock:
+        elapsed = max(time.time() - _stats['since'], 1e-6)
+        detections = _stats['detections']
+        return {
+            'mode': _scan_mode,
+            'spi_transactions': _stats['spi_transactions'],
+            'spi_per_hour': _stats['spi_transactions'] * 3600 / elapsed,
+            'detections': detections,
+            'latency_avg': _stats['latency_total'] / detections if detections else None,
+            'latency_max': _stats['latency_max'],
+            'elapsed': elapsed,
+            'last_read': _stats['last_read'],
+        }
+
+def reset_scan_stats():
+    """Start a new measurement window"""
+    with _stats_lock:
+        _stats.update(spi_transactions=0, detections=0, latency_total=0.0,
+                      latency_max=0.0, since=time.time())
+
+def start_scanner(on_scan, mode=None):
+    """
+    Start the background scanner thread.
+
+    Args:
+        on_scan: Called with the band data from the scanner thread
+        mode: MODE_IRQ or MODE_POLL, defaults to the rfid_mode setting.
+            IRQ mode falls back to polling if the interrupt can't be set up.
+    """
+    global _scanner_thread, _scan_mode
+    if _scanner_thread is not None:
+        return
+    if mode is None:
+        mode = load_settings().get('rfid_mode', MODE_IRQ)
+    _scan_mode = MODE_IRQ if mode == MODE_IRQ and init_irq() else MODE_POLL
+    log(f"RFID scan mode: {_scan_mode}")
+    _scanner_thread = threading.Thread(target=_scanner_loop, args=(on_scan,), name="rfid-scanner")
+    _scanner_thread.daemon = True
+    _scanner_thread.start()
+    log("RFID scanner started")
+
 def cleanup():
     """Clean up GPIO pins"""
     GPIO.cleanup()
@@ -196,9 +448,42 @@ def main():
             # Always clean up
             cleanup()
     
+    elif command == "bench":
+        # Measure SPI load and detection latency of one scan mode. Poll and
+        # irq have not been compared on a Pi yet, the simulated reader
+        # doesn't count SPI traffic or time like a real one.
+        mode = sys.argv[2] if len(sys.argv) > 2 else MODE_POLL
+        duration = float(sys.argv[3]) if len(sys.argv) > 3 else 60
+        if SIMULATED:
+            log("Simulated reader, these numbers say nothing about a real MFRC522")
+        
+        try:
+            if init_rfid() is None:
+                sys.exit(2)
+            def on_scan(data):
+                log(f"Detected {data['neoId']}")
+                set_scanning(True)  # Keep measuring after each band
+            
+            start_scanner(on_scan, mode)
+            reset_scan_stats()
+            set_scanning(True)
+            time.sleep(duration)
+            set_scanning(False)
+            
+            stats = get_scan_stats()
+            log(f"Mode: {stats['mode']}")
+            log(f"SPI transactions: {stats['spi_transactions']} "
+                f"({stats['spi_per_hour']:.0f}/hour)")
+            if stats['detections']:
+                log(f"Detections: {stats['detections']}, latency avg "
+                    f"{stats['latency_avg'] * 1000:.0f} ms, max {stats['latency_max'] * 1000:.0f} ms")
+        finally:
+            cleanup()
+    
     else:
         log("Usage:")
         log("  python rfid.py scan [timeout]")
+        log("  python rfid.py bench [poll|irq] [seconds]")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -1,63 +1,341 @@
 #!/usr/bin/env python3
 """
 Samba file sharing functionality for the Alleycat Photobooth.
+
+Uploads go through a background service that keeps one authenticated
+connection open, sends files in chunks that can be resumed, and keeps
+failed uploads in an on-disk retry queue with backoff. While no share is
+configured uploads stay queued, untried, until the settings change.
 """
 
+import io
 import os
+import json
+import time
+import threading
 from smb.SMBConnection import SMBConnection
+from smb.smb_structs import OperationFailure
 from logit import log
-from settings import load_settings
+from settings import load_settings, subscribe, DATA_DIR
+from metrics import counter, gauge, histogram, timed
+from catalog import record_upload
 
-def copy_to_samba(local_file):
-    """Copy a local file to the Samba share"""
-    if not os.path.exists(local_file):
-        log(f"Local file does not exist: {local_file}")
+# Constants
+UPLOAD_QUEUE_FILE = os.path.join(DATA_DIR, 'upload_queue.json')
+CHUNK_SIZE = 1024 * 1024       # bytes sent per storeFileFromOffset call
+RETRY_BASE_DELAY = 5           # seconds before the first retry
+RETRY_MAX_DELAY = 600          # seconds between retries at most
+KEEPALIVE_INTERVAL = 60        # seconds idle before the connection is checked
+PARTIAL_SUFFIX = '.part'       # remote name while an upload is incomplete
+SAMBA_SETTINGS = {'samba_share', 'samba_username', 'samba_password'}
+
+# Metrics
+UPLOAD_SECONDS = histogram('photobooth_upload_seconds', 'Time to upload a clip to the Samba share')
+UPLOADS_TOTAL = counter('photobooth_uploads_total', 'Upload attempts by result')
+UPLOAD_BYTES_TOTAL = counter('photobooth_upload_bytes_total', 'Bytes sent to the Samba share')
+
+# Global state
+_conn = None
+_conn_key = None
+_conn_last_used = 0
+_conn_lock = threading.Lock()
+_queue = []
+_queue_cond = threading.Condition()
+_uploader_thread = None
+_stats = {
+    'uploaded': 0,
+    'failed_attempts': 0,
+    'bytes': 0,
+    'last_error': None,
+    'last_upload_time': None,
+    'paused': False,
+}
+
+
+def parse_share(samba_share):
+    """Parse smb://server[:port]/share into (server, port, share)"""
+    parts = samba_share.replace('smb://', '').split('/')
+    if len(parts) < 2 or not parts[1]:
+        raise ValueError(f"Invalid Samba share format: {samba_share}")
+    server_port = parts[0].split(':')
+    server = server_port[0]
+    port = int(server_port[1]) if len(server_port) > 1 else 445
+    return server, port, parts[1]
+
+
+def share_configured(settings):
+    """True if the settings name a share uploads can go to"""
+    try:
+        parse_share(settings.get('samba_share', ''))
+        return True
+    except ValueError:
         return False
-        
-    settings = load_settings()
+
+
+def _close_connection():
+    global _conn, _conn_key
+    if _conn is not None:
+        try:
+            _conn.close()
+        except Exception:
+            pass
+    _conn = None
+    _conn_key = None
+
+
+def _get_connection(settings):
+    """
+    Return the pooled connection and share name, reconnecting if the
+    settings changed or the connection went stale.
+    """
+    global _conn, _conn_key, _conn_last_used
+
     samba_share = settings.get("samba_share", "")
     if not samba_share:
-        log("No Samba share configured")
+        raise ValueError("No Samba share configured")
+    server, port, share = parse_share(samba_share)
+    username = settings.get('samba_username', 'guest')
+    password = settings.get('samba_password', '')
+    key = (server, port, username, password)
+
+    if _conn is not None and _conn_key == key:
+        if time.time() - _conn_last_used < KEEPALIVE_INTERVAL:
+            return _conn, share
+        try:
+            _conn.echo(b'alleycat')
+            return _conn, share
+        except Exception:
+            log("Samba connection went stale, reconnecting")
+
+    _close_connection()
+    conn = SMBConnection(
+        username,
+        password,
+        'alleycat-photobooth',
+        server,
+        use_ntlm_v2=True
+    )
+    if not conn.connect(server, port):
+        raise ConnectionError("Failed to connect to Samba server")
+    _conn, _conn_key = conn, key
+    _conn_last_used = time.time()
+    log(f"Connected to Samba server {server}:{port}")
+    return _conn, share
+
+
+def _remote_size(conn, share, path):
+    """Return the size of a remote file, or None if it doesn't exist"""
+    try:
+        return conn.getAttributes(share, path).file_size
+    except OperationFailure:
+        return None
+
+
+@timed(UPLOAD_SECONDS)
+def _upload(local_file):
+    """Upload one file over the pooled connection, resuming a partial upload"""
+    global _conn_last_used
+
+    settings = load_settings()
+    filename = os.path.basename(local_file)
+    partial = filename + PARTIAL_SUFFIX
+    size = os.path.getsize(local_file)
+
+    with _conn_lock:
+        try:
+            conn, share = _get_connection(settings)
+
+            # Pick up where a previous attempt stopped
+            offset = _remote_size(conn, share, partial) or 0
+            if offset > size:
+                offset = 0
+            if offset:
+                log(f"Resuming upload of {filename} at {offset}/{size} bytes")
+
+            with open(local_file, 'rb') as f:
+                f.seek(offset)
+                truncate = offset == 0
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk and not truncate:
+                        break
+                    conn.storeFileFromOffset(share, partial, io.BytesIO(chunk),
+                                             offset=offset, truncate=truncate)
+                    truncate = False
+                    offset += len(chunk)
+                    _conn_last_used = time.time()
+                    _stats['bytes'] += len(chunk)
+                    UPLOAD_BYTES_TOTAL.inc(len(chunk))
+
+            # Only a complete file gets its real name
+            if _remote_size(conn, share, filename) is not None:
+                conn.deleteFiles(share, filename)
+            conn.rename(share, partial, filename)
+            _conn_last_used = time.time()
+            UPLOADS_TOTAL.inc(result='ok')
+        except Exception:
+            UPLOADS_TOTAL.inc(result='failed')
+            # Don't reuse a connection that failed mid-transfer
+            _close_connection()
+            raise
+
+
+def copy_to_samba(local_file):
+    """Copy a local file to the Samba share right away"""
+    if not os.path.exists(local_file):
+        log(f"Local file does not exist: {local_file}")
         return False
-    
+
     try:
-        # Parse the share URL (format: smb://server:port/share)
-        parts = samba_share.replace('smb://', '').split('/')
-        if len(parts) < 2:
-            log("Invalid Samba share format")
-            return False
-            
-        server_port = parts[0].split(':')
-        server = server_port[0]
-        port = int(server_port[1]) if len(server_port) > 1 else 445
-        share = parts[1]
-        
-        # Create SMB connection
-        conn = SMBConnection(
-            settings.get('samba_username', 'guest'),
-            settings.get('samba_password', ''),
-            'alleycat-photobooth',
-            server,
-            use_ntlm_v2=True
-        )
-        
-        # Connect and copy file
-        if not conn.connect(server, port):
-            log("Failed to connect to Samba server")
-            return False
-            
-        with open(local_file, 'rb') as file:
-            filename = os.path.basename(local_file)
-            conn.storeFile(share, filename, file)
-            
-        log(f"Successfully copied {filename} to Samba share")
+        _upload(local_file)
+        log(f"Successfully copied {os.path.basename(local_file)} to Samba share")
         return True
-        
     except Exception as e:
         log(f"Error copying to Samba share: {e}")
         return False
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
\ No newline at end of file
+
+
+def _load_queue():
+    """Read the retry queue left by a previous run"""
+    try:
+        with open(UPLOAD_QUEUE_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        log(f"Error loading upload queue: {e}")
+        return []
+
+
+def _save_queue():
+    """Persist the retry queue atomically. Caller holds _queue_cond."""
+    try:
+        os.makedirs(os.path.dirname(UPLOAD_QUEUE_FILE), exist_ok=True)
+        tmp_path = UPLOAD_QUEUE_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(_queue, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, UPLOAD_QUEUE_FILE)
+    except Exception as e:
+        log(f"Error saving upload queue: {e}")
+
+
+def queue_upload(local_file):
+    """Add a file to the upload queue. Returns immediately."""
+    start_uploader()
+    with _queue_cond:
+        if any(entry['path'] == local_file for entry in _queue):
+            return True
+        _queue.append({
+            'path': local_file,
+            'attempts': 0,
+            'next_attempt': 0,
+            'queued_at': time.time(),
+            'last_error': None,
+        })
+        _save_queue()
+        _queue_cond.notify()
+    log(f"Queued {os.path.basename(local_file)} for upload")
+    return True
+
+
+def _next_due():
+    """Return the first due entry, or None and how long to wait. Caller holds _queue_cond."""
+    now = time.time()
+    wait = None
+    for entry in _queue:
+        if entry['next_attempt'] <= now:
+            return entry, 0
+        delay = entry['next_attempt'] - now
+        wait = delay if wait is None else min(wait, delay)
+    return None, wait
+
+
+def _uploader_loop():
+    """Drain the upload queue, backing off on failures"""
+    while True:
+        configured = share_configured(load_settings())
+        with _queue_cond:
+            entry, wait = _next_due()
+            if entry is not None and not configured:
+                # Retrying won't fix the settings, wait until they change
+                if not _stats['paused']:
+                    log("No Samba share configured, holding uploads until one is set")
+                _stats['paused'] = True
+                entry, wait = None, None
+            if entry is None:
+                _queue_cond.wait(wait)
+                continue
+            _stats['paused'] = False
+
+        path = entry['path']
+        if not os.path.exists(path):
+            log(f"Dropping upload of missing file {path}")
+            ok = True
+        else:
+            start = time.time()
+            try:
+                _upload(path)
+                ok = True
+                _stats['uploaded'] += 1
+                _stats['last_upload_time'] = time.time() - start
+                log(f"Uploaded {os.path.basename(path)} in {_stats['last_upload_time']:.1f}s")
+            except Exception as e:
+                ok = False
+                _stats['failed_attempts'] += 1
+                _stats['last_error'] = str(e)
+                log(f"Error uploading {os.path.basename(path)}: {e}")
+            record_upload(path, ok)
+
+        with _queue_cond:
+            if ok:
+                _queue.remove(entry)
+            else:
+                entry['attempts'] += 1
+                entry['last_error'] = _stats['last_error']
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (entry['attempts'] - 1))
+                entry['next_attempt'] = time.time() + delay
+            _save_queue()
+
+
+def start_uploader():
+    """Start the upload service, picking up uploads queued before a restart"""
+    global _uploader_thread
+    with _queue_cond:
+        if _uploader_thread is not None:
+            return
+        _queue.extend(_load_queue())
+        # Retry everything left over right away
+        for entry in _queue:
+            entry['next_attempt'] = 0
+        _uploader_thread = threading.Thread(target=_uploader_loop, name="samba-uploader")
+        _uploader_thread.daemon = True
+        _uploader_thread.start()
+    if _queue:
+        log(f"Resuming {len(_queue)} queued upload(s)")
+
+
+def _on_settings_changed(changed, settings):
+    """Retry queued uploads right away with a new share or credentials"""
+    if not set(changed) & SAMBA_SETTINGS:
+        return
+    with _queue_cond:
+        for entry in _queue:
+            entry['next_attempt'] = 0
+        _queue_cond.notify()
+
+
+subscribe(_on_settings_changed)
+
+gauge('photobooth_upload_queue_depth', 'Clips waiting to be uploaded', fn=lambda: len(_queue))
+
+
+def get_upload_stats():
+    """Return the upload queue and transfer counters"""
+    with _queue_cond:
+        return {
+            'queue_depth': len(_queue),
+            'queue': [dict(entry) for entry in _queue],
+            **_stats,
+        }
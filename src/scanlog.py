@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+RFID scan log for the Alleycat Photobooth.
+Scans are queued and written in batches by a background thread to a rotating
+CSV log and to an indexed SQLite table, so the booth thread never touches
+the USB drive and band lookups don't need to read the whole CSV.
+"""
+
+import os
+import csv
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from datetime import datetime
+from logit import log
+from settings import load_settings, DATA_DIR
+from fleet import record_events
+
+# Constants
+SCAN_LOG_FILE = os.path.join(DATA_DIR, 'rfid_log.csv')
+SCAN_DB_FILE = os.path.join(DATA_DIR, 'rfid_scans.db')
+DEFAULT_FLUSH_INTERVAL = 2.0   # seconds a scan may wait before it is written
+DEFAULT_BATCH_SIZE = 50        # scans written per batch at most
+DEFAULT_FSYNC = True           # fsync the CSV after every batch
+DEFAULT_MAX_LOG_BYTES = 5 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5       # rotated logs kept as rfid_log.csv.1 .. .N
+
+# Global state
+_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_db_lock = threading.Lock()
+_db = None
+
+
+def _connect():
+    """Open the scan database, creating the table and index if needed"""
+    os.makedirs(os.path.dirname(SCAN_DB_FILE), exist_ok=True)
+    conn = sqlite3.connect(SCAN_DB_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scans (
+            id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            neo_id TEXT NOT NULL,
+            name TEXT,
+            role TEXT,
+            allegiance TEXT,
+            faction TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS scans_neo_id_ts ON scans (neo_id, ts)")
+    conn.commit()
+    return conn
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        _db = _connect()
+    return _db
+
+
+def _rotate(max_bytes, backup_count):
+    """Rotate the CSV log once it grows past max_bytes"""
+    try:
+        if os.path.getsize(SCAN_LOG_FILE) < max_bytes:
+            return
+    except OSError:
+        return
+
+    for i in range(backup_count - 1, 0, -1):
+        src = f"{SCAN_LOG_FILE}.{i}"
+        if os.path.exists(src):
+            os.replace(src, f"{SCAN_LOG_FILE}.{i + 1}")
+    os.replace(SCAN_LOG_FILE, f"{SCAN_LOG_FILE}.1")
+    log(f"Rotated {SCAN_LOG_FILE}")
+
+
+def _write_batch(batch, settings):
+    """Append a batch of scans to the CSV log and the database"""
+    try:
+        with open(SCAN_LOG_FILE, 'a', newline='') as f:
+            writer = csv.writer(f)
+            for ts, data in batch:
+                writer.writerow([
+                    datetime.fromtimestamp(ts).isoformat(),
+                    data.get('neoId', ''),
+                    data.get('name', ''),
+                    data.get('role', ''),
+                    data.get('allegiance', ''),
+                    data.get('faction', '')
+                ])
+            f.flush()
+            if settings.get('scanlog_fsync', DEFAULT_FSYNC):
+                os.fsync(f.fileno())
+        _rotate(int(settings.get('scanlog_max_bytes', DEFAULT_MAX_LOG_BYTES)),
+                int(settings.get('scanlog_backup_count', DEFAULT_BACKUP_COUNT)))
+    except Exception as e:
+        log(f"Error writing RFID scan log: {e}")
+
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.executemany(
+                    "INSERT INTO scans (ts, neo_id, name, role, allegiance, faction) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(ts, data.get('neoId', ''), data.get('name'), data.get('role'),
+                      data.get('allegiance'), data.get('faction'))
+                     for ts, data in batch])
+    except Exception as e:
+        log(f"Error writing RFID scan database: {e}")
+
+    record_events('scan', [{'ts': ts, **data} for ts, data in batch])
+
+
+def _writer_loop():
+    """Collect scans into batches and write them"""
+    while True:
+        batch = [_queue.get()]
+        settings = load_settings()
+        deadline = time.time() + float(settings.get('scanlog_flush_interval', DEFAULT_FLUSH_INTERVAL))
+        batch_size = int(settings.get('scanlog_batch_size', DEFAULT_BATCH_SIZE))
+
+        # Keep collecting until the batch is full or the first scan has waited long enough
+        while len(batch) < batch_size and batch[-1] is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        # None is a flush request, see flush()
+        waiters = [item for item in batch if item is None]
+        records = [item for item in batch if item is not None]
+        if records:
+            _write_batch(records, settings)
+        for _ in waiters:
+            _queue.task_done()
+        for _ in records:
+            _queue.task_done()
+
+
+def start_writer():
+    """Start the background writer thread if it isn't running yet"""
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is not None:
+            return
+        _writer_thread = threading.Thread(target=_writer_loop, name="scanlog-writer")
+        _writer_thread.daemon = True
+        _writer_thread.start()
+        atexit.register(flush)
+
+
+def log_scan(data):
+    """Queue an RFID scan to be logged. Never blocks on disk."""
+    start_writer()
+    _queue.put((time.time(), dict(data)))
+
+
+def flush():
+    """Write out every queued scan and wait until it is on disk"""
+    if _writer_thread is None:
+        return
+    _queue.put(None)
+    _queue.join()
+
+
+def last_scan(neo_id):
+    """
+    Return the most recent scan of a band.
+
+    Returns:
+        Dict with the scan fields and an ISO timestamp, or None if the band
+        has never been scanned
+    """
+    with _db_lock:
+        row = _get_db().execute(
+            "SELECT ts, neo_id, name, role, allegiance, faction FROM scans "
+            "WHERE neo_id = ? ORDER BY ts DESC LIMIT 1", (neo_id,)).fetchone()
+    if row is None:
+        return None
+    return {
+        'timestamp': datetime.fromtimestamp(row[0]).isoformat(),
+        'neoId': row[1],
+        'name': row[2],
+        'role': row[3],
+        'allegiance': row[4],
+        'faction': row[5],
+    }
+
+
+def scan_count(neo_id):
+    """Return how many times a band has been scanned"""
+    with _db_lock:
+        return _get_db().execute(
+            "SELECT COUNT(*) FROM scans WHERE neo_id = ?", (neo_id,)).fetchone()[0]
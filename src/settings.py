@@ -1,33 +1,111 @@
 import os
 import json
+import tempfile
+import threading
 from logit import log
 
 # Constants
-DATA_DIR = "/data"
+DATA_DIR = os.environ.get("PHOTOBOOTH_DATA_DIR", "/data")
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
 
-def load_settings(force_reload=True):
+# Global state
+_settings = {}
+_file_key = None  # (mtime_ns, size) of the file _settings was read from
+_lock = threading.Lock()
+_subscribers = []
+
+def _stat_key():
+    """Return (mtime_ns, size) of the settings file, or None if it is missing"""
+    try:
+        st = os.stat(SETTINGS_FILE)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def _update(settings, key):
+    """Replace the cached settings and return the keys whose values changed"""
+    global _settings, _file_key
+    changed = {k: settings.get(k) for k in set(_settings) | set(settings)
+               if _settings.get(k) != settings.get(k)}
+    _settings = settings
+    _file_key = key
+    return changed
+
+def _notify(changed, settings):
+    """Call subscribers with the changed values"""
+    if not changed:
+        return
+    log(f"Settings changed: {sorted(changed)}")
+    for callback in list(_subscribers):
+        try:
+            callback(changed, dict(settings))
+        except Exception as e:
+            log(f"Error in settings subscriber: {e}")
+
+def subscribe(callback):
+    """
+    Register a callback for settings changes.
+
+    Args:
+        callback: Called as callback(changed, settings) where changed maps
+            each changed key to its new value (None if removed)
+    """
+    _subscribers.append(callback)
+    return callback
+
+def load_settings(force_reload=False):
     """Load settings from JSON file
-    
+
     Args:
-        force_reload (bool): If True, always read from disk. If False, may use cached values.
+        force_reload (bool): If True, always read from disk. If False, the cached
+            values are used unless the file's mtime or size changed.
     """
-    if os.path.exists(SETTINGS_FILE):
-        try:
-            with open(SETTINGS_FILE, 'r') as f:
-                settings = json.load(f)
-                return settings
-        except Exception as e:
-            log(f"Error loading settings: {e}")
-    return {}
+    key = _stat_key()
+    with _lock:
+        if not force_reload and key == _file_key:
+            return dict(_settings)
+
+        settings = {}
+        if key is not None:
+            try:
+                with open(SETTINGS_FILE, 'r') as f:
+                    settings = json.load(f)
+            except Exception as e:
+                # Keep serving the last good settings, e.g. mid-edit on the USB drive
+                log(f"Error loading settings: {e}")
+                return dict(_settings)
+
+        changed = _update(settings, key)
+        current = dict(_settings)
+
+    _notify(changed, current)
+    return current
 
 def save_settings(settings):
-    """Save settings to JSON file"""
+    """Save settings to JSON file atomically"""
+    tmp_path = None
     try:
         os.makedirs(DATA_DIR, exist_ok=True)
-        with open(SETTINGS_FILE, 'w') as f:
+
+        # Write next to the real file and rename over it, so a power cut
+        # leaves either the old or the new settings, never half of one
+        fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".settings-", suffix=".json")
+        with os.fdopen(fd, 'w') as f:
             json.dump(settings, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+
+        with _lock:
+            os.replace(tmp_path, SETTINGS_FILE)
+            tmp_path = None
+            changed = _update(dict(settings), _stat_key())
+            current = dict(_settings)
+
+        _notify(changed, current)
         return True
     except Exception as e:
         log(f"Error saving settings: {e}")
-        return False
\ No newline at end of file
+        return False
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
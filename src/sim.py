@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Simulated hardware for the Alleycat Photobooth.
+
+Stand-ins for RPi.GPIO, the MFRC522 reader and the I2C LCD, driven by a
+scripted stream of band scans and button presses, so the whole booth can run
+headless on a Linux box. Selected with PHOTOBOOTH_HARDWARE=sim, see hal.py.
+
+Script format (PHOTOBOOTH_SIM_SCRIPT), one event per line, each delay in
+seconds after the previous event:
+
+    # delay  event   arguments
+    2.0      band    04-a1-b2-c3-d4 Alice bounty
+    1.0      button
+    10.0     repeat
+
+'repeat' starts the script over. Without a script, a new player scans a band
+and presses the button every PHOTOBOOTH_SIM_INTERVAL seconds (default 12).
+"""
+
+import os
+import time
+import random
+import threading
+from logit import log
+
+# Constants
+BAND_PRESENT_TIME = 1.0  # seconds a band stays on the reader
+BUTTON_PRESS_TIME = 0.1  # seconds the button is held down
+DEFAULT_INTERVAL = 12.0  # seconds between players without a script
+MI_OK = 0
+MI_NOTAGERR = 1
+MI_ERR = 2
+
+
+class SimGPIO:
+    """Minimal RPi.GPIO replacement that keeps pin states in memory"""
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self._levels = {}
+        self._callbacks = {}
+        self._edges = {}
+        self._lock = threading.Lock()
+        self.writes = 0
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        with self._lock:
+            if mode == self.IN:
+                self._levels[pin] = self.LOW if pull_up_down == self.PUD_DOWN else self.HIGH
+            else:
+                self._levels[pin] = initial if initial is not None else self.LOW
+
+    def output(self, pin, value):
+        with self._lock:
+            self._levels[pin] = value
+            self.writes += 1
+
+    def input(self, pin):
+        with self._lock:
+            return self._levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            self._callbacks[pin] = (edge, callback)
+            self._edges[pin] = threading.Event()
+        start_script()
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._callbacks.pop(pin, None)
+
+    def wait_for_edge(self, pin, edge, timeout=None):
+        with self._lock:
+            event = self._edges.setdefault(pin, threading.Event())
+        fired = event.wait(None if timeout is None else timeout / 1000)
+        event.clear()
+        return pin if fired else None
+
+    def cleanup(self, *args):
+        with self._lock:
+            self._callbacks.clear()
+
+    def drive(self, pin, value):
+        """Set an input pin from the outside and fire any edge callback"""
+        with self._lock:
+            old = self._levels.get(pin, self.HIGH)
+            self._levels[pin] = value
+            edge, callback = self._callbacks.get(pin, (None, None))
+            event = self._edges.get(pin)
+        if old == value:
+            return
+        falling = value == self.LOW
+        if edge == self.BOTH or (edge == self.FALLING) == falling:
+            if event:
+                event.set()
+            if callback:
+                callback(pin)
+
+
+GPIO = SimGPIO()
+
+
+def _block_text(text):
+    """Encode text as a 16 byte block"""
+    data = list(text.encode('utf-8')[:16])
+    return data + [0] * (16 - len(data))
+
+
+class MFRC522:
+    """MFRC522 replacement that reports the band currently on the reader"""
+
+    VersionReg = 0x37
+    MI_OK = MI_OK
+    MI_NOTAGERR = MI_NOTAGERR
+    MI_ERR = MI_ERR
+    PICC_REQIDL = 0x26
+    PICC_AUTHENT1A = 0x60
+    BIT_FRAMING_REG = 0x0D
+
+    def __init__(self, bus=0, device=0, spd=1000000, pin_mode=10, pin_rst=-1, debugLevel='WARNING'):
+        self.irq_pin = None
+
+    def Read_MFRC522(self, addr):
+        if addr == self.VersionReg:
+            return 0x92
+        return 0
+
+    def Write_MFRC522(self, addr, val):
+        # An IRQ-mode REQA kick wakes the scanner if a band is present
+        if addr == self.BIT_FRAMING_REG and val == 0x87 and _current_band():
+            from rfid import IRQ_PIN
+            GPIO.drive(IRQ_PIN, GPIO.LOW)
+            GPIO.drive(IRQ_PIN, GPIO.HIGH)
+
+    def AntennaOn(self):
+        pass
+
+    def MFRC522_Request(self, req_mode):
+        return (MI_OK, 0x10) if _current_band() else (MI_NOTAGERR, None)
+
+    def MFRC522_Anticoll(self):
+        band = _current_band()
+        if not band:
+            return (MI_ERR, [])
+        uid = band['uid']
+        bcc = uid[0] ^ uid[1] ^ uid[2] ^ uid[3]
+        return (MI_OK, uid + [bcc])
+
+    def MFRC522_SelectTag(self, ser_num):
+        return 0x18 if _current_band() else 0
+
+    def MFRC522_Auth(self, auth_mode, block_addr, sector_key, ser_num):
+        return MI_OK if _current_band() else MI_ERR
+
+    def MFRC522_Read(self, block_addr):
+        band = _current_band()
+        if not band:
+            return None
+        return band['blocks'].get(block_addr, [0] * 16)
+
+    def MFRC522_StopCrypto1(self):
+        pass
+
+
+class CharLCD:
+    """16x2 character LCD replacement that logs what it shows"""
+
+    def __init__(self, i2c_expander=None, address=None, cols=16, rows=2, **kwargs):
+        self.cols = cols
+        self.rows = rows
+        self._lines = [[' '] * cols for _ in range(rows)]
+        self._pos = (0, 0)
+        self.writes = 0
+
+    @property
+    def cursor_pos(self):
+        return self._pos
+
+    @cursor_pos.setter
+    def cursor_pos(self, pos):
+        self._pos = pos
+
+    def write_string(self, text):
+        row, col = self._pos
+        for char in text:
+            if col >= self.cols:
+                break
+            self._lines[row][col] = char
+            col += 1
+        self._pos = (row, col)
+        self.writes += len(text)
+        log(f"LCD: |{''.join(self._lines[0])}|{''.join(self._lines[1])}|", 'DEBUG')
+
+    def clear(self):
+        self._lines = [[' '] * self.cols for _ in range(self.rows)]
+        self._pos = (0, 0)
+
+    def text(self):
+        return [''.join(line) for line in self._lines]
+
+
+# Scripted event source
+
+_band = None
+_band_until = 0
+_band_lock = threading.Lock()
+_script_thread = None
+
+
+def _current_band():
+    with _band_lock:
+        if _band and time.time() < _band_until:
+            return _band
+        return None
+
+
+def present_band(neo_id, name, role='bounty', allegiance='None'):
+    """Put a band on the reader for BAND_PRESENT_TIME seconds"""
+    global _band, _band_until
+    from rfid import block_address
+    uid = [int(part, 16) for part in neo_id.split('-')[:4]]
+    band = {
+        'uid': uid,
+        'blocks': {
+            block_address(1, 0): _block_text(role),
+            block_address(39, 0): _block_text(name),
+            block_address(39, 1): _block_text(allegiance),
+        },
+    }
+    with _band_lock:
+        _band = band
+        _band_until = time.time() + BAND_PRESENT_TIME
+    log(f"SIM: band {neo_id} ({name}) presented")
+
+
+def press_button():
+    """Press and release the booth button"""
+    from gpio import BUTTON_PIN
+    log("SIM: button pressed")
+    GPIO.drive(BUTTON_PIN, GPIO.LOW)
+    time.sleep(BUTTON_PRESS_TIME)
+    GPIO.drive(BUTTON_PIN, GPIO.HIGH)
+
+
+def _random_band():
+    uid = [random.randrange(256) for _ in range(4)]
+    return '-'.join(f"{x:02x}" for x in uid), f"Player{uid[0]:03d}"
+
+
+def _default_script():
+    interval = float(os.environ.get('PHOTOBOOTH_SIM_INTERVAL', DEFAULT_INTERVAL))
+    neo_id, name = _random_band()
+    return [(2.0, 'band', [neo_id, name, 'bounty']),
+            (1.0, 'button', []),
+            (max(0.0, interval - 3.0), 'repeat', [])]
+
+
+def _load_script(path):
+    events = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            events.append((float(parts[0]), parts[1].lower(), parts[2:]))
+    return events
+
+
+def _run_script():
+    path = os.environ.get('PHOTOBOOTH_SIM_SCRIPT')
+    while True:
+        events = _load_script(path) if path else _default_script()
+        repeat = False
+        for delay, action, args in events:
+            time.sleep(delay)
+            if action == 'band':
+                present_band(*args)
+            elif action == 'button':
+                press_button()
+            elif action == 'repeat':
+                repeat = True
+                break
+            else:
+                log(f"SIM: unknown script event {action}")
+        if not repeat:
+            log("SIM: script finished")
+            return
+
+
+def start_script():
+    """Start playing the event script once the booth listens for the button"""
+    global _script_thread
+    if _script_thread is not None:
+        return
+    _script_thread = threading.Thread(target=_run_script, name="sim-script")
+    _script_thread.daemon = True
+    _script_thread.start()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Disk space governor for the Alleycat Photobooth.
+
+Keeps the data drive from filling up during a long event. Free space comes
+from statvfs and clip usage from the sizes the catalog records as clips
+move through the pipeline, so nothing walks the video folders. While free
+space is short, clips that are already uploaded are deleted locally, least
+recently served first. When that isn't enough, clips get shorter and
+encodes smaller, and once there is no room for another clip the booth
+stops recording.
+"""
+
+import os
+import time
+import shutil
+import threading
+from logit import log
+from settings import load_settings, DATA_DIR
+from catalog import (clip_id, get_video, update_video, storage_usage, eviction_candidates,
+                     STATE_EVICTED)
+from thumbnails import preview_path
+from camera import DEFAULT_PREROLL
+from metrics import counter, gauge
+
+# Constants
+DEFAULT_FREE_TARGET = 4 * 1024 ** 3      # evict uploaded clips while less than this is free
+DEFAULT_RESERVE = 512 * 1024 ** 2        # kept free for logs, databases and the OS
+DEFAULT_MIN_AGE = 600                    # seconds an uploaded clip is kept at least
+DEFAULT_DEGRADE_RECORDINGS = 20          # clips left before recordings are degraded
+DEFAULT_DEGRADED_DURATION = 3            # seconds per clip while degraded
+DEFAULT_DEGRADED_BITRATE = 1500000       # bits/s of encodes while degraded
+DEFAULT_BYTES_PER_SECOND = 2500000       # raw capture rate assumed until a clip is recorded
+CHECK_INTERVAL = 10                      # seconds between checks
+EVICTION_BATCH = 20
+EWMA_ALPHA = 0.3
+
+# Storage levels, from best to worst
+LEVEL_OK = 'ok'
+LEVEL_LOW = 'low'             # below the free target, evicting
+LEVEL_DEGRADED = 'degraded'   # few clips left, shorter clips and smaller encodes
+LEVEL_FULL = 'full'           # no room for another clip, not recording
+LEVELS = (LEVEL_OK, LEVEL_LOW, LEVEL_DEGRADED, LEVEL_FULL)
+
+# Metrics
+CLIPS_EVICTED_TOTAL = counter('photobooth_storage_evicted_clips_total', 'Uploaded clips deleted to free space')
+EVICTED_BYTES_TOTAL = counter('photobooth_storage_evicted_bytes_total', 'Bytes freed by deleting uploaded clips')
+
+# Global state
+_governor_thread = None
+_wake = threading.Event()
+_check_lock = threading.Lock()
+_bytes_per_second = DEFAULT_BYTES_PER_SECOND
+_state = {
+    'level': LEVEL_OK,
+    'free': None,
+    'total': None,
+    'next_recording': None,
+    'recordings_left': None,
+    'last_check': None,
+}
+
+
+def _disk():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return shutil.disk_usage(DATA_DIR)
+
+
+def next_recording_bytes(settings=None, duration=None):
+    """Space the next clip needs, from the capture rate seen so far"""
+    if settings is None:
+        settings = load_settings()
+    if duration is None:
+        duration = settings.get('video_duration', 5)
+    seconds = float(duration) + float(settings.get('video_preroll', DEFAULT_PREROLL))
+    # The raw clip and its encode exist side by side while it is processed
+    return int(_bytes_per_second * seconds * 2)
+
+
+def _evict(video):
+    """Delete an uploaded clip's local file. Returns the bytes freed, or None."""
+    freed = 0
+    for path in (video['path'], preview_path(video['clip'])):
+        try:
+            if path:
+                freed += os.path.getsize(path)
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log(f"Error evicting {path}: {e}")
+            return None
+    # The poster stays so the clip can still be browsed
+    update_video(video['filename'], state=STATE_EVICTED, size=0)
+    CLIPS_EVICTED_TOTAL.inc()
+    EVICTED_BYTES_TOTAL.inc(freed)
+    log(f"Evicted uploaded clip {video['clip']} ({freed / 1e6:.1f} MB)", 'DEBUG')
+    return freed
+
+
+def _level(free, left, settings):
+    if left < 1:
+        return LEVEL_FULL
+    if left < int(settings.get('storage_degrade_recordings', DEFAULT_DEGRADE_RECORDINGS)):
+        return LEVEL_DEGRADED
+    if free < int(settings.get('storage_free_target', DEFAULT_FREE_TARGET)):
+        return LEVEL_LOW
+    return LEVEL_OK
+
+
+def check(settings=None):
+    """
+    Evict uploaded clips while free space is below the target, then
+    re-evaluate the storage level.
+
+    Returns:
+        The storage state
+    """
+    if settings is None:
+        settings = load_settings()
+    target = int(settings.get('storage_free_target', DEFAULT_FREE_TARGET))
+    reserve = int(settings.get('storage_reserve', DEFAULT_RESERVE))
+    min_age = float(settings.get('storage_min_age', DEFAULT_MIN_AGE))
+
+    with _check_lock:
+        disk = _disk()
+        free = disk.free
+        evicted = 0
+        candidates = []
+        while free < target:
+            if not candidates:
+                candidates = eviction_candidates(min_age, EVICTION_BATCH)
+                if not candidates:
+                    break
+            freed = _evict(candidates.pop(0))
+            if freed is None:
+                # Try again on the next check rather than spin on a stuck file
+                break
+            evicted += freed
+            free = _disk().free
+        if evicted:
+            log(f"Evicted {evicted / 1e6:.0f} MB of uploaded clips, {free / 1e9:.1f} GB free")
+
+        next_recording = next_recording_bytes(settings)
+        left = max(0, (free - reserve) // next_recording)
+        level = _level(free, left, settings)
+        if level != _state['level']:
+            log(f"Storage {_state['level']} -> {level}: {free / 1e9:.1f} GB free, "
+                f"room for {left} clips")
+        _state.update(level=level, free=free, total=disk.total, next_recording=next_recording,
+                      recordings_left=left, last_check=time.time())
+        return dict(_state)
+
+
+def note_recording(filename):
+    """Learn the capture rate from a freshly recorded clip and re-check soon"""
+    global _bytes_per_second
+    video = get_video(clip_id(filename))
+    if video and video['size'] and video['duration']:
+        rate = video['size'] / video['duration']
+        _bytes_per_second += EWMA_ALPHA * (rate - _bytes_per_second)
+    _wake.set()
+
+
+def plan_recording(duration, settings=None):
+    """
+    Return how long the next clip may be: the requested duration, a
+    shorter one while storage is degraded, or 0 if there is no room.
+    """
+    if settings is None:
+        settings = load_settings()
+    reserve = int(settings.get('storage_reserve', DEFAULT_RESERVE))
+    if _state['level'] in (LEVEL_DEGRADED, LEVEL_FULL):
+        duration = min(duration, int(settings.get('storage_degraded_duration', DEFAULT_DEGRADED_DURATION)))
+    # Always look at the disk itself, it may have filled since the last check
+    if _disk().free - reserve < next_recording_bytes(settings, duration):
+        return 0
+    return duration
+
+
+def encode_bitrate(settings=None):
+    """Bitrate cap for processing, or None while there is space to spare"""
+    if _state['level'] not in (LEVEL_DEGRADED, LEVEL_FULL):
+        return None
+    if settings is None:
+        settings = load_settings()
+    return int(settings.get('storage_degraded_bitrate', DEFAULT_DEGRADED_BITRATE))
+
+
+def lcd_status():
+    """Short disk state for the LCD, empty while all is well"""
+    if _state['level'] == LEVEL_FULL:
+        return "Disk Full"
+    if _state['level'] == LEVEL_OK or not _state['total']:
+        return ""
+    return f"Disk {100 - 100 * _state['free'] // _state['total']}% Full"
+
+
+def _governor_loop():
+    while True:
+        try:
+            check()
+        except Exception as e:
+            log(f"Error checking storage: {e}")
+        _wake.wait(CHECK_INTERVAL)
+        _wake.clear()
+
+
+def start_governor():
+    """Start watching disk space in the background"""
+    global _governor_thread
+    if _governor_thread is not None:
+        return
+    _governor_thread = threading.Thread(target=_governor_loop, name="storage")
+    _governor_thread.daemon = True
+    _governor_thread.start()
+
+
+def get_storage_stats():
+    """Disk state, clip usage and the capture rate estimate"""
+    return {**_state, 'bytes_per_second': int(_bytes_per_second), 'clips': storage_usage()}
+
+
+gauge('photobooth_storage_free_bytes', 'Free space on the data drive', fn=lambda: _state['free'] or 0)
+gauge('photobooth_storage_level', 'Storage level: 0 ok, 1 low, 2 degraded, 3 full',
+      fn=lambda: LEVELS.index(_state['level']))
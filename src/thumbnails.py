@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Poster frames and animated previews for the Alleycat Photobooth.
+
+Each processed clip gets a small JPEG poster and a short animated GIF,
+rendered once and kept in a cache folder, so browsing recordings never
+decodes a full clip per request. Clips from before the cache existed are
+filled in by a throttled background job that steps aside for recordings.
+"""
+
+import os
+import time
+import threading
+import ffmpeg
+from logit import log
+from settings import load_settings, DATA_DIR
+from camera import VIDEO_DIR_OUT, is_capturing
+from catalog import clip_id
+from metrics import counter, histogram
+
+# Constants
+THUMBNAIL_DIR = os.path.join(DATA_DIR, 'thumbnails')
+POSTER_WIDTH = 480
+POSTER_TIME = 1.0          # seconds into the clip the poster is taken from
+PREVIEW_WIDTH = 240
+PREVIEW_FPS = 8
+PREVIEW_SECONDS = 3
+BACKFILL_DELAY = 2.0       # seconds between backfilled clips
+BUSY_POLL = 0.5            # seconds between checks while the camera is in use
+
+# Metrics
+THUMBNAIL_SECONDS = histogram('photobooth_thumbnail_seconds', 'Time to render a clip poster and preview')
+THUMBNAILS_TOTAL = counter('photobooth_thumbnails_total', 'Clip thumbnails rendered by result')
+
+# Global state
+_backfill_thread = None
+_backfill_lock = threading.Lock()
+
+
+def poster_path(clip):
+    return os.path.join(THUMBNAIL_DIR, f"{clip}.jpg")
+
+
+def preview_path(clip):
+    return os.path.join(THUMBNAIL_DIR, f"{clip}.gif")
+
+
+def _poster(video_path, output):
+    return (
+        ffmpeg
+        .input(video_path, ss=POSTER_TIME)
+        .filter('scale', POSTER_WIDTH, -2)
+        .output(output, vframes=1, f='image2', **{'q:v': 4})
+    )
+
+
+def _preview(video_path, output):
+    # Build a palette from the clip itself, GIFs look muddy with the default one
+    frames = (
+        ffmpeg
+        .input(video_path, t=PREVIEW_SECONDS)
+        .filter('fps', PREVIEW_FPS)
+        .filter('scale', PREVIEW_WIDTH, -2)
+        .split()
+    )
+    palette = frames[0].filter('palettegen')
+    return ffmpeg.filter([frames[1], palette], 'paletteuse').output(output, f='gif')
+
+
+def _render(build, video_path, output, threads, yield_to_capture):
+    """
+    Run one ffmpeg render to a temporary file and move it into place.
+
+    Returns True on success, False on failure and None if it was abandoned
+    because a recording started.
+    """
+    tmp_path = output + '.tmp'
+    process = (
+        build(video_path, tmp_path)
+        .global_args('-loglevel', 'error', '-threads', str(threads))
+        .overwrite_output()
+        .run_async()
+    )
+    try:
+        while process.poll() is None:
+            if yield_to_capture and is_capturing():
+                process.kill()
+                process.wait()
+                return None
+            time.sleep(0.1)
+        if process.returncode != 0:
+            return False
+        os.replace(tmp_path, output)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def generate_thumbnails(video_path, threads=0, yield_to_capture=False):
+    """
+    Render the poster and preview of a processed clip.
+
+    Args:
+        video_path: Path of the processed clip
+        threads: ffmpeg thread count, 0 lets ffmpeg decide
+        yield_to_capture: Give up as soon as the camera is in use
+
+    Returns:
+        True if both images exist afterwards, False if rendering failed,
+        None if it was abandoned for a recording
+    """
+    clip = clip_id(video_path)
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    start = time.time()
+    try:
+        for build, output in ((_poster, poster_path(clip)), (_preview, preview_path(clip))):
+            if os.path.exists(output):
+                continue
+            result = _render(build, video_path, output, threads, yield_to_capture)
+            if not result:
+                if result is False:
+                    THUMBNAILS_TOTAL.inc(result='failed')
+                return result
+    except Exception as e:
+        log(f"Error rendering thumbnails for {clip}: {e}")
+        THUMBNAILS_TOTAL.inc(result='failed')
+        return False
+
+    THUMBNAIL_SECONDS.observe(time.time() - start)
+    THUMBNAILS_TOTAL.inc(result='ok')
+    return True
+
+
+def _wait_for_idle_camera():
+    while is_capturing():
+        time.sleep(BUSY_POLL)
+
+
+def _backfill():
+    """Render missing thumbnails for clips already in the out folder"""
+    try:
+        entries = sorted(os.scandir(VIDEO_DIR_OUT), key=lambda e: e.name)
+    except OSError:
+        return
+
+    done = 0
+    for entry in entries:
+        if not entry.name.endswith('.mp4') or not entry.is_file():
+            continue
+        clip = clip_id(entry.name)
+        if os.path.exists(poster_path(clip)) and os.path.exists(preview_path(clip)):
+            continue
+
+        delay = float(load_settings().get('thumbnail_backfill_delay', BACKFILL_DELAY))
+        result = None
+        while result is None:
+            _wait_for_idle_camera()
+            # One thread, and abandoned if a recording starts, so it never
+            # competes with the camera
+            result = generate_thumbnails(entry.path, threads=1, yield_to_capture=True)
+        if result:
+            done += 1
+        time.sleep(delay)
+
+    if done:
+        log(f"Backfilled thumbnails for {done} clip(s)")
+
+
+def start_backfill():
+    """Start the thumbnail backfill in the background if it isn't running"""
+    global _backfill_thread
+    with _backfill_lock:
+        if _backfill_thread is not None and _backfill_thread.is_alive():
+            return
+        _backfill_thread = threading.Thread(target=_backfill, name="thumbnail-backfill")
+        _backfill_thread.daemon = True
+        _backfill_thread.start()
@@ -4,53 +4,72 @@ Web interface for the Alleycat Photobooth.
 Handles the Flask web server and API endpoints.
 """
 
-from flask import Flask, render_template, Response, request, jsonify
-import ffmpeg
-import subprocess
-from logit import log
+from flask import Flask, render_template, Response, request, jsonify, send_from_directory
+import socket
+import threading
+from werkzeug.serving import make_server, WSGIRequestHandler
+from logit import log, get_recent_logs
 from settings import load_settings, save_settings
+from processing import get_queue_stats
+from broadcast import get_broadcaster
+from preview import stream_preview, close_all as close_previews
+from scanlog import last_scan, scan_count
+from samba import get_upload_stats
+from metrics import render as render_metrics
+from catalog import list_videos, get_video, touch_video, FILTERS, MAX_PAGE_SIZE
+from thumbnails import THUMBNAIL_DIR
+from camera import VIDEO_DIR_OUT
+from encoders import get_encoder, get_probe_results, H264_ENCODERS
+from coordinator import fleet
+from fleet import get_agent_stats
+from storage import get_storage_stats
 
-# Global state
-recording = False
-stream_process = None
-webcam_device = None
+try:
+    from waitress import create_server
+except ImportError:
+    create_server = None
+
+# Constants
+DEFAULT_PORT = 5000
+DEFAULT_THREADS = 16              # concurrent requests, each preview stream holds one
+DEFAULT_CHANNEL_TIMEOUT = 60      # seconds an idle connection is kept
+DEFAULT_CONNECTION_LIMIT = 100    # open connections before new ones wait
+DEFAULT_OUTBUF_HIGH_WATERMARK = 64 * 1024  # bytes buffered per connection before the app waits
+DEFAULT_SEND_BUFFER = 64 * 1024    # kernel send buffer per connection, 0 for the system's
+THUMBNAIL_MAX_AGE = 7 * 24 * 3600  # seconds browsers may cache a thumbnail
+STOP_TIMEOUT = 5                  # seconds open requests get to finish on shutdown
+VIDEOS_PAGE_SIZE = 24
 
 app = Flask(__name__)
+# Every booth can act as the fleet coordinator
+app.register_blueprint(fleet)
 
-def get_webcam_device():
-    """Find the first available webcam device"""
-    global webcam_device
-    
-    # If we already have a device, return it
-    if webcam_device:
-        return webcam_device
-        
-    # Otherwise, find a new device
-    for i in range(10):  # Check up to /dev/video9
-        device = f"/dev/video{i}"
-        if os.path.exists(device):
-            webcam_device = device
-            return device
-            
-    return None
+# Global state
+_server = None
+_server_lock = threading.Lock()
 
 # Web Interface Routes
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', storage=get_storage_stats())
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     if request.method == 'POST':
         try:
-            # Get form data
+            # Get form data, keeping settings the form doesn't show
             settings_data = {
+                **load_settings(),
                 'webcam_device': request.form.get('webcam_device'),
                 'webcam_resolution': request.form.get('webcam_resolution'),
                 'webcam_rotation': int(request.form.get('webcam_rotation', 0)),
                 'video_duration': int(request.form.get('video_duration')),
-                'video_framerate': int(request.form.get('video_framerate'))
+                'video_framerate': int(request.form.get('video_framerate')),
+                'video_encoder': request.form.get('video_encoder') or None
             }
+            # Automatic encoder selection is the absence of the setting
+            if not settings_data['video_encoder']:
+                del settings_data['video_encoder']
             
             # Save settings
             if save_settings(settings_data):
@@ -65,156 +84,184 @@ def settings():
     
     # Load current settings for the form
     current_settings = load_settings()
-    return render_template('settings.html', settings=current_settings, message=message)
+    return render_template('settings.html', settings=current_settings, message=message,
+                           encoder=get_encoder(current_settings), probe=get_probe_results(),
+                           encoder_choices=H264_ENCODERS)
 
 @app.route('/preview')
 def preview():
     return render_template('preview.html')
 
+@app.route('/videos')
+def videos():
+    page = max(1, request.args.get('page', 1, type=int))
+    clips, total = list_videos(limit=VIDEOS_PAGE_SIZE, offset=(page - 1) * VIDEOS_PAGE_SIZE)
+    pages = max(1, -(-total // VIDEOS_PAGE_SIZE))
+    return render_template('videos.html', videos=clips, page=page, pages=pages, total=total)
+
+@app.route('/videos/<clip>/poster.jpg')
+def video_poster(clip):
+    # Thumbnails never change once rendered, so let browsers keep them
+    return send_from_directory(THUMBNAIL_DIR, f"{clip}.jpg", max_age=THUMBNAIL_MAX_AGE)
+
+@app.route('/videos/<clip>/preview.gif')
+def video_preview(clip):
+    return send_from_directory(THUMBNAIL_DIR, f"{clip}.gif", max_age=THUMBNAIL_MAX_AGE)
+
+@app.route('/videos/<clip>/video.mp4')
+def video_file(clip):
+    """
+    Stream a processed clip. Range requests let browsers scrub, and ETag
+    and Last-Modified make repeat downloads conditional. The file is handed
+    to the server's file wrapper rather than read into memory here.
+    """
+    # Recently watched clips are the last to be evicted
+    touch_video(clip)
+    return send_from_directory(VIDEO_DIR_OUT, f"{clip}.mp4",
+                               mimetype='video/mp4',
+                               as_attachment=request.args.get('download') == '1',
+                               conditional=True,
+                               etag=True)
+
+@app.route('/api/queue')
+def api_queue():
+    """Processing and upload queue depth and per-job timings"""
+    return jsonify({'processing': get_queue_stats(), 'uploads': get_upload_stats()})
+
+@app.route('/api/storage')
+def api_storage():
+    """Disk space, storage level and clip usage"""
+    return jsonify(get_storage_stats())
+
+@app.route('/api/fleet')
+def api_fleet():
+    """This booth's connection to the fleet coordinator"""
+    return jsonify(get_agent_stats())
+
+@app.route('/api/scans/<neo_id>')
+def api_scans(neo_id):
+    """When a band last scanned and how often"""
+    last = last_scan(neo_id)
+    if last is None:
+        return jsonify({'error': 'Band has not been scanned'}), 404
+    return jsonify({'last': last, 'count': scan_count(neo_id)})
+
+@app.route('/api/videos')
+def api_videos():
+    """Catalogued clips, newest first, filterable by player, state and upload status"""
+    limit = max(1, min(request.args.get('limit', 50, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    filters = {key: request.args.get(key) for key in FILTERS if key in request.args}
+    videos, total = list_videos(filters, limit, offset)
+    return jsonify({'total': total, 'limit': limit, 'offset': offset, 'videos': videos})
+
+@app.route('/api/videos/<clip>')
+def api_video(clip):
+    """Catalog entry of a single clip"""
+    video = get_video(clip)
+    if video is None:
+        return jsonify({'error': 'Clip not found'}), 404
+    return jsonify(video)
+
+@app.route('/api/logs')
+def api_logs():
+    """Recent log records, filterable by level and module"""
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify(get_recent_logs(limit, request.args.get('level'), request.args.get('module')))
+
+@app.route('/api/metrics')
+def api_metrics():
+    """Prometheus metrics"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/preview')
 def api_preview():
-    """Stream MJPEG from webcam"""
-    global recording, stream_process, webcam_device
-    
-    if recording:
-        log("Camera busy - recording in progress")
-        return "Camera Busy", 503
-    
-    # Clean up any existing stream process
-    if stream_process:
-        try:
-            log("Terminating previous stream process")
-            stream_process.terminate()
-            try:
-                stream_process.wait(timeout=1)
-            except subprocess.TimeoutExpired:
-                log("Force killing previous stream process")
-                stream_process.kill()
-                stream_process.wait()
-        except Exception as e:
-            log(f"Error cleaning up previous stream: {str(e)}")
-        finally:
-            stream_process = None
-            # Add a small delay to ensure device is released
-            time.sleep(0.5)
-    
-    # Use the global device instance
-    if not webcam_device:
-        webcam_device = get_webcam_device()
-    
-    if not webcam_device:
+    """Stream MJPEG from the shared camera broadcaster"""
+    broadcaster = get_broadcaster()
+    if not broadcaster:
         log("No camera device found")
         return "No camera found", 503
     
+    # Each client drops stale frames and adapts its rate to its connection
+    return Response(
+        stream_preview(broadcaster),
+        mimetype='multipart/x-mixed-replace; boundary=frame'
+    )
+
+def _make_server(settings):
+    """
+    Create the HTTP server picked by the web_server setting.
+
+    'waitress' (the default when it is installed) serves requests from a
+    fixed pool of threads; 'werkzeug' starts a thread per request.
+
+    Returns:
+        (name, serve, stop) where serve blocks until stop is called
+    """
+    kind = settings.get('web_server', 'auto')
+    host = settings.get('web_host', '0.0.0.0')
+    port = int(settings.get('web_port', DEFAULT_PORT))
+    threads = int(settings.get('web_threads', DEFAULT_THREADS))
+    timeout = int(settings.get('web_channel_timeout', DEFAULT_CHANNEL_TIMEOUT))
+    # Connections inherit the listening socket's send buffer. Together with
+    # a small outbuf a slow preview client blocks its stream within a frame
+    # or two, and that wait is how preview.py measures its drain rate.
+    send_buffer = int(settings.get('web_send_buffer', DEFAULT_SEND_BUFFER))
+    socket_options = [(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)] if send_buffer else []
+
+    if kind in ('auto', 'waitress') and create_server is not None:
+        server = create_server(app,
+                               host=host,
+                               port=port,
+                               threads=threads,
+                               channel_timeout=timeout,
+                               connection_limit=int(settings.get('web_connection_limit',
+                                                                 DEFAULT_CONNECTION_LIMIT)),
+                               outbuf_high_watermark=int(settings.get('web_outbuf_high_watermark',
+                                                                      DEFAULT_OUTBUF_HIGH_WATERMARK)),
+                               ident='photobooth')
+        for option in socket_options:
+            server.socket.setsockopt(*option)
+
+        def stop():
+            # Let requests that are still finishing use the server before it closes
+            server.task_dispatcher.shutdown(timeout=STOP_TIMEOUT)
+            server.close()
+        return 'waitress', server.run, stop
+
+    if kind == 'waitress':
+        log("waitress is not installed, falling back to werkzeug")
+
+    # Drop connections that stay silent, like waitress' channel_timeout
+    handler = type('RequestHandler', (WSGIRequestHandler,), {'timeout': timeout})
+    server = make_server(host, port, app, threaded=True, request_handler=handler)
+    server.daemon_threads = True
+    for option in socket_options:
+        server.socket.setsockopt(*option)
+    return 'werkzeug', server.serve_forever, server.shutdown
+
+def run_flask():
+    """Run the Flask admin interface until stop_flask is called"""
+    global _server
+    settings = load_settings()
+    # Behind a proxy that understands X-Sendfile the kernel sends clips directly
+    app.use_x_sendfile = bool(settings.get('web_x_sendfile', False))
     try:
-        settings = load_settings(force_reload=True)
-        
-        # Calculate half resolution from settings
-        full_res = settings.get('webcam_resolution', '1280x720')
-        width, height = full_res.split('x')
-        half_res = f"{int(width)//2}x{int(height)//2}"
-        
-        # Get rotation from settings
-        rotation = settings.get('webcam_rotation', 0)
-        
-        log(f"Starting video stream: device={webcam_device}, resolution={half_res}, rotation={rotation}")
-        
-        # Start with basic input
-        # low res and bc it's just for preview
-        stream = (
-            ffmpeg
-            .input(webcam_device, 
-                   f='v4l2',
-                   input_format='mjpeg',
-                   s=half_res,
-                   framerate=5)
-        )
-        
-        # Apply rotation if specified
-        if rotation != 0:
-            stream = stream.filter('transpose', rotation)
-        
-        # Add output settings
-        stream_process = (
-            stream
-            .output('pipe:', 
-                   format='mpjpeg',
-                   vcodec='mjpeg',  # Use mjpeg encoding since we might have rotation
-                   pix_fmt='yuvj422p',
-                   q=2)  # Quality setting for mjpeg encoding
-            .run_async(pipe_stdout=True)
-        )
-        
-        log("Video stream started successfully")
-        
-        def generate():
-            global stream_process
-            try:
-                buffer = b''
-                while True:
-                    if not stream_process:
-                        log("Stream process not initialized", "ERROR")
-                        break
-                    
-                    # Read a chunk of data
-                    chunk = stream_process.stdout.read(4096)  # Read 4KB at a time
-                    if not chunk:
-                        break
-                        
-                    buffer += chunk
-                    
-                    # Look for JPEG markers
-                    start = buffer.find(b'\xff\xd8')
-                    if start != -1:
-                        end = buffer.find(b'\xff\xd9', start)
-                        if end != -1:
-                            # Found a complete JPEG frame
-                            jpeg_frame = buffer[start:end+2]
-                            yield (b'--frame\r\n'
-                                   b'Content-Type: image/jpeg\r\n\r\n' + jpeg_frame + b'\r\n')
-                            # Keep any remaining data
-                            buffer = buffer[end+2:]
-            except Exception as e:
-                log(f"Error in stream generation: {str(e)}", "ERROR")
-            finally:
-                if stream_process:
-                    try:
-                        log("Terminating stream process in generator")
-                        stream_process.terminate()
-                        try:
-                            stream_process.wait(timeout=1)
-                        except subprocess.TimeoutExpired:
-                            log("Force killing stream process in generator")
-                            stream_process.kill()
-                            stream_process.wait()
-                    except Exception as e:
-                        log(f"Error terminating stream in generator: {str(e)}")
-                    finally:
-                        stream_process = None
-        
-        return Response(
-            generate(),
-            mimetype='multipart/x-mixed-replace; boundary=frame'
-        )
-        
+        name, serve, stop = _make_server(settings)
     except Exception as e:
-        log(f"Error starting stream: {str(e)}")
-        if stream_process:
-            try:
-                log("Terminating stream process in error handler")
-                stream_process.terminate()
-                try:
-                    stream_process.wait(timeout=1)
-                except subprocess.TimeoutExpired:
-                    log("Force killing stream process in error handler")
-                    stream_process.kill()
-                    stream_process.wait()
-            except Exception as e:
-                log(f"Error terminating stream in error handler: {str(e)}")
-            finally:
-                stream_process = None
-        return jsonify({'error': 'Failed to start webcam stream'}), 500
+        log(f"Error starting web server: {e}")
+        return
+    with _server_lock:
+        _server = stop
+    log(f"Web server ({name}) listening")
+    serve()
 
-def run_flask():
-    """Run the Flask admin interface in a separate thread"""
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False) 
\ No newline at end of file
+def stop_flask():
+    """Stop the web server and end open preview streams"""
+    global _server
+    close_previews()
+    with _server_lock:
+        stop, _server = _server, None
+    if stop:
+        stop()
+        log("Web server stopped")